@@ -0,0 +1,110 @@
+"""
+Bounded outbound queue of one client connection, so a client that reads slowly
+backs up its own queue instead of the exchange.
+"""
+
+import asyncio
+from collections import deque
+
+from .ouch_messages import OuchServerMessages
+
+# Server messages that only describe the market. A client that falls behind can lose
+# or conflate them without missing anything about its own orders.
+MARKET_DATA_MESSAGES = frozenset((
+    OuchServerMessages.BestBidAndOffer,
+    OuchServerMessages.PostBatch,
+    OuchServerMessages.PegStateUpdate,
+))
+
+# What a full queue does with a new message:
+#   drop: market data is dropped
+#   conflate: market data supersedes the queued message of the same type and stock, which is
+#       dropped, and goes to the back of the queue, after the messages queued before it; it is
+#       dropped if there is none
+#   disconnect: the client is disconnected
+# Whatever the policy, an order message that does not fit disconnects the client: it cannot be
+# dropped, and queueing it past the bounds would let the queue grow without limit.
+OVERFLOW_POLICIES = ('drop', 'conflate', 'disconnect')
+
+
+def conflation_key(server_msg):
+    '''
+    (message type, stock) of a market data message, None for any other message. Two messages
+    with the same key describe the same thing, the later one supersedes the earlier.
+    '''
+    message_type = server_msg.message_type
+    if message_type not in MARKET_DATA_MESSAGES:
+        return None
+    return (message_type, server_msg['stock'] if 'stock' in server_msg else None)
+
+
+class ClientSendQueue:
+    '''
+    Serialized messages waiting to be written to one client, bounded by bytes and by number
+    of messages. The connection's writer task waits on ready and writes everything queued
+    with a single writelines, until the queue is closed and empty.
+    '''
+
+    def __init__(self, max_bytes = None, max_messages = None, overflow_policy = 'conflate'):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % overflow_policy)
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.overflow_policy = overflow_policy
+        # entries are [message bytes, conflation key], lists so conflation can blank out (set to None
+        # the bytes of) the entry it supersedes, which take skips
+        self.entries = deque()
+        self.queued_messages = 0
+        self.queued_bytes = 0
+        # conflation key -> queued entry
+        self.market_data = {}
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+
+    def __len__(self):
+        return self.queued_messages
+
+    def full(self, message_bytes):
+        return ((self.max_bytes is not None and self.queued_bytes + len(message_bytes) > self.max_bytes)
+                or (self.max_messages is not None and self.queued_messages >= self.max_messages))
+
+    def put(self, message_bytes, key = None):
+        '''
+        Queue a message, key being its conflation_key.
+        Returns False if the client must be disconnected, True otherwise.
+        '''
+        if self.full(message_bytes):
+            if self.overflow_policy == 'disconnect' or key is None:
+                return False
+            elif self.overflow_policy == 'conflate' and key in self.market_data:
+                queued = self.market_data[key]
+                self.queued_bytes -= len(queued[0])
+                self.queued_messages -= 1
+                queued[0] = None
+            else:
+                self.dropped += 1
+                return True
+        entry = [message_bytes, key]
+        self.entries.append(entry)
+        self.queued_messages += 1
+        self.queued_bytes += len(message_bytes)
+        if key is not None:
+            self.market_data[key] = entry
+        self.ready.set()
+        return True
+
+    def take(self):
+        '''Empty the queue, returning the bytes of every queued message in order'''
+        chunks = [message_bytes for (message_bytes, _) in self.entries if message_bytes is not None]
+        self.entries.clear()
+        self.market_data.clear()
+        self.queued_messages = 0
+        self.queued_bytes = 0
+        self.ready.clear()
+        return chunks
+
+    def close(self):
+        '''No more messages will be queued: the writer task writes what is queued and stops'''
+        self.closed = True
+        self.ready.set()
@@ -0,0 +1,58 @@
+"""
+Clocks giving the time as nanoseconds since midnight, the timestamp of OUCH messages and market logs
+"""
+
+import datetime
+import time
+import pytz
+
+DEFAULT_TIMEZONE = pytz.timezone('US/Pacific')
+
+NANOSECONDS_PER_DAY = 86400 * 10**9
+# UTC offsets and their changes fall on quarter hours, so the offset looked up at a resync holds until the next one
+RESYNC_NANOSECONDS = 15 * 60 * 10**9
+
+
+class MidnightClock(object):
+    """
+    Wall clock time of a timezone, as nanoseconds since its midnight. The wall clock and UTC offset are
+    read once every quarter hour, and the time in between is counted with time.monotonic_ns, so calls
+    cost a clock read and some integer arithmetic, and never step back between two resyncs.
+    """
+
+    def __init__(self, tz=DEFAULT_TIMEZONE):
+        self.tz = tz
+        self.resync()
+
+    def resync(self):
+        """Anchor the monotonic clock to the wall clock, and look up the UTC offset"""
+        wall = time.time_ns()
+        self.monotonic_anchor = time.monotonic_ns()
+        offset = datetime.datetime.fromtimestamp(wall // 10**9, tz=self.tz).utcoffset()
+        self.local_anchor = wall + int(offset.total_seconds()) * 10**9
+        self.resync_at = self.monotonic_anchor + RESYNC_NANOSECONDS - self.local_anchor % RESYNC_NANOSECONDS
+
+    def __call__(self):
+        now = time.monotonic_ns()
+        if now >= self.resync_at:
+            self.resync()
+            now = self.monotonic_anchor
+        return (self.local_anchor + now - self.monotonic_anchor) % NANOSECONDS_PER_DAY
+
+
+class SimulatedClock(object):
+    """
+    A clock that only moves when told to, for replays: the exchange's timestamps are the ones of the
+    messages replayed, however fast they go through.
+    """
+
+    def __init__(self, now=0):
+        self.now = now
+
+    def set(self, now):
+        """Move the clock to now, if that is later than its time"""
+        if now > self.now:
+            self.now = now
+
+    def __call__(self):
+        return self.now
@@ -4,33 +4,131 @@ Simple Ouch Server to do request echoing
 
 import sys
 import asyncio
-import asyncio.streams
 import configargparse
 import logging as log
 import itertools
 from collections import namedtuple
 from functools import partial
 import datetime
-import pytz
 
 from .ouch_messages import OuchClientMessages, OuchServerMessages
+from .client_send_queue import ClientSendQueue, conflation_key
+from .clock import DEFAULT_TIMEZONE, MidnightClock
 
-DEFAULT_TIMEZONE = pytz.timezone('US/Pacific')
+# size of the buffer a connection reads into; every complete message in it is decoded before it fills up
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class ClientConnection(asyncio.BufferedProtocol):
+    """
+    One client connection. The transport reads straight into a buffer allocated once (see
+    get_buffer), and the client's task decodes the messages there in place, from the start offset
+    up to the end one; only a partial message left near the end of the buffer is ever moved, back
+    to its front. Reading pauses while the buffer is full. The connection is its own writer too,
+    with the writelines, drain and close of a StreamWriter.
+    """
+
+    def __init__(self, server, buffer_size=READ_BUFFER_SIZE):
+        self.server = server
+        self.buffer = bytearray(max(buffer_size, server.max_message_size))
+        # the bytes read and not decoded yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        self.eof = False
+        # set when bytes are read or the client is gone, for the client's task
+        self.readable = asyncio.Event()
+        self.transport = None
+        self.reading_paused = False
+        self.writing_paused = False
+        self.drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server._accept_client(self, self)
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.end == len(self.buffer):
+            self.transport.pause_reading()
+            self.reading_paused = True
+        self.readable.set()
+
+    def consumed(self, position):
+        """The messages up to position were decoded: make room for the next read"""
+        self.start = position
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < self.server.max_message_size:
+            remainder = self.end - self.start
+            self.buffer[:remainder] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, remainder
+        if self.reading_paused and self.end < len(self.buffer):
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        self.eof = True
+        self.readable.set()
+        # stay open for writing, the writer task closes the connection once its queue is sent
+        return True
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.readable.set()
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_exception(ConnectionResetError('Connection lost'))
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def writelines(self, chunks):
+        self.transport.writelines(chunks)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        if self.writing_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            await self.drain_waiter
+
+    def close(self):
+        self.transport.close()
 
 
 class ProtocolMessageServer(object): 
     """
     
     """
-    ClientInfo = namedtuple('ClientInfo', ['task', 'reader', 'writer'])
+    ClientInfo = namedtuple('ClientInfo', ['task', 'reader', 'writer', 'send_queue', 'writer_task'])
     
-    def __init__(self, ProtocolMessageTypes, host='0.0.0.0', port=8090):
+    def __init__(self, ProtocolMessageTypes, host='0.0.0.0', port=8090,
+                 send_queue_bytes=None, send_queue_messages=None, overflow_policy='conflate'):
+        """
+        send_queue_bytes, send_queue_messages: bounds of each client's outbound queue (None: unbounded)
+        overflow_policy: what a full queue does, see client_send_queue.OVERFLOW_POLICIES
+        """
         self._ProtocolMessageCls = ProtocolMessageTypes.get_message_class()
         self._ProtocolMessageTypes = ProtocolMessageTypes
         self._tokens = itertools.count(0,2)  # evens
         self.server = None # encapsulates the server sockets
         self.clients = {}  # token -> ClientInfo
         self.listeners = {}  # token -> callback    
+        self.send_queue_bytes = send_queue_bytes
+        self.send_queue_messages = send_queue_messages
+        self.overflow_policy = overflow_policy
+        # header (as an int) -> (message type, payload size), to frame messages straight out of a buffer
+        self._header_size = self._ProtocolMessageCls.get_header_class().size
+        self._frames = {int.from_bytes(message_type.header_bytes, 'big'): (message_type, message_type.payload_size)
+                        for message_type in ProtocolMessageTypes}
+        self.max_message_size = self._header_size + max(message_type.payload_size for message_type in ProtocolMessageTypes)
 
         # server host and port
         self.host = host
@@ -52,57 +150,124 @@ class ProtocolMessageServer(object):
         # start a new Task to handle this specific client connection
         client_token = next(self._tokens)
         task = asyncio.Task(self._handle_client_requests(client_token, client_reader))
+        # outbound messages wait in the client's own queue for its own writer task, so a
+        # client that reads slowly never holds up the exchange or the other clients
+        send_queue = ClientSendQueue(self.send_queue_bytes, self.send_queue_messages, self.overflow_policy)
+        writer_task = asyncio.Task(self._write_client(client_token, client_writer, send_queue))
         
         log.info('client task %s created: %s', str(client_token), task)
-        self.clients[client_token] = self.ClientInfo(task, client_reader, client_writer)
+        self.clients[client_token] = self.ClientInfo(task, client_reader, client_writer, send_queue, writer_task)
 
         def client_done(task):
             log.info('client task %s done: %s', str(client_token), task)
-            del self.clients[client_token]
+            self.clients.pop(client_token, None)
+            # the writer task sends what is still queued, then closes the connection
+            send_queue.close()
 
         task.add_done_callback(client_done)
     
-    async def _handle_client_requests(self, client_token, client_reader):
+    async def _handle_client_requests(self, client_token, connection):
         """
         This method actually does the work to handle the requests for
-        a specific client.  The protocol is line oriented, so there is
-        a main loop that reads a line with a request and then sends
-        out one or more lines back to the client with the result.
+        a specific client, a ClientConnection. Every complete message read
+        into its buffer is decoded in place, so a burst of orders costs one
+        wakeup rather than two reads per message. A partial message at the
+        end of the buffer waits for the next read.
         """
-        header_size = self._ProtocolMessageCls.get_header_class().size
         while True:
-            try:
-                header_bytes = (await client_reader.readexactly(header_size))
-            except asyncio.IncompleteReadError:
-                log.info('no more messages; connection terminated')
+            await connection.readable.wait()
+            connection.readable.clear()
+            # whatever was read before the end of the stream is decoded below
+            eof = connection.eof
+            (client_msgs, position, failed) = self.decode_messages(connection.buffer, client_token,
+                                                                   connection.start, connection.end)
+            connection.consumed(position)
+            for client_msg in client_msgs:
+                await self.broadcast_to_listeners(client_msg)
+            if failed:
+                log.error('Unknown message header, connection terminated')
                 break
-            message_type = (self._ProtocolMessageTypes
-                            .lookup_by_header_bytes(header_bytes))
-            payload_size = message_type.payload_size
-            try:
-                payload_bytes = (await client_reader.readexactly(payload_size))
-            except asyncio.IncompleteReadError as err:
-                log.error('Connection terminated mid-packet!')
+            if eof:
+                if connection.start < connection.end:
+                    log.error('Connection terminated mid-packet!')
+                else:
+                    log.info('no more messages; connection terminated')
                 break
 
-            client_msg = message_type.from_bytes(payload_bytes, header=False)
-            client_msg.meta = client_token
-            await self.broadcast_to_listeners(client_msg)
+    def decode_messages(self, buffer, meta=None, start=0, end=None):
+        """
+        Decode the complete messages of buffer[start:end].
+        Args:
+            buffer: bytes or bytearray of back to back messages, headers included
+            meta: set as the meta of every decoded message
+            start, end: offsets of the bytes to decode, end None for the end of buffer
+        Returns:
+            (messages, position, failed): the messages, the offset in buffer past
+            them, and whether decoding stopped at a header naming no known message
+            type (position is then that of the header)
+        """
+        header_size = self._header_size
+        frames = self._frames
+        if end is None:
+            end = len(buffer)
+        position = start
+        messages = []
+        while position + header_size <= end:
+            if header_size == 1:
+                header = buffer[position]
+            else:
+                header = int.from_bytes(buffer[position:position + header_size], 'big')
+            frame = frames.get(header)
+            if frame is None:
+                return messages, position, True
+            (message_type, payload_size) = frame
+            payload_start = position + header_size
+            if payload_start + payload_size > end:
+                break
+            message = message_type.from_buffer(buffer, payload_start)
+            message.meta = meta
+            messages.append(message)
+            position = payload_start + payload_size
+        return messages, position, False
             
     async def send_server_response(self, server_msg):
-        client_token = server_msg.meta
-        try:
-            client_writer = self.clients[client_token].writer
-        except KeyError:
-            return
-        client_writer.write(bytes(server_msg))
-        await client_writer.drain()
+        client = self.clients.get(server_msg.meta)
+        if client is not None:
+            self._queue_message(server_msg.meta, client, bytes(server_msg), conflation_key(server_msg))
 
     async def broadcast_server_message(self, server_msg):
-        for client in self.clients.values():
-            client.writer.write(bytes(server_msg))
-        for client in self.clients.values():
-            await client.writer.drain()
+        # serialized once, whatever the number of clients
+        message_bytes = bytes(server_msg)
+        key = conflation_key(server_msg)
+        for (client_token, client) in list(self.clients.items()):
+            self._queue_message(client_token, client, message_bytes, key)
+
+    def _queue_message(self, client_token, client, message_bytes, key):
+        """
+        Queue message_bytes for a client. Replies and broadcasts share the queue, so a client
+        sees them in the order they were sent.
+        """
+        if not client.send_queue.put(message_bytes, key):
+            log.warning('client %s send queue is full (%d messages), disconnecting', client_token, len(client.send_queue))
+            self.clients.pop(client_token, None)
+            client.writer.close()
+            client.writer_task.cancel()
+
+    async def _write_client(self, client_token, client_writer, send_queue):
+        """
+        Writer task of a connection: write everything queued since its last write with one
+        writelines, then wait for the client to take it before the next write. Once the queue
+        is closed and sent, close the connection.
+        """
+        try:
+            while not send_queue.closed or len(send_queue):
+                await send_queue.ready.wait()
+                client_writer.writelines(send_queue.take())
+                await client_writer.drain()
+        except ConnectionError as err:
+            log.info('client %s connection lost while writing: %s', client_token, err)
+        finally:
+            client_writer.close()
     
     def register_listener(self, callback):
         listener_token = next(self._tokens)
@@ -125,10 +290,8 @@ class ProtocolMessageServer(object):
         called.  This method runs the loop until the server sockets
         are ready to accept connections.
         """
-        self.server = await asyncio.streams.start_server(self._accept_client,
-                                         self.host, 
-                                         self.port
-                                         )
+        self.server = await asyncio.get_running_loop().create_server(
+            partial(ClientConnection, self), self.host, self.port)
 
     def stop(self, loop):
         """
@@ -140,7 +303,11 @@ class ProtocolMessageServer(object):
             loop.run_until_complete(self.server.wait_closed())
             self.server = None
 
+default_clock = MidnightClock()
+
 def nanoseconds_since_midnight(tz=DEFAULT_TIMEZONE):
+    if tz is DEFAULT_TIMEZONE:
+        return default_clock()
     now = datetime.datetime.now(tz=tz)
     timestamp = 0  # since midnight
     timestamp += now.hour
@@ -1,5 +1,6 @@
 import struct
 import enum
+from operator import attrgetter
 
 class DuplicateFreeEnum(enum.Enum):
     # force unique values, as per docs:
@@ -42,6 +43,8 @@ class NamedFieldSequenceSerializerMeta(type):
             cls._wire_format +
             ''.join(cls._protocol_fields[field].type_spec
                     for field in cls.__slots__))
+        # slot -> position, so key lookups are a dict hit rather than a scan of __slots__
+        cls._slot_indexes = {slot: i for (i, slot) in enumerate(cls.__slots__)}
         super().__init__(name, bases, namespace)
 
     @property
@@ -58,6 +61,11 @@ class NamedFieldSequence(object, metaclass=NamedFieldSequenceSerializerMeta):
     def from_bytes(cls, source_bytes):
         return cls(*cls._struct_formatter.unpack(source_bytes))
 
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
+        """decode the fields starting at offset of buffer, without slicing it"""
+        return cls(*cls._struct_formatter.unpack_from(buffer, offset))
+
     def to_bytes(self):
         return bytes(self)
 
@@ -76,10 +84,12 @@ class NamedFieldSequence(object, metaclass=NamedFieldSequenceSerializerMeta):
                 setattr(self, slot, kwargs.get(slot, None))
 
     def __bytes__(self):
-        for slot in self.__slots__:
-            assert getattr(self, slot) is not None, 'slot %s has value None' % (slot)
-        return self._struct_formatter.pack(
-            *(getattr(self, slot) for slot in self.__slots__))
+        # a slot left as None fails in pack with struct.error
+        return self._struct_formatter.pack(*self.values())
+
+    def values(self):
+        """field values in slot order"""
+        return tuple(getattr(self, slot) for slot in self.__slots__)
 
     def __len__(self):
         return len(self.__slots__)
@@ -88,23 +98,23 @@ class NamedFieldSequence(object, metaclass=NamedFieldSequenceSerializerMeta):
     def iteritems(self):
         yield from ((s, getattr(self, s)) for s in self.__slots__)
     def __getitem__(self, key):
-        if key in self.__slots__:
+        if key in self._slot_indexes:
             return getattr(self, key)
         else:
             raise KeyError('key %s not found' % (key))
     def __setitem__(self, key, value):
-        if key in self.__slots__:
+        if key in self._slot_indexes:
             setattr(self, key, value)
         else:
             raise KeyError('key %s not found' % (key))
     def __delitem__(self, key):
-        if key in self.__slots__:
+        if key in self._slot_indexes:
             raise TypeError('%s has immutable keys' % (self.__class__.__name__))
         else:
             raise KeyError('key %s not found' % (key))
 
     def __contains__(self, key):
-        return key in self.__slots__
+        return key in self._slot_indexes
     
     def __repr__(self):
         rep = ('NamedFieldSequence(' + ', '
@@ -133,6 +143,12 @@ class ProtocolMessage(object):
         message = cls(message_type_spec)
         message.payload = message_type_spec.PayloadCls.from_bytes(payload_bytes)
         return message
+
+    @classmethod
+    def from_payload_buffer(cls, message_type_spec, buffer, offset=0):
+        message = cls(message_type_spec)
+        message.payload = message_type_spec.PayloadCls.from_buffer(buffer, offset)
+        return message
     @classmethod
     def get_header_class(cls):
         return cls._HeaderCls
@@ -148,9 +164,7 @@ class ProtocolMessage(object):
         return self._message_type_spec
 
     def __bytes__(self):
-        #print(f"before bytes[header: {self._message_type_spec.header}, payload: {self.payload}]")
-        #print(f'bytes[header : {bytes(self._message_type_spec.header)}{type(self._message_type_spec.header)}, Paylod {bytes(self.payload)}{type(self.payload)}], SUM: {bytes(self._message_type_spec.header) + bytes(self.payload)} ')
-        return bytes(self._message_type_spec.header) + bytes(self.payload)
+        return self._message_type_spec.encode_payload(self.payload)
 
     def __len__(self):
         return len(self.payload)
@@ -178,6 +192,48 @@ class ProtocolMessage(object):
     def __str__(self):
         return '{self.header!s}: {self.payload!s}'.format(self=self)
 
+class MessageRecord(object):
+    """
+    Compact stand-in for a ProtocolMessage: its type and a tuple of its payload values in
+    field order, with no payload object behind it. Reads like a message (message_type,
+    record[key], key in record, meta) and is only packed into bytes at the wire.
+    """
+    __slots__ = ('message_type', 'field_values', 'meta')
+
+    def __init__(self, message_type_spec, field_values, meta=None):
+        self.message_type = message_type_spec
+        self.field_values = field_values
+        self.meta = meta
+
+    def to_message(self):
+        """the full ProtocolMessage holding the same values"""
+        message = self.message_type(*self.field_values)
+        message.meta = self.meta
+        return message
+
+    def __bytes__(self):
+        return self.message_type.encode(*self.field_values)
+
+    def __len__(self):
+        return len(self.field_values)
+    def __iter__(self):
+        yield from iter(self.message_type.PayloadCls.__slots__)
+    def iteritems(self):
+        yield from zip(self.message_type.PayloadCls.__slots__, self.field_values)
+    def __getitem__(self, key):
+        index = self.message_type.field_indexes.get(key)
+        if index is None:
+            raise KeyError('key %s not found' % (key))
+        return self.field_values[index]
+    def __contains__(self, key):
+        return key in self.message_type.field_indexes
+
+    def __repr__(self):
+        return 'MessageRecord({}, {!r})'.format(self.message_type.name, self.field_values)
+
+    def __str__(self):
+        return str(self.to_message())
+
 class MessageTypeSpec(object):
     _MessageCls = None
 
@@ -191,6 +247,14 @@ class MessageTypeSpec(object):
         self._PayloadCls = type(
             name, (PayloadBaseCls,),
             {'__slots__': payload_fields})
+        # header and payload packed by one Struct, the header values being constant
+        self._message_struct = struct.Struct(
+            PayloadBaseCls._wire_format +
+            ''.join(HeaderCls._protocol_fields[field].type_spec for field in HeaderCls.__slots__) +
+            ''.join(PayloadBaseCls._protocol_fields[field].type_spec for field in payload_fields))
+        self._header_values = self._header.values()
+        self._payload_getter = attrgetter(*payload_fields) if len(payload_fields) > 1 else (
+            lambda payload, slot=payload_fields[0]: (getattr(payload, slot),))
 
     def __call__(self, *args, **kwargs):
         return self._MessageCls(self, *args, **kwargs)
@@ -204,6 +268,26 @@ class MessageTypeSpec(object):
                 raise ValueError('header mismatch!')
         return self._MessageCls.from_payload_bytes(self, message_bytes)
 
+    def from_buffer(self, buffer, offset=0):
+        """decode a message whose payload (header excluded) starts at offset of buffer"""
+        return self._MessageCls.from_payload_buffer(self, buffer, offset)
+
+    def encode(self, *payload_values):
+        """bytes of a message, header included, straight from its payload values in field
+        order, without building the message"""
+        return self._message_struct.pack(*self._header_values, *payload_values)
+
+    def encode_into(self, buffer, offset, *payload_values):
+        """like encode, but pack into buffer at offset"""
+        self._message_struct.pack_into(buffer, offset, *self._header_values, *payload_values)
+
+    def record(self, *payload_values, meta=None):
+        """a MessageRecord of this type from its payload values in field order"""
+        return MessageRecord(self, payload_values, meta)
+
+    def encode_payload(self, payload):
+        return self._message_struct.pack(*self._header_values, *self._payload_getter(payload))
+
     @classmethod
     def get_message_class(self):
         return self._MessageCls
@@ -222,6 +306,12 @@ class MessageTypeSpec(object):
     @property
     def payload_size(self):
         return self._PayloadCls.size
+    @property
+    def field_indexes(self):
+        return self._PayloadCls._slot_indexes
+    @property
+    def message_size(self):
+        return self._message_struct.size
         
     def __repr__(self):
         header_spec = ('[' + ', '.join(repr(self._header[key])
@@ -0,0 +1,49 @@
+import datetime
+import unittest
+from OuchServer.clock import MidnightClock, SimulatedClock, DEFAULT_TIMEZONE, NANOSECONDS_PER_DAY
+
+
+def wall_clock_nanoseconds(tz):
+    now = datetime.datetime.now(tz=tz)
+    return (((now.hour * 60 + now.minute) * 60 + now.second) * 10**6 + now.microsecond) * 10**3
+
+
+class TestMidnightClock(unittest.TestCase):
+
+    def assertCloseToWallClock(self, timestamp, tz):
+        difference = abs(timestamp - wall_clock_nanoseconds(tz))
+        # around midnight one of them may have wrapped already
+        self.assertLess(min(difference, NANOSECONDS_PER_DAY - difference), 50 * 10**6)
+
+    def test_matches_the_wall_clock(self):
+        for tz in (DEFAULT_TIMEZONE, datetime.timezone.utc, datetime.timezone(datetime.timedelta(hours=5, minutes=45))):
+            clock = MidnightClock(tz)
+            self.assertCloseToWallClock(clock(), tz)
+
+    def test_never_steps_back(self):
+        clock = MidnightClock()
+        timestamps = [clock() for _ in range(1000)]
+        if timestamps[0] <= timestamps[-1]:
+            self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_resyncs_on_schedule(self):
+        clock = MidnightClock()
+        anchor = clock.monotonic_anchor
+        clock.resync_at = anchor
+        self.assertCloseToWallClock(clock(), DEFAULT_TIMEZONE)
+        self.assertGreater(clock.monotonic_anchor, anchor)
+        self.assertGreater(clock.resync_at, clock.monotonic_anchor)
+
+
+class TestSimulatedClock(unittest.TestCase):
+
+    def test_moves_only_forward_when_set(self):
+        clock = SimulatedClock(100)
+        self.assertEqual(clock(), 100)
+        clock.set(250)
+        clock.set(200)
+        self.assertEqual(clock(), 250)
+
+
+if __name__ == '__main__':
+    unittest.main()
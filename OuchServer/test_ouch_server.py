@@ -0,0 +1,248 @@
+import asyncio
+import struct
+import unittest
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from OuchServer.ouch_server import ProtocolMessageServer, ClientConnection
+from OuchServer.client_send_queue import conflation_key
+
+
+def enter_order(token, price):
+    return OuchClientMessages.EnterOrder(
+        order_token = token, buy_sell_indicator = b'B', shares = 5, stock = b'AMAZGOOG',
+        price = price, time_in_force = 99999, firm = b'FIRM', display = b'Y', capacity = b'P',
+        intermarket_sweep_eligibility = b'N', minimum_quantity = 1, cross_type = b'N',
+        customer_type = b' ', midpoint_peg = False)
+
+
+class TestDecodeMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ProtocolMessageServer(OuchClientMessages)
+
+    def test_splits_back_to_back_messages(self):
+        cancel = OuchClientMessages.CancelOrder(order_token = b'a', shares = 0)
+        stream = bytearray(bytes(enter_order(b'a', 10)) + bytes(cancel) + bytes(enter_order(b'b', 11)))
+        # cut the last message short
+        stream = stream[:-3]
+        (messages, consumed, failed) = self.server.decode_messages(stream, meta = 4)
+        self.assertFalse(failed)
+        self.assertEqual([m.message_type for m in messages], [OuchClientMessages.EnterOrder, OuchClientMessages.CancelOrder])
+        self.assertEqual(consumed, len(bytes(enter_order(b'a', 10))) + len(bytes(cancel)))
+        self.assertEqual(messages[0]['price'], 10)
+        self.assertEqual(messages[0]['order_token'], b'a'.ljust(32, b'\x00'))
+        self.assertEqual([m.meta for m in messages], [4, 4])
+
+        # the rest of the partial message arrives with the next read
+        stream += bytes(enter_order(b'b', 11))[-3:]
+        (messages, position, failed) = self.server.decode_messages(stream, start = consumed)
+        self.assertEqual(position, len(stream))
+        self.assertEqual(messages[0]['price'], 11)
+
+    def test_unknown_header(self):
+        stream = bytes(enter_order(b'a', 10)) + b'?' + bytes(50)
+        (messages, position, failed) = self.server.decode_messages(stream)
+        self.assertTrue(failed)
+        self.assertEqual([m['order_token'] for m in messages], [b'a'.ljust(32, b'\x00')])
+        self.assertEqual(position, len(bytes(enter_order(b'a', 10))))
+
+
+class TestConnection(unittest.TestCase):
+
+    def test_messages_read_over_a_socket(self):
+        server = ProtocolMessageServer(OuchClientMessages, host = '127.0.0.1', port = 0)
+        received = []
+
+        async def listener(m):
+            received.append(m)
+        server.register_listener(listener)
+        orders = [bytes(enter_order(str(i).encode(), i)) for i in range(3000)]
+
+        async def run():
+            await server.start()
+            port = server.server.sockets[0].getsockname()[1]
+            (reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+            # more than the read buffer holds, with messages cut across writes
+            stream = b''.join(orders)
+            for i in range(0, len(stream), 1000):
+                writer.write(stream[i:i + 1000])
+                await writer.drain()
+            # an unknown header ends the connection, after the messages before it
+            writer.write(orders[0] + b'?' + bytes(50))
+            closed = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            server.server.close()
+            await server.server.wait_closed()
+            return closed
+        self.assertEqual(asyncio.run(run()), b'')
+        self.assertEqual([bytes(m) for m in received], orders + orders[:1])
+        self.assertEqual(server.clients, {})
+
+
+class TestEncoders(unittest.TestCase):
+
+    def test_encode_matches_header_and_payload(self):
+        executed = OuchServerMessages.Executed(timestamp = 1, order_token = b'a', executed_shares = 2,
+            execution_price = 10, liquidity_flag = b'?', match_number = 3, midpoint_peg = False)
+        expected = bytes(executed.header) + bytes(executed.payload)
+        self.assertEqual(bytes(executed), expected)
+        self.assertEqual(OuchServerMessages.Executed.encode(1, b'a', 2, 10, b'?', 3, False), expected)
+        self.assertEqual(OuchServerMessages.Executed.message_size, len(expected))
+        buffer = bytearray(len(expected) + 2)
+        OuchServerMessages.Executed.encode_into(buffer, 2, 1, b'a', 2, 10, b'?', 3, False)
+        self.assertEqual(bytes(buffer[2:]), expected)
+        # single field payloads
+        trade_now = OuchClientMessages.TradeNow(order_token = b'a')
+        self.assertEqual(bytes(trade_now), b'N' + b'a'.ljust(32, b'\x00'))
+        self.assertEqual(OuchClientMessages.TradeNow.from_bytes(bytes(trade_now))['order_token'], b'a'.ljust(32, b'\x00'))
+
+    def test_record_reads_and_packs_like_the_message(self):
+        values = (1, b'AMAZGOOG', 10, 5, 11, 6, 9, 12)
+        message = OuchServerMessages.BestBidAndOffer(*values)
+        record = OuchServerMessages.BestBidAndOffer.record(*values, meta = 3)
+        self.assertEqual(bytes(record), bytes(message))
+        self.assertEqual(record['volume_at_best_ask'], 6)
+        self.assertIn('stock', record)
+        self.assertNotIn('order_token', record)
+        with self.assertRaises(KeyError):
+            record['order_token']
+        self.assertEqual(dict(record.iteritems()), dict(message.iteritems()))
+        self.assertEqual(conflation_key(record), conflation_key(message))
+        full = record.to_message()
+        self.assertEqual((full.message_type, full.meta, bytes(full)), (OuchServerMessages.BestBidAndOffer, 3, bytes(message)))
+
+    def test_unset_field(self):
+        with self.assertRaises(struct.error):
+            bytes(OuchServerMessages.SystemEvent(timestamp = 1))
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+        # set to a future to keep drain() from returning, like a client that stopped reading
+        self.blocked = None
+
+    def writelines(self, chunks):
+        self.writes.append(b''.join(chunks))
+
+    async def drain(self):
+        if self.blocked is not None:
+            await self.blocked
+
+    def close(self):
+        self.closed = True
+
+
+class TestClientSendQueues(unittest.TestCase):
+
+    def connect(self, server, writer):
+        server._accept_client(ClientConnection(server), writer)
+        return max(server.clients)
+
+    def test_one_write_per_client_per_iteration(self):
+        server = ProtocolMessageServer(OuchClientMessages)
+        event = OuchServerMessages.SystemEvent(timestamp = 1, event_code = b'S')
+        quote = OuchServerMessages.PegStateUpdate(timestamp = 1, peg_state = 0, peg_price = 10)
+
+        async def run():
+            writers = [RecordingWriter(), RecordingWriter()]
+            tokens = [self.connect(server, writer) for writer in writers]
+            event.meta = tokens[1]
+            await server.broadcast_server_message(quote)
+            await server.send_server_response(event)
+            await server.broadcast_server_message(quote)
+            self.assertEqual(writers[0].writes, [])
+            await asyncio.sleep(0)
+            await server.broadcast_server_message(quote)
+            await asyncio.sleep(0)
+            return writers
+        writers = asyncio.run(run())
+
+        self.assertEqual(writers[0].writes, [bytes(quote) * 2, bytes(quote)])
+        self.assertEqual(writers[1].writes, [bytes(quote) + bytes(event) + bytes(quote), bytes(quote)])
+
+    def run_slow_client(self, overflow_policy, sequence):
+        """Send sequence (indexes in [executed, quote 0, quote 1, quote 2]) to a slow and a fast client,
+        the slow one's queue bounded to 2 messages. Returns the slow client's writer, what is left queued
+        for it (None if it was disconnected) and the messages"""
+        server = ProtocolMessageServer(OuchClientMessages, send_queue_messages = 2, overflow_policy = overflow_policy)
+        executed = OuchServerMessages.Executed(timestamp = 1, order_token = b'a', executed_shares = 1,
+            execution_price = 10, liquidity_flag = b'?', match_number = 0, midpoint_peg = False)
+        quotes = [OuchServerMessages.BestBidAndOffer(timestamp = 1, stock = b'AMAZGOOG', best_bid = bid,
+            volume_at_best_bid = 1, best_ask = 20, volume_at_best_ask = 1, next_bid = 0, next_ask = 30)
+            for bid in (10, 11, 12)]
+        messages = [executed] + quotes
+
+        async def run():
+            slow, fast = RecordingWriter(), RecordingWriter()
+            slow.blocked = asyncio.get_running_loop().create_future()
+            slow_token = self.connect(server, slow)
+            self.connect(server, fast)
+            await server.broadcast_server_message(executed)
+            await asyncio.sleep(0)
+            # the slow client's writer is stuck in drain from here on
+            for i in sequence:
+                await server.broadcast_server_message(messages[i])
+                await asyncio.sleep(0)
+                if slow_token in server.clients:
+                    self.assertLessEqual(len(server.clients[slow_token].send_queue), 2)
+            queued = server.clients[slow_token].send_queue.take() if slow_token in server.clients else None
+            if not slow.blocked.done():
+                slow.blocked.set_result(None)
+            return slow, fast, queued
+        (slow, fast, queued) = asyncio.run(run())
+        # the fast client is not held back
+        self.assertEqual(len(fast.writes), len(sequence) + 1)
+        return slow, queued, [bytes(m) for m in messages]
+
+    def test_drop_market_data(self):
+        (slow, queued, (executed, q0, q1, q2)) = self.run_slow_client('drop', [0, 1, 2, 3])
+        self.assertEqual(queued, [executed, q0])
+
+    def test_conflate_market_data(self):
+        (slow, queued, (executed, q0, q1, q2)) = self.run_slow_client('conflate', [1, 0, 2, 3])
+        # the latest quote goes after the execution queued before it
+        self.assertEqual(queued, [executed, q2])
+
+    def test_order_message_overflow_disconnects(self):
+        for overflow_policy in ('drop', 'conflate'):
+            (slow, queued, _) = self.run_slow_client(overflow_policy, [0, 1, 0])
+            self.assertTrue(slow.closed)
+            self.assertIsNone(queued)
+
+    def test_queued_messages_are_sent_after_the_client_leaves(self):
+        server = ProtocolMessageServer(OuchClientMessages)
+        event = OuchServerMessages.SystemEvent(timestamp = 1, event_code = b'S')
+
+        async def run():
+            writer = RecordingWriter()
+            writer.blocked = asyncio.get_running_loop().create_future()
+            connection = ClientConnection(server)
+            server._accept_client(connection, writer)
+            token = max(server.clients)
+            await server.broadcast_server_message(event)
+            await asyncio.sleep(0)
+            # stuck writing the first message when the client's end of the stream comes
+            await server.broadcast_server_message(event)
+            connection.eof = True
+            connection.readable.set()
+            # the reader task ends, then its done callback runs
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertNotIn(token, server.clients)
+            self.assertFalse(writer.closed)
+            writer.blocked.set_result(None)
+            await asyncio.sleep(0.01)
+            return writer
+        writer = asyncio.run(run())
+        self.assertEqual(writer.writes, [bytes(event), bytes(event)])
+        self.assertTrue(writer.closed)
+
+    def test_disconnect(self):
+        (slow, queued, _) = self.run_slow_client('disconnect', [0, 1, 2])
+        self.assertTrue(slow.closed)
+        self.assertIsNone(queued)
+
+
+if __name__ == '__main__':
+    unittest.main()
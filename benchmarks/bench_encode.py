@@ -0,0 +1,35 @@
+"""Serialization cost of the high volume server messages.
+
+Run from the repository root:
+    python -m benchmarks.bench_encode
+"""
+import time
+from OuchServer.ouch_messages import OuchServerMessages
+
+ROUNDS = 200000
+
+EXECUTED = (1, b'a', 2, 10, b'?', 3, False)
+BBO = (1, b'AMAZGOOG', 10, 5, 11, 5, 9, 12)
+
+def per_message(encode):
+    """Microseconds per call of encode()"""
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        encode()
+    return (time.perf_counter() - start) / ROUNDS * 10**6
+
+def main():
+    for (message_type, values) in ((OuchServerMessages.Executed, EXECUTED), (OuchServerMessages.BestBidAndOffer, BBO)):
+        message = message_type(*values)
+        timings = [
+            ('header + payload', per_message(lambda: bytes(message.header) + bytes(message.payload))),
+            ('bytes(message)', per_message(lambda: bytes(message))),
+            ('build + bytes', per_message(lambda: bytes(message_type(*values)))),
+            ('spec.encode', per_message(lambda: message_type.encode(*values))),
+        ]
+        print(message_type.name)
+        for (name, t) in timings:
+            print('  {:<18} {:>8.3f}us'.format(name, t))
+
+if __name__ == '__main__':
+    main()
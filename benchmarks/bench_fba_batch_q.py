@@ -0,0 +1,48 @@
+"""Entry throughput of the FBA price level queues, with every order of a level entered in the same batch.
+
+Run from the repository root:
+    python -m benchmarks.bench_fba_batch_q
+"""
+import random
+import time
+from exchange.order_books.fba_book_price_q import FBA_PRICE_QUEUES
+
+DEPTHS = (1000, 10000, 100000)
+
+def entry_rate(queue_cls, depth):
+    """Enter `depth` orders in one batch on a level holding `depth` orders of the last one, then close
+    the batch. Returns orders entered per second."""
+    queue = queue_cls(100)
+    rng = random.Random(1)
+    for order_id in range(depth):
+        queue.add_order(order_id, 1, 1, rng)
+    queue.close_batch(rng)
+    start = time.perf_counter()
+    for order_id in range(depth, 2 * depth):
+        queue.add_order(order_id, 1, 2, rng)
+    queue.close_batch(rng)
+    return depth / (time.perf_counter() - start)
+
+def batch_rate(queue_cls, depth):
+    """Enter `depth` orders in one batch, cancel a tenth of them and fill the rest. Returns orders per second."""
+    queue = queue_cls(100)
+    rng = random.Random(2)
+    start = time.perf_counter()
+    for order_id in range(depth):
+        queue.add_order(order_id, 1, 1, rng)
+    for order_id in range(0, depth, 10):
+        queue.cancel_order(order_id, 1)
+    queue.close_batch(rng)
+    while queue.interest > 0:
+        queue.fill_order(rng.randint(1, 3))
+    return depth / (time.perf_counter() - start)
+
+def main():
+    print('{:>8} {:>8} '.format('depth', 'op') + ' '.join('{:>14}'.format(name) for name in FBA_PRICE_QUEUES))
+    for depth in DEPTHS:
+        for (op, rate) in (('enter', entry_rate), ('batch', batch_rate)):
+            rates = [rate(queue_cls, depth) for queue_cls in FBA_PRICE_QUEUES.values()]
+            print('{:>8} {:>8} '.format(depth, op) + ' '.join('{:>12.0f}/s'.format(r) for r in rates))
+
+if __name__ == '__main__':
+    main()
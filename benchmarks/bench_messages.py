@@ -0,0 +1,67 @@
+"""Cost of building the server messages of one accepted and filled order, as full
+messages copied field by field (the former Exchange code) and as MessageRecords.
+
+Run from the repository root:
+    python -m benchmarks.bench_messages
+"""
+import time
+import tracemalloc
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+
+ROUNDS = 100000
+
+ENTER = OuchClientMessages.EnterOrder(
+    order_token = b'a'.ljust(32), buy_sell_indicator = b'B', shares = 5, stock = b'AMAZGOOG',
+    price = 10, time_in_force = 99999, firm = b'FIRM', display = b'Y', capacity = b'P',
+    intermarket_sweep_eligibility = b'N', minimum_quantity = 1, cross_type = b'N',
+    customer_type = b' ', midpoint_peg = False)
+ENTER.meta = None
+
+def as_messages(enter):
+    m = OuchServerMessages.Accepted(
+        timestamp=1, order_reference_number=1, order_state=b'L', bbo_weight_indicator=b' ',
+        order_token=enter['order_token'], buy_sell_indicator=enter['buy_sell_indicator'],
+        shares=enter['shares'], stock=enter['stock'], price=enter['price'],
+        time_in_force=enter['time_in_force'], firm=enter['firm'], display=enter['display'],
+        capacity=enter['capacity'], intermarket_sweep_eligibility=enter['intermarket_sweep_eligibility'],
+        minimum_quantity=enter['minimum_quantity'], cross_type=enter['cross_type'],
+        midpoint_peg=enter['midpoint_peg'])
+    m.meta = enter.meta
+    fills = []
+    for _ in range(2):
+        r = OuchServerMessages.Executed(timestamp = 1, order_token = enter['order_token'], executed_shares = 5,
+            execution_price = 10, liquidity_flag = b'?', match_number = 0, midpoint_peg = enter['midpoint_peg'])
+        r.meta = enter.meta
+        fills.append(r)
+    return m, fills
+
+def as_records(enter):
+    order = enter.payload
+    m = OuchServerMessages.Accepted.record(
+        1, order.order_token, order.buy_sell_indicator, order.shares, order.stock, order.price,
+        order.time_in_force, order.firm, order.display, 1, order.capacity,
+        order.intermarket_sweep_eligibility, order.minimum_quantity, order.cross_type, b'L', b' ',
+        order.midpoint_peg, meta = enter.meta)
+    fills = [OuchServerMessages.Executed.record(1, order.order_token, 5, 10, b'?', 0, order.midpoint_peg,
+                meta = enter.meta) for _ in range(2)]
+    return m, fills
+
+def per_order(build):
+    """(microseconds, bytes allocated) per order"""
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        build(ENTER)
+    elapsed = (time.perf_counter() - start) / ROUNDS * 10**6
+    tracemalloc.start()
+    kept = [build(ENTER) for _ in range(1000)]
+    allocated = tracemalloc.get_traced_memory()[0] / len(kept)
+    tracemalloc.stop()
+    return elapsed, allocated
+
+def main():
+    for (name, build) in (('messages', as_messages), ('records', as_records)):
+        (elapsed, allocated) = per_order(build)
+        print('{:<10} {:>8.2f}us {:>8.0f} bytes/order'.format(name, elapsed, allocated))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Insert cost of a new price level against book depth for each price ladder backend.
+
+Run from the repository root:
+    python -m benchmarks.bench_price_ladder
+"""
+import random
+import time
+from functools import partial
+from exchange.order_books.book_price_q import BookPriceQ
+from exchange.order_books.list_elements import PRICE_LADDERS, TickIndexedLadder
+
+DEPTHS = (100, 1000, 5000, 20000)
+INSERTS = 500
+
+def time_inserts(ladder_cls, depth, inserts = INSERTS, seed = 0):
+    """Fill a ladder with `depth` levels, then time `inserts` new levels at random prices.
+    Returns microseconds per insert."""
+    rng = random.Random(seed)
+    prices = rng.sample(range(1, 4 * (depth + inserts)), depth + inserts)
+    ladder = ladder_cls(index_func = lambda bq: bq.price,
+                        initializer = lambda p: BookPriceQ(p),
+                        index_multiplier = -1)
+    for price in prices[:depth]:
+        ladder[price]
+    start = time.perf_counter()
+    for price in prices[depth:]:
+        ladder[price]
+    return (time.perf_counter() - start) / inserts * 10**6
+
+def ladders_for(depth):
+    ladders = dict(PRICE_LADDERS)
+    # dense ladder over the whole band the random prices are drawn from
+    ladders['tick'] = partial(TickIndexedLadder, min_price = 0, max_price = 4 * (depth + INSERTS))
+    return ladders
+
+def main():
+    print('{:>8} '.format('depth') + ' '.join('{:>12}'.format(name) for name in ladders_for(0)))
+    for depth in DEPTHS:
+        timings = [time_inserts(ladder_cls, depth) for ladder_cls in ladders_for(depth).values()]
+        print('{:>8} '.format(depth) + ' '.join('{:>10.2f}us'.format(t) for t in timings))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Fill and cancel throughput of the price level queues on deep levels.
+
+Run from the repository root:
+    python -m benchmarks.bench_price_q
+"""
+import random
+import time
+import tracemalloc
+from exchange.order_books.array_price_q import PRICE_QUEUES
+
+DEPTHS = (10000, 50000, 200000)
+
+def fill_rate(queue_cls, depth):
+    """Fill a level of `depth` one-share orders with takers of 1-3 shares. Returns orders filled per second."""
+    queue = queue_cls(100)
+    for order_id in range(depth):
+        queue.add_order(order_id, 1)
+    rng = random.Random(1)
+    start = time.perf_counter()
+    while queue.interest > 0:
+        queue.fill_order(rng.randint(1, 3))
+    return depth / (time.perf_counter() - start)
+
+def cancel_rate(queue_cls, depth):
+    """Cancel every order of a level of `depth` orders in random order. Returns cancels per second."""
+    queue = queue_cls(100)
+    for order_id in range(depth):
+        queue.add_order(order_id, 1)
+    order_ids = list(range(depth))
+    random.Random(2).shuffle(order_ids)
+    start = time.perf_counter()
+    for order_id in order_ids:
+        queue.cancel_order(order_id)
+    return depth / (time.perf_counter() - start)
+
+def level_memory(queue_cls, depth):
+    """Bytes allocated per resting order by a level of `depth` orders."""
+    tracemalloc.start()
+    queue = queue_cls(100)
+    for order_id in range(depth):
+        queue.add_order(order_id, 1)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / depth
+
+def main():
+    print('{:>8} {:>8} '.format('depth', 'op') + ' '.join('{:>14}'.format(name) for name in PRICE_QUEUES))
+    for depth in DEPTHS:
+        for (op, rate) in (('fill', fill_rate), ('cancel', cancel_rate)):
+            rates = [rate(queue_cls, depth) for queue_cls in PRICE_QUEUES.values()]
+            print('{:>8} {:>8} '.format(depth, op) + ' '.join('{:>12.0f}/s'.format(r) for r in rates))
+        sizes = [level_memory(queue_cls, depth) for queue_cls in PRICE_QUEUES.values()]
+        print('{:>8} {:>8} '.format(depth, 'memory') + ' '.join('{:>10.1f}B/o'.format(b) for b in sizes))
+
+if __name__ == '__main__':
+    main()
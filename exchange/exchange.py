@@ -9,21 +9,60 @@ import asyncio
 import asyncio.streams
 import logging as log
 import itertools
-from functools import partial
 from collections import deque
 
 from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
-from OuchServer.ouch_server import nanoseconds_since_midnight
+from OuchServer.ouch_server import default_clock
+from OuchServer.clock import NANOSECONDS_PER_DAY
 
-from exchange.order_store import OrderStore
+from exchange.order_books.cda_book import CDABook
+from exchange.order_store import OrderStore, OrderStoreEntry, RECENT_TOKENS
+from exchange.expiry_wheel import ExpiryWheel
+from exchange.recovery import WriteAheadLog
 
-from exchange_logging.exchange_loggers import BookLogger, TransactionLogger, ClientActionLogger, PLACE_LIMIT_ORDER_ACTION, CANCEL_LIMIT_ORDER_ACTION
+from exchange_logging.exchange_loggers import BookLogger, BookDeltaLogger, TransactionLogger, ClientActionLogger, LogWriter, PLACE_LIMIT_ORDER_ACTION, CANCEL_LIMIT_ORDER_ACTION
+from exchange_logging.event_journal import encode_message
+
+# Symbol carried by BBO/PostBatch messages of a single book exchange
+DEFAULT_STOCK = b'AMAZGOOG'
 
 class Exchange:
-    def __init__(self, order_book, order_reply, loop, message_broadcast = None, book_log='book_log.txt', transaction_log='transaction_log.txt', action_log='action_log.txt'):
+    def __init__(self, order_book, order_reply, loop, message_broadcast = None, book_log='book_log.txt', transaction_log='transaction_log.txt', action_log='action_log.txt',
+                 book_factory = None, stock = DEFAULT_STOCK, bbo_conflation = None,
+                 log_buffer_records = 65536, log_overflow_policy = 'block',
+                 book_log_mode = 'snapshot', book_snapshot_every = 1000, book_snapshot_interval = None,
+                 log_format = 'json', journal_log = 'journal.bin', order_history_log = None,
+                 wal_dir = None, state_snapshot_interval = 60, wal_wait_commit = True, clock = None,
+                 order_retired = None, recent_tokens = RECENT_TOKENS):
         """
         order_store: tracks orders submitted to the exchange and their status(expiration)
         order_book: Limit Order book that self updates and matches buy and sell orders
+        book_factory: if given, the exchange is multi-symbol: order_book is ignored and every stock
+            gets its own book, created by calling book_factory() the first time an order names it
+        stock: symbol of order_book in single book mode
+        bbo_conflation: if given, BestBidAndOffer updates are held and only the latest of each
+            stock is broadcast, every bbo_conflation seconds (0: once per event loop tick).
+            Other broadcast messages are never held back.
+        log_buffer_records, log_overflow_policy: bound of the buffer of the thread writing the market
+            logs, and what a full buffer does (see exchange_loggers.LOG_OVERFLOW_POLICIES)
+        book_log_mode: 'snapshot' logs the full changed books after every message, 'delta' only their
+            changed price levels, with a full snapshot every book_snapshot_every entries or
+            book_snapshot_interval seconds (see exchange_loggers.BookDeltaLogger)
+        log_format: 'json' writes the book, transaction and action logs as JSON lines, 'journal' writes
+            all three as one binary journal_log (see exchange_logging.event_journal)
+        order_history_log: if given, every message of every order (its EnterOrder or ReplaceOrder, then
+            its responses) is written to this binary journal, since the order store forgets an order's
+            messages and then the order itself once it is done with
+        wal_dir: if given, every message handled is first written to a write-ahead log in this directory,
+            and the books and order store are snapshot there every state_snapshot_interval seconds. An
+            exchange started on a wal_dir left by a previous one recovers its state (see exchange.recovery).
+            Only a continuous double auction (this class, on CDABooks) can recover, ValueError otherwise
+        wal_wait_commit: hold the responses to messages until the write-ahead log has them on disk
+        clock: callable giving the timestamps of messages and logs, in nanoseconds since midnight (default:
+            the server's MidnightClock, see OuchServer.clock)
+        order_retired: if given, called with the token of every order the order store forgets (see retire_order)
+        recent_tokens: number of retired order tokens an order can not reuse (rejected as a RepeatID, see OrderStore)
+        order_books: dict of stock -> order book
         order_reply: post office reply function, takes in 
                 message 
                 original order
@@ -33,8 +72,22 @@ class Exchange:
         outgoing_broadcast_messages: 
         handlers: A dict of methods to handle corresponding client message
         """
-        self.order_store = OrderStore()
-        self.order_book = order_book
+        self.order_store = OrderStore(recent_tokens = recent_tokens)
+        self.clock = default_clock if clock is None else clock
+        self.order_retired = order_retired
+        self.book_factory = book_factory
+        self.stock = stock
+        if book_factory is None:
+            self.order_book = order_book
+            self.order_books = {stock: order_book}
+        else:
+            self.order_book = None
+            self.order_books = {}
+        # symbols whose book changed since the book log was last written
+        self.touched_stocks = set()
+        # stock -> set of (buy_sell_indicator, price) levels changed since the book delta log was
+        # last written, or None if the whole book may have changed
+        self.touched_levels = {}
         self.order_reply = order_reply
         self.message_broadcast = message_broadcast
         self.next_match_number = 0
@@ -42,6 +95,13 @@ class Exchange:
         self.outgoing_messages = deque()
         self.order_ref_numbers = itertools.count(1, 2)  # odds    
         self.outgoing_broadcast_messages = deque() 
+        self.bbo_conflation = bbo_conflation
+        # stock -> latest BestBidAndOffer not broadcast yet
+        self.conflated_bbos = {}
+        self.bbo_flush_handle = None
+        # time in force expiries, swept once per tick while any are pending
+        self.expiries = ExpiryWheel(loop.time())
+        self.expiry_handle = None
         self.handlers = { 
             OuchClientMessages.EnterOrder: self.enter_order_atomic,
             OuchClientMessages.ReplaceOrder: self.replace_order_atomic,
@@ -49,27 +109,121 @@ class Exchange:
             OuchClientMessages.SystemStart: self.system_start_atomic,
             OuchClientMessages.ModifyOrder: None}
 
+        # the logs are serialized and written by a background thread, off the matching path
+        self.log_writer = LogWriter(max_records = log_buffer_records, overflow_policy = log_overflow_policy)
+        journal = None
+        if log_format == 'journal':
+            journal = self.log_writer.open(f"exchange/market_logs/{journal_log}", binary = True)
+
         # BOOK HISTORY LOG
         self.book_log_file = book_log
-        self.book_logger = BookLogger(log_filepath=f"exchange/market_logs/{book_log}", logger_name="book_logger")
+        self.book_log_mode = book_log_mode
+        if book_log_mode == 'delta':
+            self.book_logger = BookDeltaLogger(log_filepath=f"exchange/market_logs/{book_log}", logger_name="book_logger", writer=self.log_writer,
+                snapshot_every=book_snapshot_every, snapshot_interval=book_snapshot_interval, journal=journal)
+        else:
+            self.book_logger = BookLogger(log_filepath=f"exchange/market_logs/{book_log}", logger_name="book_logger", writer=self.log_writer, journal=journal)
 
         # TRANSACTION HISTORY LOG
         self.transaction_log_file = transaction_log
-        self.transaction_logger = TransactionLogger(log_filepath=f"exchange/market_logs/{transaction_log}", logger_name="transaction_logger")
+        self.transaction_logger = TransactionLogger(log_filepath=f"exchange/market_logs/{transaction_log}", logger_name="transaction_logger", writer=self.log_writer, journal=journal)
     
         # CLIENT ACTION HISTORY LOG
         self.action_log_file = action_log
-        self.action_logger = ClientActionLogger(f"exchange/market_logs/{action_log}", logger_name="action_logger")
+        self.action_logger = ClientActionLogger(f"exchange/market_logs/{action_log}", logger_name="action_logger", writer=self.log_writer, journal=journal)
 
+        # ORDER HISTORY LOG
+        if order_history_log is not None:
+            history_file = self.log_writer.open(f"exchange/market_logs/{order_history_log}", binary = True)
+            self.order_store.history = lambda record_type, timestamp, message: self.log_writer.put_record(
+                history_file, encode_message, (timestamp, record_type, message))
+
+        # WRITE-AHEAD LOG
+        self.wal = None
+        if wal_dir is not None:
+            book_class = type(order_book) if book_factory is None else getattr(book_factory, 'func', book_factory)
+            if type(self) is not Exchange or not (isinstance(book_class, type) and issubclass(book_class, CDABook)):
+                raise ValueError('wal_dir is only supported by an Exchange of CDABooks, not %s of %s'
+                                 % (type(self).__name__, getattr(book_class, '__name__', book_class)))
+            wal = WriteAheadLog(wal_dir, loop, snapshot_interval = state_snapshot_interval, wait_commit = wal_wait_commit)
+            if wal.recover(self):
+                # the clients of the previous exchange are gone, only the book log keeps the recovered books
+                self.outgoing_messages.clear()
+                self.outgoing_broadcast_messages.clear()
+                self.log_books()
+            self.wal = wal
+            wal.start(self)
+
+    def close(self):
+        """Stop the exchange's timers, write what its market logs and write-ahead log still buffer and
+        close them; the log threads stop. Messages handled afterwards are not logged.
+        """
+        for handle in (self.expiry_handle, self.bbo_flush_handle):
+            if handle is not None:
+                handle.cancel()
+        self.expiry_handle = self.bbo_flush_handle = None
+        if self.wal is not None:
+            self.wal.close()
+        self.log_writer.close()
 
     def system_start_atomic(self, system_event_message, timestamp):
         """Clear past data of exchange to simulate the creation of a new exchange"""  
         self.order_store.clear_order_store()
-        self.order_book.reset_book()
+        self.expiries.clear()
+        for stock in self.order_books:
+            self.touch_book(stock)
+        if self.book_factory is None:
+            self.order_book.reset_book()
+        else:
+            self.order_books.clear()
+        self.touched_stocks.clear()
+        self.conflated_bbos.clear()
         m = OuchServerMessages.SystemEvent(event_code=b'S', timestamp=timestamp)
         m.meta = system_event_message.meta
         self.outgoing_messages.append(m)
 
+    def book_for(self, stock):
+        """Find the order book trading a stock, creating it in multi-symbol mode
+        Args:
+            stock: The stock field of an EnterOrder message
+        Returns:
+            A tuple (symbol, order book); in single book mode this is always (self.stock, self.order_book)
+        """
+        if self.book_factory is None:
+            symbol, book = self.stock, self.order_book
+        else:
+            symbol, book = stock, self.order_books.get(stock)
+            if book is None:
+                log.info('Opening order book for %s', stock)
+                book = self.order_books[stock] = self.book_factory()
+        self.touched_stocks.add(symbol)
+        return symbol, book
+
+    def touch_levels(self, stock, buy_sell_indicator, price, crossed_orders = ()):
+        """Note the price levels an order changed, for the book delta log: the level at price on its
+        own side, and the levels of the other side it crossed
+        """
+        if stock in self.touched_levels:
+            levels = self.touched_levels[stock]
+            if levels is None:
+                return
+        else:
+            levels = self.touched_levels[stock] = set()
+        levels.add((buy_sell_indicator, price))
+        other_side = b'S' if buy_sell_indicator == b'B' else b'B'
+        for (_, cross_price, _) in crossed_orders:
+            levels.add((other_side, cross_price))
+
+    def touch_book(self, stock):
+        """Note that any level of a book may have changed, the book delta log then snapshots it"""
+        self.touched_levels[stock] = None
+
+    def book_for_order(self, store_entry):
+        """Find the order book holding an order already in the order store. Cancel and replace
+        messages carry no stock, the order's original EnterOrder names it.
+        """
+        return self.book_for(store_entry.stock)
+
     def accepted_from_enter(self, enter_order_message, timestamp, order_reference_number, order_state=b'L', bbo_weight_indicator=b' '):
         """Create Accept server response from a buy/sell order message
         
@@ -79,26 +233,32 @@ class Exchange:
             order_reference_number: A int for the order number in context of the entire exchange
             order_state: A byte string representing whether the order is Limit order(b'L')
         Returns:
-            OuchServerMessages.Accepted message containing information about the clients' order and Exchange internal information
+            OuchServerMessages.Accepted record containing information about the clients' order and Exchange internal information
+        """
+        order = enter_order_message.payload
+        return OuchServerMessages.Accepted.record(
+            timestamp, order.order_token, order.buy_sell_indicator, order.shares, order.stock,
+            order.price, order.time_in_force, order.firm, order.display, order_reference_number,
+            order.capacity, order.intermarket_sweep_eligibility, order.minimum_quantity,
+            order.cross_type, order_state, bbo_weight_indicator, order.midpoint_peg,
+            meta = enter_order_message.meta)
+
+    def rejected_from_enter(self, enter_order_message, timestamp, reason):
+        """Create Rejected server response for a buy/sell order message that can not be entered
+        Args:
+            enter_order_message: OuchClientMessage representing a buy/sell order
+            timestamp: Time(in seconds) the client's order was rejected
+            reason: A byte string (up to 8 characters) explaining the rejection
+        Returns:
+            OuchServerMessages.Rejected
         """
-        m = OuchServerMessages.Accepted(
-            timestamp=timestamp,
-            order_reference_number=order_reference_number, 
-            order_state=order_state,
-            bbo_weight_indicator=bbo_weight_indicator,
-            order_token=enter_order_message['order_token'],
-            buy_sell_indicator=enter_order_message['buy_sell_indicator'],
-            shares=enter_order_message['shares'],
-            stock=enter_order_message['stock'],
-            price=enter_order_message['price'],
-            time_in_force=enter_order_message['time_in_force'],
-            firm=enter_order_message['firm'],
-            display=enter_order_message['display'],
-            capacity=enter_order_message['capacity'],
-            intermarket_sweep_eligibility=enter_order_message['intermarket_sweep_eligibility'],
-            minimum_quantity=enter_order_message['minimum_quantity'],
-            cross_type=enter_order_message['cross_type'],
-            midpoint_peg=enter_order_message['midpoint_peg'])
+        m = OuchServerMessages.Rejected(
+                timestamp = timestamp,
+                order_token = enter_order_message['order_token'],
+                reason = reason,
+                price = enter_order_message['price'],
+                shares = enter_order_message['shares']
+            )
         m.meta = enter_order_message.meta
         return m
 
@@ -126,35 +286,25 @@ class Exchange:
         m.meta = replace_order_message.meta
         return m
     
-    def order_cancelled_from_cancel(self, original_enter_message, timestamp, amount_canceled, reason=b'U',order_token = None):
+    def order_cancelled_from_cancel(self, store_entry, timestamp, amount_canceled, reason=b'U',order_token = None):
         """Create CancelOrder when Clients' request to cancel an order
         Args:
-            original_enter_message: OuchClientMessage representing the buy/sell order the client wants to cancel
+            store_entry: OrderStoreEntry of the order the client wants to cancel
             timestamp: Time(in seconds) of when the order was canceled
             amount_canceled: The amount of shares to remain
             order_token: The unique token representing the clients' order
         Returns:
             OuchCLientMessages.Cancel 
         """
-        order_token = original_enter_message['order_token'] if order_token is None else order_token
-        m = OuchServerMessages.Canceled(timestamp = timestamp,
-                            order_token = order_token,
-                            decrement_shares = amount_canceled,
-                            reason = reason,
-                            midpoint_peg = original_enter_message['midpoint_peg'],
-                            price = original_enter_message['price'],
-                            buy_sell_indicator = original_enter_message['buy_sell_indicator'])
-        m.meta = original_enter_message.meta
-        return m
+        return OuchServerMessages.Canceled.record(
+            timestamp, order_token, amount_canceled, reason, store_entry.midpoint_peg, store_entry.price,
+            store_entry.buy_sell_indicator, meta = store_entry.meta)
     
-    def best_quote_update(self, order_message, new_bbo, timestamp):
-        m = OuchServerMessages.BestBidAndOffer(timestamp=timestamp, stock=b'AMAZGOOG',
-            best_bid=new_bbo.best_bid, volume_at_best_bid=new_bbo.volume_at_best_bid,
-            best_ask=new_bbo.best_ask, volume_at_best_ask=new_bbo.volume_at_best_ask,
-            next_bid=new_bbo.next_bid, next_ask=new_bbo.next_ask 
-        )
-        m.meta = order_message.meta
-        return m
+    def best_quote_update(self, order_message, new_bbo, timestamp, stock = None):
+        stock = self.stock if stock is None else stock
+        return OuchServerMessages.BestBidAndOffer.record(
+            timestamp, stock, new_bbo.best_bid, new_bbo.volume_at_best_bid, new_bbo.best_ask,
+            new_bbo.volume_at_best_ask, new_bbo.next_bid, new_bbo.next_ask, meta = order_message.meta)
 
     def process_cross(self, id, fulfilling_order_id, price, volume, timestamp, liquidity_flag = b'?'):
         """Create response msgs for clients involved in a trade(when orders cross)
@@ -165,38 +315,24 @@ class Exchange:
             volume: An int representing the amount of shares that will be exchanged
             timestamp: Time(in seconds) of initial transaction
         Returns:
-            A list of size 2 containing OuchServerMesssages for each client in the trade
+            A list of size 2 containing Executed records for each client in the trade
         """
         log.info('Orders (%s, %s) crossed at price %s, volume %s', id, fulfilling_order_id, price, volume)
-        order_message = self.order_store.orders[id].first_message
-        fulfilling_order_message = self.order_store.orders[fulfilling_order_id].first_message
-        log.info('incoming order message: %s, fullfilling order message: %s',order_message,fulfilling_order_message)
+        order_entry = self.order_store.orders[id]
+        fulfilling_order_entry = self.order_store.orders[fulfilling_order_id]
+        log.info('incoming order: %s, fullfilling order: %s', order_entry, fulfilling_order_entry)
         match_number = self.next_match_number
         self.next_match_number += 1
-        original_enter_message = self.order_store.orders[id].original_enter_message
-        r1 = OuchServerMessages.Executed(
-                timestamp = timestamp,
-                order_token = id,
-                executed_shares = volume,
-                execution_price = price,
-                liquidity_flag = liquidity_flag,
-                match_number = match_number,
-                midpoint_peg = original_enter_message['midpoint_peg']
-                )
-        r1.meta = order_message.meta
-        self.order_store.add_to_order(r1['order_token'], r1)
-        fulfilling_original_enter_message = self.order_store.orders[fulfilling_order_id].original_enter_message
-        r2 = OuchServerMessages.Executed(
-                timestamp = timestamp,
-                order_token = fulfilling_order_id,
-                executed_shares = volume,
-                execution_price = price,
-                liquidity_flag = liquidity_flag,
-                match_number = match_number,
-                midpoint_peg = fulfilling_original_enter_message['midpoint_peg']
-                )
-        r2.meta = fulfilling_order_message.meta
-        self.order_store.add_to_order(r2['order_token'], r2)
+        r1 = OuchServerMessages.Executed.record(
+                timestamp, id, volume, price, liquidity_flag, match_number,
+                order_entry.midpoint_peg, meta = order_entry.meta)
+        self.order_store.add_to_order(id, r1)
+        order_entry.executed_quantity += volume
+        r2 = OuchServerMessages.Executed.record(
+                timestamp, fulfilling_order_id, volume, price, liquidity_flag, match_number,
+                fulfilling_order_entry.midpoint_peg, meta = fulfilling_order_entry.meta)
+        self.order_store.add_to_order(fulfilling_order_id, r2)
+        fulfilling_order_entry.executed_quantity += volume
         return [r1, r2]
 
     def enter_order_atomic(self, enter_order_message, timestamp, executed_quantity = 0):
@@ -206,37 +342,36 @@ class Exchange:
             timestamp: int that represents time(in seconds) of when order was made
             executed_quantity: int specifying amount of shares to sell/buy
         """
+        stock, order_book = self.book_for(enter_order_message['stock'])
+        if not order_book.valid_price(enter_order_message['price']):
+            log.info('Price %s is outside of the book price band, order %s rejected', 
+                enter_order_message['price'], enter_order_message['order_token'])
+            self.outgoing_messages.append(self.rejected_from_enter(enter_order_message, timestamp, reason = b'BadPrice'))
+            return
         order_stored = self.order_store.store_order( 
             id = enter_order_message['order_token'], 
             message = enter_order_message, 
-            executed_quantity = executed_quantity)
+            executed_quantity = executed_quantity,
+            timestamp = timestamp)
         if not order_stored:
             log.info('Order already stored with id %s, order ignored', enter_order_message['order_token'])
-            m = OuchServerMessages.Rejected(
-                    timestamp = timestamp,
-                    order_token = enter_order_message['order_token'],
-                    reason = b'RepeatID',
-                    price = enter_order_message['price'],
-                    shares = enter_order_message['shares']
-                )
-            m.meta = enter_order_message.meta
-            self.outgoing_messages.append(m)
+            self.outgoing_messages.append(self.rejected_from_enter(enter_order_message, timestamp, reason = b'RepeatID'))
             return 
         else:
             time_in_force = enter_order_message['time_in_force']
             enter_into_book = True if time_in_force > 0 else False    
             #schedule a cancellation at some point in the future
             if time_in_force > 0 and time_in_force < 99998:     
-                cancel_order_message = self.cancel_order_from_enter_order( enter_order_message )
-                self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                self.schedule_expiry(enter_order_message['order_token'], time_in_force, timestamp)
             
-            enter_order_func = self.order_book.enter_buy if enter_order_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
+            enter_order_func = order_book.enter_buy if enter_order_message['buy_sell_indicator'] == b'B' else order_book.enter_sell
             (crossed_orders, entered_order, new_bbo) = enter_order_func(
                     enter_order_message['order_token'],
                     enter_order_message['price'],
                     enter_order_message['shares'],
                     enter_into_book)
-            log.info("Resulting book: %s", self.order_book)
+            self.touch_levels(stock, enter_order_message['buy_sell_indicator'], enter_order_message['price'], crossed_orders)
+            log.info("Resulting %s book: %s", stock, order_book)
             m=self.accepted_from_enter(enter_order_message, 
                 order_reference_number=next(self.order_ref_numbers),
                 timestamp=timestamp)
@@ -249,16 +384,83 @@ class Exchange:
                                 for m in self.process_cross(id, fulfilling_order_id, price, volume, timestamp=timestamp)]
             #self.outgoing_messages.extend(cross_messages)
             self.outgoing_broadcast_messages.extend(cross_messages)
+            self.retire_completed(order_book, crossed_orders, enter_order_message['order_token'])
             # if cross_messages:
             #     self.outgoing_broadcast_messages.append(cross_messages[1])
             if new_bbo:
-                bbo_message = self.best_quote_update(enter_order_message, new_bbo, timestamp)
+                bbo_message = self.best_quote_update(enter_order_message, new_bbo, timestamp, stock)
                 self.outgoing_broadcast_messages.append(bbo_message)
             
             # Update Client Action Log
             self.action_logger.update_log(action_type=PLACE_LIMIT_ORDER_ACTION, client_action_msg=enter_order_message, timestamp=timestamp)
 
 
+    def retire_order(self, order_token):
+        """Forget an order that is done with, and its expiry"""
+        self.order_store.retire_order(order_token)
+        self.expiries.remove(order_token)
+        if self.order_retired is not None:
+            self.order_retired(order_token)
+
+    def retire_completed(self, order_book, crossed_orders, order_token = None):
+        """Retire the orders of crossed_orders, and order_token, that no longer rest in order_book: filled, or not
+        entered into the book
+        """
+        if order_token is not None and not self.order_is_resting(order_book, order_token):
+            self.retire_order(order_token)
+        for ((id, fulfilling_order_id), price, volume) in crossed_orders:
+            for crossed_id in (id, fulfilling_order_id):
+                if crossed_id in self.order_store.orders and not self.order_is_resting(order_book, crossed_id):
+                    self.retire_order(crossed_id)
+
+    def schedule_expiry(self, order_token, time_in_force, accepted_at = None):
+        """Have an order cancelled time_in_force seconds after it was accepted (its timestamp accepted_at, now if
+        None), by the next sweep after that: an order replayed from the write-ahead log keeps the expiry it had
+        """
+        if accepted_at is not None:
+            # timestamps wrap at midnight; one ahead of the clock means the clock stepped back at a resync
+            elapsed = (self.clock() - accepted_at) % NANOSECONDS_PER_DAY
+            if elapsed < NANOSECONDS_PER_DAY // 2:
+                time_in_force = max(0, time_in_force - elapsed / 10**9)
+        now = self.loop.time()
+        self.expiries.add(order_token, now, time_in_force)
+        if self.expiry_handle is None:
+            self.expiry_handle = self.loop.call_later(self.expiries.next_tick_time() - now, self.expire_orders)
+
+    def order_is_resting(self, order_book, order_token):
+        """Whether an order still has shares in order_book"""
+        return order_token in order_book.order_index
+
+    def expire_orders(self):
+        """Timer callback: cancel the orders whose time in force has passed since the last sweep, and send the
+        cancels out together. Orders that were filled or cancelled meanwhile only leave the order store.
+        """
+        self.expiry_handle = None
+        expired = self.expiries.advance(self.loop.time())
+        if expired:
+            timestamp = self.clock()
+            for order_token in expired:
+                store_entry = self.order_store.orders.get(order_token)
+                if store_entry is None:
+                    continue
+                stock, order_book = self.book_for_order(store_entry)
+                if not self.order_is_resting(order_book, order_token):
+                    self.retire_order(order_token)
+                    continue
+                cancel_order_message = OuchClientMessages.CancelOrder(order_token = order_token, shares = 0)
+                cancel_order_message.meta = store_entry.meta
+                self.expire_order(cancel_order_message, timestamp)
+            asyncio.ensure_future(self.send_outgoing_messages())
+            asyncio.ensure_future(self.send_outgoing_broadcast_messages())
+        if len(self.expiries):
+            self.expiry_handle = self.loop.call_later(self.expiries.next_tick_time() - self.loop.time(), self.expire_orders)
+
+    def expire_order(self, cancel_order_message, timestamp):
+        """Cancel an order whose time in force has passed, logging the cancel ahead like a client's"""
+        if self.wal is not None:
+            self.wal.append(timestamp, cancel_order_message)
+        self.cancel_order_atomic(cancel_order_message, timestamp)
+
     def cancel_order_atomic(self, cancel_order_message, timestamp, reason=b'U'):
         """Cancel an order
         Args:
@@ -269,37 +471,33 @@ class Exchange:
         if store_entry is None:
             log.info(f"No such order to cancel, ignored. Token to cancel: {cancel_order_message['order_token']}")
         else:
-            original_enter_message = store_entry.original_enter_message
-            cancelled_orders, new_bbo = self.order_book.cancel_order(
+            stock, order_book = self.book_for_order(store_entry)
+            # the book's order index locates the order, no price or side needed
+            cancelled_orders, new_bbo = order_book.cancel_order(
                 id = cancel_order_message['order_token'],
-                price = store_entry.first_message['price'],
-                volume = cancel_order_message['shares'],
-                buy_sell_indicator = store_entry.original_enter_message['buy_sell_indicator'])
+                volume = cancel_order_message['shares'])
+            self.touch_levels(stock, store_entry.buy_sell_indicator, store_entry.price)
            
            
             # Remove order entry if all shares were cancelled
             if cancel_order_message['shares'] == 0:
-                 self.order_store.orders.pop(cancel_order_message['order_token'], None)
+                 self.retire_order(cancel_order_message['order_token'])
             # Order was traded or canceled before it expired
             if not cancelled_orders and not new_bbo:
                 return
             # Create and broadcast cancel message(s)
-            cancel_messages = [ self.order_cancelled_from_cancel(original_enter_message, timestamp, amount_canceled, reason,order_token= cancel_order_message['order_token'])
+            cancel_messages = [ self.order_cancelled_from_cancel(store_entry, timestamp, amount_canceled, reason,order_token= cancel_order_message['order_token'])
                         for (id, amount_canceled) in cancelled_orders ]
             self.outgoing_broadcast_messages.extend(cancel_messages) 
-            log.info("Resulting book: %s", self.order_book)
+            log.info("Resulting %s book: %s", stock, order_book)
             if new_bbo:
-                bbo_message = self.best_quote_update(cancel_order_message, new_bbo, timestamp)
+                bbo_message = self.best_quote_update(cancel_order_message, new_bbo, timestamp, stock)
                 self.outgoing_broadcast_messages.append(bbo_message)
             
             # Update Client Action Log
             client_action_data = cancel_order_message 
             self.action_logger.update_log(action_type=CANCEL_LIMIT_ORDER_ACTION, client_action_msg=client_action_data, timestamp=timestamp)
 
-            # Broadcast cancel message(s)
-            loop = asyncio.get_event_loop()
-            loop.call_soon_threadsafe(loop.create_task, self.send_outgoing_broadcast_messages())
-
     # """
     # NASDAQ may respond to the Replace Order Message in several ways:
     #     1) If the order for the existing Order Token is no longer live or if the replacement Order
@@ -322,26 +520,28 @@ class Exchange:
         if replace_order_message['existing_order_token'] not in self.order_store.orders:
             log.debug('Existing token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
             return []
-        elif replace_order_message['replacement_order_token'] in self.order_store.orders:
-            log.debug('Replacement token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
+        elif self.order_store.token_used(replace_order_message['replacement_order_token']):
+            log.debug('Replacement token %s already used, siliently ignoring', replace_order_message['replacement_order_token'])
+            return []
+        stock, order_book = self.book_for_order(self.order_store.orders[replace_order_message['existing_order_token']])
+        if not order_book.valid_price(replace_order_message['price']):
+            log.debug('Replacement price %s is outside of the book price band, siliently ignoring', replace_order_message['price'])
             return []
         else:
             store_entry = self.order_store.orders[replace_order_message['existing_order_token']]
             log.debug('store_entry: %s', store_entry)
-            cancelled_orders, new_bbo_post_cancel = self.order_book.cancel_order(
+            cancelled_orders, new_bbo_post_cancel = order_book.cancel_order(
                 id = replace_order_message['existing_order_token'],
-                price = store_entry.first_message['price'],
-                volume = 0,
-                buy_sell_indicator = store_entry.original_enter_message['buy_sell_indicator'])  # Fully cancel
+                volume = 0)  # Fully cancel
+            self.touch_levels(stock, store_entry.buy_sell_indicator, store_entry.price)
             
             if len(cancelled_orders)==0:
                 log.debug('No orders cancelled, siliently ignoring')
                 return []
             else:
                 (id_cancelled, amount_cancelled) = cancelled_orders[0]
-                original_enter_message = store_entry.original_enter_message
-                first_message = store_entry.first_message
-                shares_diff = replace_order_message['shares'] - first_message['shares'] 
+                self.retire_order(replace_order_message['existing_order_token'])
+                shares_diff = replace_order_message['shares'] - store_entry.shares
                 liable_shares = max(0, amount_cancelled + shares_diff )
                 if liable_shares == 0:
                     log.debug('No remaining liable shares on the book to replace')
@@ -350,29 +550,30 @@ class Exchange:
                     self.order_store.store_order(
                             id = replace_order_message['replacement_order_token'], 
                             message = replace_order_message,
-                            original_enter_message = original_enter_message)
+                            replaced_entry = store_entry,
+                            timestamp = timestamp)
                     time_in_force = replace_order_message['time_in_force']
                     enter_into_book = True if time_in_force > 0 else False    
                     if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                        cancel_order_message = self.cancel_order_from_replace_order( replace_order_message )
-                        self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                        self.schedule_expiry(replace_order_message['replacement_order_token'], time_in_force, timestamp)
                     
-                    enter_order_func = self.order_book.enter_buy if original_enter_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
+                    enter_order_func = order_book.enter_buy if store_entry.buy_sell_indicator == b'B' else order_book.enter_sell
                     crossed_orders, entered_order, new_bbo_post_enter = enter_order_func(
                             replace_order_message['replacement_order_token'],
                             replace_order_message['price'],
                             liable_shares,
                             enter_into_book)
+                    self.touch_levels(stock, store_entry.buy_sell_indicator, replace_order_message['price'], crossed_orders)
 
                     r = OuchServerMessages.Replaced(
                             timestamp=timestamp,
                             replacement_order_token = replace_order_message['replacement_order_token'],
-                            buy_sell_indicator=original_enter_message['buy_sell_indicator'],
+                            buy_sell_indicator=store_entry.buy_sell_indicator,
                             shares=liable_shares,
-                            stock=original_enter_message['stock'],
+                            stock=store_entry.stock,
                             price=replace_order_message['price'],
                             time_in_force=replace_order_message['time_in_force'],
-                            firm=original_enter_message['firm'],
+                            firm=store_entry.firm,
                             display=replace_order_message['display'],
                             order_reference_number=next(self.order_ref_numbers), 
                             capacity=b'*',
@@ -382,7 +583,7 @@ class Exchange:
                             order_state=b'L' if entered_order is not None else b'D',
                             previous_order_token=replace_order_message['existing_order_token'],
                             bbo_weight_indicator=b'*',
-                            midpoint_peg=original_enter_message['midpoint_peg']
+                            midpoint_peg=store_entry.midpoint_peg
                             )
                     r.meta = replace_order_message.meta
                     self.outgoing_messages.append(r)
@@ -394,30 +595,77 @@ class Exchange:
                                                     volume, 
                                                     timestamp=timestamp)]
                     self.outgoing_messages.extend(cross_messages)
+                    self.retire_completed(order_book, crossed_orders, replace_order_message['replacement_order_token'])
 
                     bbo_message = None
                     if new_bbo_post_enter:
                         bbo_message = self.best_quote_update(replace_order_message, 
-                            new_bbo_post_enter, timestamp)
+                            new_bbo_post_enter, timestamp, stock)
                     elif new_bbo_post_cancel:
                         bbo_message = self.best_quote_update(replace_order_message, 
-                            new_bbo_post_cancel, timestamp)
+                            new_bbo_post_cancel, timestamp, stock)
                     if bbo_message:
                         self.outgoing_broadcast_messages.append(bbo_message)
 
     async def send_outgoing_broadcast_messages(self):
         """Send Server OuchMessage to all connected clients"""
+        if self.wal is not None:
+            await self.wal.committed()
+        # the executions of one flush are logged with its time
+        timestamp = None
         while len(self.outgoing_broadcast_messages)>0:
             m = self.outgoing_broadcast_messages.popleft()
             if m.message_type == OuchServerMessages.Executed:
                 # self.update_transaction_log(m)
-                self.transaction_logger.update_log(transaction=m, timestamp=nanoseconds_since_midnight())
+                if timestamp is None:
+                    timestamp = self.clock()
+                self.transaction_logger.update_log(transaction=m, timestamp=timestamp)
+            elif self.bbo_conflation is not None and m.message_type == OuchServerMessages.BestBidAndOffer:
+                self.conflate_bbo(m)
+                continue
             await self.message_broadcast(m)
         
-        self.book_logger.update_log(book=self.order_book, timestamp=nanoseconds_since_midnight())
+        self.log_books()
+
+    def conflate_bbo(self, bbo_message):
+        """Hold a BBO update until the next flush, superseding the one held for the same stock"""
+        self.conflated_bbos[bbo_message['stock']] = bbo_message
+        if self.bbo_flush_handle is None:
+            if self.bbo_conflation > 0:
+                self.bbo_flush_handle = self.loop.call_later(self.bbo_conflation, self.flush_conflated_bbos)
+            else:
+                self.bbo_flush_handle = self.loop.call_soon(self.flush_conflated_bbos)
+
+    def flush_conflated_bbos(self):
+        self.bbo_flush_handle = None
+        asyncio.ensure_future(self.send_conflated_bbos())
+
+    async def send_conflated_bbos(self):
+        """Broadcast the latest held BBO update of every stock"""
+        bbo_messages = list(self.conflated_bbos.values())
+        self.conflated_bbos.clear()
+        for m in bbo_messages:
+            await self.message_broadcast(m)
+
+    def log_books(self):
+        """Write the books that changed since the last call to the book log"""
+        timestamp = self.clock()
+        if self.book_log_mode == 'delta':
+            for (stock, levels) in self.touched_levels.items():
+                self.book_logger.update_log(book=self.order_books.get(stock), timestamp=timestamp, levels=levels,
+                    stock=None if self.book_factory is None else stock)
+            self.touched_levels.clear()
+        elif self.book_factory is None:
+            self.book_logger.update_log(book=self.order_book, timestamp=timestamp)
+        else:
+            for stock in self.touched_stocks:
+                self.book_logger.update_log(book=self.order_books[stock], timestamp=timestamp, stock=stock)
+        self.touched_stocks.clear()
 
     async def send_outgoing_messages(self):
         """Send Server OuchMessage directly to sender"""
+        if self.wal is not None:
+            await self.wal.committed()
         while len(self.outgoing_messages)>0:
             m = self.outgoing_messages.popleft()
             await self.order_reply(m)
@@ -429,15 +677,66 @@ class Exchange:
         Returns False, if unsupported message is received, otherwise, responds to corresponding
             sender.
         """
+        if self.handle_message(message) is False:
+            return False
+        await self.publish()
 
-        # Perform operation associated with message type
-        if message.message_type in self.handlers:
-            timestamp = nanoseconds_since_midnight()
-            self.handlers[message.message_type](message, timestamp)
-            await self.send_outgoing_broadcast_messages()
-        else:
+    def handle_message(self, message, timestamp = None):
+        """Perform the operation associated with a message type, queueing the responses without sending them
+        Args:
+            message: client OuchMessage
+            timestamp: time the message is handled at, now if None (a replay passes the logged time)
+        Returns False if the message type is not supported.
+        """
+        handler = self.handlers.get(message.message_type)
+        if handler is None:
             log.error("Unknown message type %s", message.message_type)
             return False
+        if timestamp is None:
+            timestamp = self.clock()
+        if self.wal is not None:
+            self.wal.append(timestamp, message)
+        handler(message, timestamp)
+
+    async def publish(self):
+        """Send the responses queued by handle_message"""
+        await self.send_outgoing_broadcast_messages()
+
+    def snapshot_state(self):
+        """Copy of what the write-ahead log can not rebuild without replaying the whole session, as plain values:
+        the resting orders of every book in time priority, the order store entries and recently retired tokens, and the counters
+        """
+        order_reference_number = next(self.order_ref_numbers)
+        self.order_ref_numbers = itertools.count(order_reference_number, 2)
+        books = {}
+        for (stock, book) in self.order_books.items():
+            books[stock] = [(buy_sell_indicator, level.price, list(level.order_q.items()))
+                for (buy_sell_indicator, ladder) in ((b'B', book.bids), (b'S', book.asks))
+                for level in ladder.ascending_items()]
+        orders = [(token, entry.as_tuple()) for (token, entry) in self.order_store.orders.items()]
+        return {"match_number": self.next_match_number, "order_reference_number": order_reference_number,
+                "books": books, "orders": orders, "retired_tokens": list(self.order_store.retired)}
+
+    def restore_state(self, state):
+        """Take back a state from snapshot_state, in place of the current one"""
+        self.next_match_number = state["match_number"]
+        self.order_ref_numbers = itertools.count(state["order_reference_number"], 2)
+        for (stock, levels) in state["books"].items():
+            stock, book = self.book_for(stock)
+            for (buy_sell_indicator, price, orders) in levels:
+                ladder = book.bids if buy_sell_indicator == b'B' else book.asks
+                for (token, volume) in orders:
+                    book.rest_order(ladder, token, price, volume)
+            book.update_bbo(bid_touched = True, ask_touched = True)
+            self.touch_book(stock)
+        for (token, values) in state["orders"]:
+            # the clients of the previous exchange are gone, the order has no connection to answer to
+            entry = self.order_store.orders[token] = OrderStoreEntry.from_tuple(values)
+            if entry.accepted_at is not None and 0 < entry.time_in_force < 99998:
+                # the expiry fires when it would have, or at the next sweep if that has passed
+                self.schedule_expiry(token, entry.time_in_force, entry.accepted_at)
+        for token in state["retired_tokens"]:
+            self.order_store.remember_retired(token)
 
     async def modify_order(self, modify_order_message):
         raise NotImplementedError()
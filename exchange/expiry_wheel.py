@@ -0,0 +1,117 @@
+"""Hierarchical timer wheel holding the time-in-force expiries of resting orders.
+
+Time is counted in ticks (one second by default) since an origin on the event loop's clock. Level 0
+has one slot per tick for the next `slots` ticks, level 1 one slot per `slots` ticks for the next
+slots**2, and so on; expiries further out wait in an overflow dict. Whenever the wheel below wraps,
+the next slot of a level is spread over the levels below it, so every entry reaches level 0 by the
+tick it is due. Adding and removing an order are dict operations, and a tick only visits the slots
+that are due.
+"""
+
+import math
+
+
+class ExpiryWheel:
+    '''
+    Expiry times of orders, by order token. The exchange advances it once per tick and cancels the
+    orders it returns.
+    '''
+
+    def __init__(self, origin, tick = 1, slots = 64, levels = 3):
+        '''
+        Args:
+            origin: time (on the clock passed to add and advance) of tick 0
+            tick: seconds per tick, the resolution of the expiries
+            slots: slots per level
+            levels: number of levels; slots**levels ticks ahead are held without the overflow
+        '''
+        self.origin = origin
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        # every slot is a dict of order token -> tick it is due
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.overflow = {}
+        self.current = 0
+        # order token -> the slot holding it
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __contains__(self, token):
+        return token in self.buckets
+
+    def tick_at(self, now):
+        return int((now - self.origin) // self.tick)
+
+    def next_tick_time(self):
+        '''Time of the next tick, when advance should be called again'''
+        return self.origin + (self.current + 1) * self.tick
+
+    def add(self, token, now, delay):
+        '''Have token expire delay seconds after now (at the first tick at or after that)'''
+        if not self.buckets:
+            # nothing was due while the wheel was empty, skip the idle ticks
+            self.current = max(self.current, self.tick_at(now))
+        self.remove(token)
+        due = max(self.current + 1, math.ceil((now + delay - self.origin) / self.tick))
+        self.place(token, due)
+
+    def place(self, token, due):
+        distance = due - self.current
+        width = 1
+        for wheel in self.wheels:
+            if distance < width * self.slots:
+                bucket = wheel[(due // width) % self.slots]
+                break
+            width *= self.slots
+        else:
+            bucket = self.overflow
+        bucket[token] = due
+        self.buckets[token] = bucket
+
+    def remove(self, token):
+        '''Drop the expiry of token, if it has one'''
+        bucket = self.buckets.pop(token, None)
+        if bucket is not None:
+            del bucket[token]
+
+    def clear(self):
+        for bucket in self.buckets.values():
+            bucket.clear()
+        self.buckets.clear()
+
+    def cascade(self):
+        '''Spread the slots of the upper levels that start at the current tick over the levels below'''
+        width = self.slots
+        for level in range(1, self.levels + 1):
+            if self.current % width:
+                return
+            bucket = self.wheels[level][(self.current // width) % self.slots] if level < self.levels else self.overflow
+            if bucket:
+                entries = list(bucket.items())
+                bucket.clear()
+                for (token, due) in entries:
+                    self.place(token, due)
+            width *= self.slots
+
+    def advance(self, now):
+        '''
+        Move the wheel to the tick of now.
+        Returns:
+            list of the tokens due on the way, in the order they fell due
+        '''
+        target = self.tick_at(now)
+        expired = []
+        while self.current < target and self.buckets:
+            self.current += 1
+            self.cascade()
+            bucket = self.wheels[0][self.current % self.slots]
+            if bucket:
+                for token in bucket:
+                    del self.buckets[token]
+                expired.extend(bucket)
+                bucket.clear()
+        self.current = max(self.current, target)
+        return expired
@@ -1,7 +1,6 @@
 import logging as log
 import asyncio
 from exchange.exchange import Exchange
-from OuchServer.ouch_server import nanoseconds_since_midnight
 from OuchServer.ouch_messages import OuchServerMessages
 
 
@@ -14,8 +13,14 @@ class FBAExchange(Exchange):
         asyncio.ensure_future(self.run_batch_repeating())
 
     def run_batch_atomic(self):
-        timestamp = nanoseconds_since_midnight()
-        crossed_orders, clearing_price = self.order_book.batch_process()
+        for stock, order_book in self.order_books.items():
+            self.run_book_batch(stock, order_book)
+
+    def run_book_batch(self, stock, order_book):
+        timestamp = self.clock()
+        crossed_orders, clearing_price = order_book.batch_process()
+        self.touched_stocks.add(stock)
+        self.touch_book(stock)
         cross_messages = [m for ((id, fulfilling_order_id), price, volume) 
                                             in crossed_orders 
                             for m in self.process_cross(
@@ -23,11 +28,12 @@ class FBAExchange(Exchange):
                                 price, volume, 
                                 timestamp=timestamp)]
         self.outgoing_messages.extend(cross_messages)
-        best_bid, best_ask, next_bid, next_ask, v_bb, v_bo = self.order_book.bbo
+        self.retire_completed(order_book, crossed_orders)
+        best_bid, best_ask, next_bid, next_ask, v_bb, v_bo = order_book.bbo
         self.outgoing_broadcast_messages.append(
             OuchServerMessages.PostBatch(
-                    timestamp=nanoseconds_since_midnight(),
-                    stock=b'AMAZGOOG',
+                    timestamp=timestamp,
+                    stock=stock,
                     clearing_price=clearing_price,
                     transacted_volume=len(crossed_orders),
                     best_bid=best_bid,
@@ -1,8 +1,6 @@
 import asyncio
 import logging as log
-from functools import partial
 from exchange.exchange import Exchange
-from OuchServer.ouch_server import nanoseconds_since_midnight
 from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
 from .order_books.cda_book import MIN_BID, MAX_ASK
 
@@ -16,25 +14,39 @@ class IEXExchange(Exchange):
     def __init__(self, delay, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.delay = delay
-        self.previous_peg_state = 0
+        # stock -> last peg state sent for that book
+        self.previous_peg_states = {}
         self.handlers.update({
             OuchClientMessages.ExternalFeedChange: self.external_feed_change,
         })
     
     async def process_message(self, message):
+        return self.handle_message(message)
+
+    def handle_message(self, message, timestamp = None):
+        """Like Exchange.handle_message, after the speed bump for orders and cancels. A given timestamp is
+        the time the message arrived at, it is handled at that time plus the delay.
+        """
         if message.message_type not in self.handlers:
             log.error("Unknown message type %s", message.message_type)
             return False
         log.debug('Processing message %s', message)
 
         if message.message_type in self.delayed_message_types:
-            self.loop.call_later(self.delay, self._process_message, message)
+            if timestamp is not None:
+                timestamp += round(self.delay * 10**9)
+            self.loop.call_later(self.delay, self._process_message, message, timestamp)
         else:
-            self._process_message(message)
+            self._process_message(message, timestamp)
+
+    async def publish(self):
+        # _process_message sends its own responses once the speed bump has passed
+        pass
 
-    def _process_message(self, message):
-        """actually process a message. called, possibly after a delay, by process_message"""
-        timestamp = nanoseconds_since_midnight()
+    def _process_message(self, message, timestamp = None):
+        """actually process a message, at timestamp (now if None). called, possibly after a delay, by process_message"""
+        if timestamp is None:
+            timestamp = self.clock()
         self.handlers[message.message_type](message, timestamp)
         asyncio.ensure_future(self.send_outgoing_messages())
         asyncio.ensure_future(self.send_outgoing_broadcast_messages())
@@ -44,22 +56,37 @@ class IEXExchange(Exchange):
             peg_point = None
         else:
             peg_point = (message['e_best_bid'] + message['e_best_offer']) // 2
-        log.debug('Peg update: new peg is is %d', peg_point)
-        (crossed_orders, new_bbo) = self.order_book.update_peg_price(peg_point)
-        cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
-                            for m in self.process_cross(id, fulfilling_order_id, price, volume, timestamp=timestamp)]
-        self.outgoing_messages.extend(cross_messages)
-        if new_bbo:
-            bbo_message = self.best_quote_update(message, new_bbo, timestamp)
-            self.outgoing_broadcast_messages.append(bbo_message)
-        self.send_peg_state_update(timestamp)
+        log.debug('Peg update: new peg is is %s', peg_point)
+        # the external feed names no symbol, so the peg moves in every book
+        for stock, order_book in list(self.order_books.items()):
+            self.touched_stocks.add(stock)
+            (crossed_orders, new_bbo) = order_book.update_peg_price(peg_point)
+            # pegged orders rest outside the ladders, only lit levels they crossed changed
+            for (_, price, _) in crossed_orders:
+                self.touch_levels(stock, b'B', price)
+                self.touch_levels(stock, b'S', price)
+            cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
+                                for m in self.process_cross(id, fulfilling_order_id, price, volume, timestamp=timestamp)]
+            self.outgoing_messages.extend(cross_messages)
+            self.retire_completed(order_book, crossed_orders)
+            if new_bbo:
+                bbo_message = self.best_quote_update(message, new_bbo, timestamp, stock)
+                self.outgoing_broadcast_messages.append(bbo_message)
+            self.send_peg_state_update(timestamp, order_book)
 
     # kind of a bummer that so much of this has to be repeated, but I can't think of a better way
     def enter_order_atomic(self, enter_order_message, timestamp, executed_quantity = 0):
+        # pegged orders never rest at their own price, so only lit orders are checked against the band
+        stock, order_book = self.book_for(enter_order_message['stock'])
+        if not enter_order_message['midpoint_peg'] and not order_book.valid_price(enter_order_message['price']):
+            log.debug('Price %s is outside of the book price band, order %s ignored', 
+                enter_order_message['price'], enter_order_message['order_token'])
+            return []
         order_stored = self.order_store.store_order( 
             id = enter_order_message['order_token'], 
             message = enter_order_message, 
-            executed_quantity = executed_quantity)
+            executed_quantity = executed_quantity,
+            timestamp = timestamp)
         if not order_stored:
             log.debug('Order already stored with id %s, order ignored', enter_order_message['order_token'])
             return []
@@ -67,17 +94,17 @@ class IEXExchange(Exchange):
             time_in_force = enter_order_message['time_in_force']
             enter_into_book = True if time_in_force > 0 else False    
             if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                cancel_order_message = self.cancel_order_from_enter_order( enter_order_message )
-                self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                self.schedule_expiry(enter_order_message['order_token'], time_in_force)
             
-            enter_order_func = self.order_book.enter_buy if enter_order_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
+            enter_order_func = order_book.enter_buy if enter_order_message['buy_sell_indicator'] == b'B' else order_book.enter_sell
             (crossed_orders, entered_order, new_bbo) = enter_order_func(
                     enter_order_message['order_token'],
                     enter_order_message['price'],
                     enter_order_message['shares'],
                     enter_into_book,
                     enter_order_message['midpoint_peg'])
-            log.debug("Resulting book: %s", self.order_book)
+            self.touch_levels(stock, enter_order_message['buy_sell_indicator'], enter_order_message['price'], crossed_orders)
+            log.debug("Resulting %s book: %s", stock, order_book)
             m=self.accepted_from_enter(enter_order_message, 
                 order_reference_number=next(self.order_ref_numbers),
                 timestamp=timestamp)
@@ -86,33 +113,41 @@ class IEXExchange(Exchange):
             cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
                                 for m in self.process_cross(id, fulfilling_order_id, price, volume, timestamp=timestamp)]
             self.outgoing_messages.extend(cross_messages)
+            self.retire_completed(order_book, crossed_orders, enter_order_message['order_token'])
             if new_bbo:
-                bbo_message = self.best_quote_update(enter_order_message, new_bbo, timestamp)
+                bbo_message = self.best_quote_update(enter_order_message, new_bbo, timestamp, stock)
                 self.outgoing_broadcast_messages.append(bbo_message)
-            self.check_for_peg_update(timestamp)
+            self.check_for_peg_update(timestamp, stock, order_book)
+
+    def order_is_resting(self, order_book, order_token):
+        return (order_token in order_book.order_index or order_token in order_book.pegged_bids
+                or order_token in order_book.pegged_asks)
 
     def cancel_order_atomic(self, cancel_order_message, timestamp, reason=b'U'):
         if cancel_order_message['order_token'] not in self.order_store.orders:
            log.debug(f"No such order to cancel, ignored. Token to cancel: {cancel_order_message['order_token']}")
         else:
             store_entry = self.order_store.orders[cancel_order_message['order_token']]
-            original_enter_message = store_entry.original_enter_message
-            cancelled_orders, new_bbo = self.order_book.cancel_order(
+            stock, order_book = self.book_for_order(store_entry)
+            cancelled_orders, new_bbo = order_book.cancel_order(
                 order_id = cancel_order_message['order_token'],
-                price = store_entry.first_message['price'],
+                price = store_entry.price,
                 volume = cancel_order_message['shares'],
-                buy_sell_indicator = original_enter_message['buy_sell_indicator'],
-                midpoint_peg = original_enter_message['midpoint_peg'])
-            cancel_messages = [ self.order_cancelled_from_cancel(original_enter_message, timestamp, amount_canceled, reason, order_token= cancel_order_message['order_token'])
+                buy_sell_indicator = store_entry.buy_sell_indicator,
+                midpoint_peg = store_entry.midpoint_peg)
+            self.touch_levels(stock, store_entry.buy_sell_indicator, store_entry.price)
+            if cancel_order_message['shares'] == 0:
+                self.retire_order(cancel_order_message['order_token'])
+            cancel_messages = [ self.order_cancelled_from_cancel(store_entry, timestamp, amount_canceled, reason, order_token= cancel_order_message['order_token'])
                         for (id, amount_canceled) in cancelled_orders ]
 
             self.outgoing_messages.extend(cancel_messages) 
-            log.debug("Resulting book: %s", self.order_book)
+            log.debug("Resulting %s book: %s", stock, order_book)
             if new_bbo:
-                bbo_message = self.best_quote_update(cancel_order_message, new_bbo, timestamp)
+                bbo_message = self.best_quote_update(cancel_order_message, new_bbo, timestamp, stock)
                 self.outgoing_broadcast_messages.append(bbo_message)
-            if original_enter_message['midpoint_peg']:
-                self.send_peg_state_update(timestamp)
+            if store_entry.midpoint_peg:
+                self.send_peg_state_update(timestamp, order_book)
 
     # replace for iex is a little weird, right now it maintains the litness of any replaced order.
     # it doesn't really make sense to replace a pegged order at all for our implementation, so this should work fine.
@@ -121,27 +156,31 @@ class IEXExchange(Exchange):
         if replace_order_message['existing_order_token'] not in self.order_store.orders:
             log.debug('Existing token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
             return []
-        elif replace_order_message['replacement_order_token'] in self.order_store.orders:
-            log.debug('Replacement token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
+        elif self.order_store.token_used(replace_order_message['replacement_order_token']):
+            log.debug('Replacement token %s already used, siliently ignoring', replace_order_message['replacement_order_token'])
+            return []
+        stock, order_book = self.book_for_order(self.order_store.orders[replace_order_message['existing_order_token']])
+        if not order_book.valid_price(replace_order_message['price']):
+            log.debug('Replacement price %s is outside of the book price band, siliently ignoring', replace_order_message['price'])
             return []
         else:
             store_entry = self.order_store.orders[replace_order_message['existing_order_token']]
-            original_enter_message = store_entry.original_enter_message
             log.debug('store_entry: %s', store_entry)
-            cancelled_orders, new_bbo_post_cancel = self.order_book.cancel_order(
+            cancelled_orders, new_bbo_post_cancel = order_book.cancel_order(
                 order_id = replace_order_message['existing_order_token'],
-                price = store_entry.first_message['price'],
+                price = store_entry.price,
                 volume = 0,
-                buy_sell_indicator = original_enter_message['buy_sell_indicator'],
-                midpoint_peg=original_enter_message['midpoint_peg'])  # Fully cancel
+                buy_sell_indicator = store_entry.buy_sell_indicator,
+                midpoint_peg=store_entry.midpoint_peg)  # Fully cancel
+            self.touch_levels(stock, store_entry.buy_sell_indicator, store_entry.price)
             
             if len(cancelled_orders)==0:
                 log.debug('No orders cancelled, siliently ignoring')
                 return []
             else:
                 (id_cancelled, amount_cancelled) = cancelled_orders[0]
-                first_message = store_entry.first_message
-                shares_diff = replace_order_message['shares'] - first_message['shares'] 
+                self.retire_order(replace_order_message['existing_order_token'])
+                shares_diff = replace_order_message['shares'] - store_entry.shares
                 liable_shares = max(0, amount_cancelled + shares_diff )
                 if liable_shares == 0:
                     log.debug('No remaining liable shares on the book to replace')
@@ -150,31 +189,32 @@ class IEXExchange(Exchange):
                     self.order_store.store_order(
                             id = replace_order_message['replacement_order_token'], 
                             message = replace_order_message,
-                            original_enter_message = original_enter_message)
+                            replaced_entry = store_entry,
+                            timestamp = timestamp)
                     time_in_force = replace_order_message['time_in_force']
                     enter_into_book = True if time_in_force > 0 else False    
                     if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                        cancel_order_message = self.cancel_order_from_replace_order( replace_order_message )
-                        self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                        self.schedule_expiry(replace_order_message['replacement_order_token'], time_in_force)
                     
-                    enter_order_func = self.order_book.enter_buy if original_enter_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
+                    enter_order_func = order_book.enter_buy if store_entry.buy_sell_indicator == b'B' else order_book.enter_sell
                     crossed_orders, entered_order, new_bbo_post_enter = enter_order_func(
                             replace_order_message['replacement_order_token'],
                             replace_order_message['price'],
                             liable_shares,
                             enter_into_book,
-                            midpoint_peg=original_enter_message['midpoint_peg'])
-                    log.debug("Resulting book: %s", self.order_book)
+                            midpoint_peg=store_entry.midpoint_peg)
+                    self.touch_levels(stock, store_entry.buy_sell_indicator, replace_order_message['price'], crossed_orders)
+                    log.debug("Resulting %s book: %s", stock, order_book)
 
                     r = OuchServerMessages.Replaced(
                             timestamp=timestamp,
                             replacement_order_token = replace_order_message['replacement_order_token'],
-                            buy_sell_indicator=original_enter_message['buy_sell_indicator'],
+                            buy_sell_indicator=store_entry.buy_sell_indicator,
                             shares=liable_shares,
-                            stock=original_enter_message['stock'],
+                            stock=store_entry.stock,
                             price=replace_order_message['price'],
                             time_in_force=replace_order_message['time_in_force'],
-                            firm=original_enter_message['firm'],
+                            firm=store_entry.firm,
                             display=replace_order_message['display'],
                             order_reference_number=next(self.order_ref_numbers), 
                             capacity=b'*',
@@ -184,7 +224,7 @@ class IEXExchange(Exchange):
                             order_state=b'L' if entered_order is not None else b'D',
                             previous_order_token=replace_order_message['existing_order_token'],
                             bbo_weight_indicator=b'*',
-                            midpoint_peg=original_enter_message['midpoint_peg']
+                            midpoint_peg=store_entry.midpoint_peg
                             )
                     r.meta = replace_order_message.meta
                     self.outgoing_messages.append(r)
@@ -196,37 +236,38 @@ class IEXExchange(Exchange):
                                                     volume, 
                                                     timestamp=timestamp)]
                     self.outgoing_messages.extend(cross_messages)
+                    self.retire_completed(order_book, crossed_orders, replace_order_message['replacement_order_token'])
 
                     bbo_message = None
                     if new_bbo_post_enter:
                         bbo_message = self.best_quote_update(replace_order_message, 
-                            new_bbo_post_enter, timestamp)
+                            new_bbo_post_enter, timestamp, stock)
                     elif new_bbo_post_cancel:
                         bbo_message = self.best_quote_update(replace_order_message, 
-                            new_bbo_post_cancel, timestamp)
+                            new_bbo_post_cancel, timestamp, stock)
                     if bbo_message:
                         self.outgoing_broadcast_messages.append(bbo_message)
-                    self.check_for_peg_update(timestamp)
+                    self.check_for_peg_update(timestamp, stock, order_book)
     
     # compares book's peg state against exchange's peg state, sending an update
     # if a change is seen
-    def check_for_peg_update(self, timestamp):
-        cur_peg_state = self.order_book.get_peg_state()
-        if self.previous_peg_state == cur_peg_state:
+    def check_for_peg_update(self, timestamp, stock, order_book):
+        cur_peg_state = order_book.get_peg_state()
+        if self.previous_peg_states.get(stock, 0) == cur_peg_state:
             return
-        self.previous_peg_state = cur_peg_state
-        self.send_peg_state_update(timestamp)
+        self.previous_peg_states[stock] = cur_peg_state
+        self.send_peg_state_update(timestamp, order_book)
     
     # create and send a peg state update message
-    def send_peg_state_update(self, timestamp):
-        peg_price = self.order_book.peg_price
+    def send_peg_state_update(self, timestamp, order_book):
+        peg_price = order_book.peg_price
         # HACK: when peg price is None, need to represent that somehow
         # I wanna get this done, so -999999 represents None
         if peg_price is None:
             peg_price = -999999
         m = OuchServerMessages.PegStateUpdate(
             timestamp = timestamp,
-            peg_state = self.order_book.get_peg_state(),
+            peg_state = order_book.get_peg_state(),
             peg_price = peg_price
         )
         self.outgoing_broadcast_messages.append(m)
@@ -0,0 +1,161 @@
+"""Array backed alternative to BookPriceQ.
+
+Resting orders of a price level are kept in parallel ids/volumes lists in
+time priority. Each order's index into the lists is its handle, so fills
+from the head and cancels by order id are O(1): a removed order leaves a
+tombstone (id None) that is skipped by fills and dropped when the lists
+are compacted, which happens once tombstones make up half of the entries.
+"""
+from .book_price_q import BookPriceQ
+
+COMPACT_MIN_TOMBSTONES = 64	# never compact small queues, a rebuild would cost more than skipping
+
+
+class OrderQueueView:
+	'''
+	Read only mapping view of an ArrayBookPriceQ in time priority, standing in for BookPriceQ.order_q
+	so callers can keep using `id in q.order_q`, `q.order_q[id]`, `len(q.order_q)` and `q.order_q.items()`.
+	'''
+	__slots__ = ('q',)
+
+	def __init__(self, q):
+		self.q = q
+
+	def __len__(self):
+		return len(self.q.slots)
+
+	def __contains__(self, order_id):
+		return order_id in self.q.slots
+
+	def __getitem__(self, order_id):
+		return self.q.entry(self.q.slots[order_id])
+
+	def __iter__(self):
+		ids = self.q.ids
+		for i in range(self.q.head, len(ids)):
+			if ids[i] is not None:
+				yield ids[i]
+
+	def keys(self):
+		return iter(self)
+
+	def values(self):
+		for (_, value) in self.items():
+			yield value
+
+	def items(self):
+		q = self.q
+		ids = q.ids
+		for i in range(q.head, len(ids)):
+			if ids[i] is not None:
+				yield (ids[i], q.entry(i))
+
+	def __repr__(self):
+		return 'OrderQueueView({})'.format(list(self.items()))
+
+
+class ArrayBookPriceQ:
+	'''Drop-in replacement for BookPriceQ keeping the orders in parallel arrays, see the module docstring.'''
+	def __init__(self, price):
+		self.interest = 0 	#sum of interest at this price
+		self.price = price
+		self.ids = []		#order ids in time priority, None for a tombstone
+		self.volumes = []	#remaining volume, parallel to ids
+		self.slots = {}		#order id -> index into ids/volumes, live orders only
+		self.head = 0		#entries before head are all tombstones
+		self.order_q = OrderQueueView(self)
+
+	def __str__(self):
+		return '${} Interest: {}'.format(
+			self.price, self.interest)
+
+	def as_dict(self):
+		return {"price" : self.price, "quantity": self.interest}
+
+	def entry(self, i):
+		'''The value order_q maps the order at index i to.'''
+		return self.volumes[i]
+
+	def add_order(self, order_id, volume):
+		self.interest += volume
+		self.slots[order_id] = len(self.ids)
+		self.ids.append(order_id)
+		self.volumes.append(volume)
+
+	def cancel_order(self, order_id):
+		i = self.slots.pop(order_id)
+		self.interest -= self.volumes[i]
+		self.ids[i] = None
+		tombstones = len(self.ids) - len(self.slots)
+		if tombstones >= COMPACT_MIN_TOMBSTONES and 2 * tombstones >= len(self.ids):
+			self.compact()
+
+	def reduce_order(self, order_id, new_volume):
+		i = self.slots[order_id]
+		volume = self.volumes[i]
+		assert new_volume <= volume
+		self.volumes[i] = new_volume
+		self.interest -= (volume - new_volume)
+
+	def fill_order(self, volume):
+		'''
+		For a given order volume to fill, dequeue's the oldest orders 
+		at this price point to be used to fill the order. 
+
+		Returns a tuple giving the volume filled at this price, and a list of (order_id, order_volume) pairs giving the order volume amount filled from each order in the book.
+		'''
+		volume_to_fill = volume
+		fulfilling_orders = []
+		ids = self.ids
+		volumes = self.volumes
+		head = self.head
+		end = len(ids)
+		while volume_to_fill > 0 and head < end:
+			next_order_id = ids[head]
+			if next_order_id is None:
+				head += 1
+				continue
+			next_order_volume = volumes[head]
+			if next_order_volume > volume_to_fill:
+				volumes[head] = next_order_volume - volume_to_fill
+				fulfilling_orders.append((next_order_id, volume_to_fill))
+				self.interest -= volume_to_fill
+				volume_to_fill = 0
+			else:
+				volume_to_fill -= next_order_volume
+				fulfilling_orders.append((next_order_id, next_order_volume))
+				self.interest -= next_order_volume
+				del self.slots[next_order_id]
+				ids[head] = None
+				head += 1
+		self.head = head
+		if 2 * head >= end and head >= COMPACT_MIN_TOMBSTONES or not self.slots:
+			self.compact()
+		return (volume - volume_to_fill, fulfilling_orders)
+
+	def compact(self):
+		'''
+		Drop all tombstones and re-index the live orders. 
+
+		Returns the old indexes of the live orders, in order, so subclasses can compact their own arrays.
+		'''
+		ids = self.ids
+		if not self.slots:
+			self.ids = []
+			self.volumes = []
+			self.head = 0
+			return []
+		live = [i for i in range(self.head, len(ids)) if ids[i] is not None]
+		volumes = self.volumes
+		self.ids = [ids[i] for i in live]
+		self.volumes = [volumes[i] for i in live]
+		self.slots = {order_id: i for (i, order_id) in enumerate(self.ids)}
+		self.head = 0
+		return live
+
+
+# price level queues selectable by CDABook/IEXBook, keyed by their command line name
+PRICE_QUEUES = {
+	'ordered': BookPriceQ,
+	'array': ArrayBookPriceQ,
+}
@@ -3,7 +3,6 @@ BookPriceQ organizes this information by combining the total amount of
 shares for the price as 'interest'. While maintaining distinction
 between multiple clients' orders.
 """
-import logging as log
 from collections import OrderedDict
 
 
@@ -62,6 +61,5 @@ class BookPriceQ:
 			else:
 				volume_to_fill -= next_order_volume
 				fulfilling_orders.append(self.order_q.popitem(last=False))
-				log.info(self.order_q.values())
 				self.interest -= next_order_volume
 		return (volume - volume_to_fill, fulfilling_orders)
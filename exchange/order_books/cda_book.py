@@ -11,16 +11,36 @@ MIN_BID = 0
 MAX_ASK = 2147483647
 
 bbo = namedtuple('BestQuotes', 'best_bid volume_at_best_bid best_ask volume_at_best_ask next_bid next_ask')
+# columnar results of enter_many/cancel_many: one list per field, row i of every list describes the same cross/order
+batch_result = namedtuple('BatchResult', 'taker_ids maker_ids cross_prices cross_volumes entered_ids entered_prices entered_volumes bbo')
+cancel_result = namedtuple('CancelResult', 'canceled_ids canceled_volumes bbo')
 
 class CDABook:
-	def __init__(self):
+	def __init__(self, ladder = SortedIndexedDefaultList, price_q = BookPriceQ):
+		'''
+		args:
+			ladder: price ladder class (or factory with the same signature) used to hold the price
+				levels of each side, see list_elements.PRICE_LADDERS
+			price_q: class of the queue holding the resting orders of a price level, see 
+				array_price_q.PRICE_QUEUES
+		'''
+		self.ladder = ladder
+		self.price_q = price_q
+		# live best/next prices and volumes, refreshed from the head of a side's ladder when it is touched
 		self.bid = MIN_BID
 		self.ask = MAX_ASK
-		self.bids = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-							initializer = lambda p: BookPriceQ(p),
+		self.volume_at_best_bid = 0
+		self.volume_at_best_ask = 0
+		self.next_bid = MIN_BID
+		self.next_ask = MAX_ASK
+		self.bids = ladder(index_func = lambda bq: bq.price, 
+							initializer = price_q,
 							index_multiplier = -1)
-		self.asks = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-							initializer = lambda p: BookPriceQ(p))
+		self.asks = ladder(index_func = lambda bq: bq.price, 
+							initializer = price_q)
+		# order id -> (ladder, level) of every resting order, so cancels go straight to the order
+		self.order_index = {}
+		# last published BBO
 		self.bbo = bbo(best_bid=MIN_BID, volume_at_best_bid=0, best_ask=MAX_ASK,
 			volume_at_best_ask=0, next_bid=MIN_BID, next_ask=MAX_ASK)
 
@@ -45,95 +65,144 @@ class CDABook:
     #             	self.bids.remove(id)
 
 	def reset_book(self):
-		self.__init__()	# I dont see a reason not to do this.
+		self.__init__(ladder = self.ladder, price_q = self.price_q)	# I dont see a reason not to do this.
 
-	def cancel_order(self, id, price, volume, buy_sell_indicator):
+	def valid_price(self, price):
+		'''Whether an order at price can rest in the book, i.e. the price ladder accepts it.'''
+		return self.bids.valid_price(price)
+
+	def cancel_order(self, id, price = None, volume = 0, buy_sell_indicator = None):
 		'''
 		Cancel all or part of an order. Volume refers to the desired remaining shares to be executed: if it is 0, the order is
 		fully cancelled, otherwise an order of volume volume remains.
 
 		args:
 			id: a string representing the id of the order to cancel
-			price: an int representing the cost per share 
+			price: unused, the order index locates the order; kept for existing callers
 			volume: an int representing the amount of shares 
-			buy_sell_indicator: a b-string specifying whether the order is a buy (b'B') or sell (b'S')
+			buy_sell_indicator: unused, see price
 		returns:
 			None if the order does not exist or the book is empty. Otherwise returns the status of the 
 			canceled order.
 		'''
-		orders = self.bids if buy_sell_indicator == b'B' else self.asks
-		if price not in orders or id not in orders[price].order_q:
-			log.info('-----------------------------------------------')
-			log.info('No order in the book to cancel, cancel ignored.')
-			log.info(f'Token to cancel: {id}. Price: {price}.')
-			log.info(f'active tokens: {orders[price].order_q}.')
-			log.info(f'active orders: {orders}')
-			log.info('-----------------------------------------------')
+		handle = self.order_index.get(id)
+		amount_canceled = self._cancel_order(id, price, volume, buy_sell_indicator)
+		if amount_canceled is None:
 			return [], None
+		bid_side = handle[0] is self.bids
+		bbo_update = self.update_bbo(bid_touched = bid_side, ask_touched = not bid_side)
+		return [(id, amount_canceled)], bbo_update
+
+	def _cancel_order(self, id, price, volume, buy_sell_indicator):
+		'''
+		Cancel or reduce an order through the order index, without touching the BBO. The price ladder
+		is only touched to drop the order's level if it empties.
+
+		returns:
+			the amount canceled, or None if the order is not in the book
+		'''
+		handle = self.order_index.get(id)
+		if handle is None:
+			log.info('No order in the book to cancel, cancel ignored. Token to cancel: %s', id)
+			return None
+		(orders, level) = handle
+		current_volume = level.order_q[id]
+		# fully cancel
+		if volume == 0:
+			level.cancel_order(id)
+			del self.order_index[id]
+			if level.interest == 0:
+				orders.remove(level.price)
+			return current_volume
+		elif current_volume >= volume:
+			level.reduce_order(id, volume)
+			return current_volume - volume
 		else:
-			amount_canceled=0
-			current_volume=orders[price].order_q[id]
-			# fully cancel
-			if volume==0: 										
-				orders[price].cancel_order(id)
-				amount_canceled = current_volume
-				if orders[price].interest == 0:
-					orders.remove(price)
-			elif current_volume >= volume:
-				orders[price].reduce_order(id, volume)		
-				amount_canceled = current_volume - volume
-			else:
-				amount_canceled = 0
-			bbo_update = None
-			if price == self.bid:
-				bbo_update = self.update_bid()
-			elif price == self.ask:
-				bbo_update = self.update_ask()
-
-			return [(id, amount_canceled)], bbo_update
-			
+			return 0
 
-	def update_bid(self):
-		if self.bids.start is None:
-			self.bid = MIN_BID
-			best_bid, vol_bid = MIN_BID, 0 
-			next_bid = MIN_BID
+	def cancel_many(self, cancels):
+		'''
+		Cancel or reduce a batch of orders in one pass, publishing the BBO once at the end.
+		Like enter_many, a building block the exchange does not call yet.
+
+		args:
+			cancels: iterable of (id, price, volume, buy_sell_indicator) tuples, with the same meaning
+				as the arguments of cancel_order, plus any extra cancel_order arguments of subclasses
+		returns:
+			a cancel_result with one row per order found in the book and the final BBO update (None if unchanged)
+		'''
+		canceled_ids = []
+		canceled_volumes = []
+		bid_touched = ask_touched = False
+		for (id, price, volume, buy_sell_indicator, *extra) in cancels:
+			# the side comes from the book, like in cancel_order; orders outside the ladders (pegged) touch neither
+			handle = self.order_index.get(id)
+			amount_canceled = self._cancel_order(id, price, volume, buy_sell_indicator, *extra)
+			if amount_canceled is None:
+				continue
+			canceled_ids.append(id)
+			canceled_volumes.append(amount_canceled)
+			if handle is not None:
+				if handle[0] is self.bids:
+					bid_touched = True
+				else:
+					ask_touched = True
+		return cancel_result(canceled_ids, canceled_volumes, self.update_bbo(bid_touched, ask_touched))
+
+	def refresh_bid(self):
+		'''Re-read best/next bid and the volume at the best bid from the head of the bid ladder.'''
+		best = self.bids.start
+		if best is None:
+			self.bid, self.volume_at_best_bid, self.next_bid = MIN_BID, 0, MIN_BID
+		else:
+			self.bid, self.volume_at_best_bid = best.data.price, best.data.interest
+			next = best.next
+			self.next_bid = MIN_BID if next is None else next.data.price
+
+	def refresh_ask(self):
+		'''Re-read best/next ask and the volume at the best ask from the head of the ask ladder.'''
+		best = self.asks.start
+		if best is None:
+			self.ask, self.volume_at_best_ask, self.next_ask = MAX_ASK, 0, MAX_ASK
 		else:
-			self.bid = self.bids.start.data.price
-			best_bid, vol_bid = self.bids.start.data.price, self.bids.start.data.interest
-			try:
-				next_bid = self.bids.start.next.data.price
-			except:
-				next_bid = MIN_BID
-		best_ask, vol_ask, next_ask = self.bbo.best_ask, self.bbo.volume_at_best_ask, self.bbo.next_ask
-		new_bbo = bbo(best_ask=best_ask, best_bid=best_bid, volume_at_best_bid=vol_bid,
-			volume_at_best_ask=vol_ask, next_bid=next_bid, next_ask=next_ask)
-		if new_bbo != self.bbo:
-			self.bbo = new_bbo
-			return new_bbo
-		#while self.price_q[self.bid].interest == 0 and self.bid > self.min_price:
-		#	self.bid -= self.decrement
+			self.ask, self.volume_at_best_ask = best.data.price, best.data.interest
+			next = best.next
+			self.next_ask = MAX_ASK if next is None else next.data.price
+
+	def publish_bbo(self):
+		'''
+		Compare the live best quotes against the last published BBO.
+
+		returns:
+			a new bbo namedtuple if anything changed since the last publication, otherwise None
+		'''
+		last = self.bbo
+		if (self.bid == last.best_bid and self.ask == last.best_ask 
+				and self.volume_at_best_bid == last.volume_at_best_bid 
+				and self.volume_at_best_ask == last.volume_at_best_ask
+				and self.next_bid == last.next_bid and self.next_ask == last.next_ask):
+			return None
+		self.bbo = bbo(best_bid=self.bid, volume_at_best_bid=self.volume_at_best_bid, 
+			best_ask=self.ask, volume_at_best_ask=self.volume_at_best_ask,
+			next_bid=self.next_bid, next_ask=self.next_ask)
+		return self.bbo
+
+	def update_bbo(self, bid_touched, ask_touched):
+		'''
+		Refresh the touched sides of the book, then publish the BBO. Called once per incoming
+		order or cancel, so a sweep through several levels produces at most one BBO update.
+		'''
+		if bid_touched:
+			self.refresh_bid()
+		if ask_touched:
+			self.refresh_ask()
+		return self.publish_bbo()
+
+	def update_bid(self):
+		return self.update_bbo(bid_touched = True, ask_touched = False)
 
 	def update_ask(self):
-		if self.asks.start is None:
-			self.ask = MAX_ASK
-			best_ask, vol_ask = MAX_ASK, 0
-			next_ask = MAX_ASK
-		else:
-			self.ask = self.asks.start.data.price
-			best_ask, vol_ask = self.asks.start.data.price, self.asks.start.data.interest
-			try:
-				next_ask = self.asks.start.next.data.price
-			except:
-				next_ask = MAX_ASK
-		best_bid, vol_bid, next_bid = self.bbo.best_bid, self.bbo.volume_at_best_bid, self.bbo.next_bid
-		new_bbo = bbo(best_ask=best_ask, best_bid=best_bid, volume_at_best_bid=vol_bid,
-			volume_at_best_ask=vol_ask, next_bid=next_bid, next_ask=next_ask)
-		if new_bbo != self.bbo:
-			self.bbo = new_bbo
-			return new_bbo
-		#while self.price_q[self.ask].interest == 0 and self.ask < self.max_price:
-		#	self.ask += self.decrement		
+		return self.update_bbo(bid_touched = False, ask_touched = True)
 
 	def enter_buy(self, id, price, volume, enter_into_book):
 		'''
@@ -148,75 +217,146 @@ class CDABook:
 		Returns: 
 			A Tuple containing any orders that were traded, the order entered in the book, new best buy/sell offer 
 		'''
-		order_crosses=[]
+		order_crosses = []
+		entered_order = self._match_buy(id, price, volume, enter_into_book, order_crosses)
+		bbo_update = self.update_bbo(bid_touched = entered_order is not None, ask_touched = len(order_crosses) > 0)
+		return (order_crosses, entered_order, bbo_update) 
+
+	def enter_sell(self, id, price, volume, enter_into_book):
+		'''
+		Enter a limit order to sell at price price: first try and fulfill as much as possible, then enter the
+		remaining as a limit sell
+
+		Args:
+			id: order_token of the order to enter into the book
+			price: An int representing the price of the book
+			volume: An int representing the amount of shares in the order
+			enter_into_book: A bool representing whether to store the order in the book
+
+		Returns: 
+			A Tuple containing any orders that were traded, the order entered in the book, new best buy/sell offer 
+		'''
+		order_crosses = []
+		entered_order = self._match_sell(id, price, volume, enter_into_book, order_crosses)
+		bbo_update = self.update_bbo(bid_touched = len(order_crosses) > 0, ask_touched = entered_order is not None)
+		return (order_crosses, entered_order, bbo_update) 
+
+	def rest_order(self, orders, id, price, volume):
+		'''Add an order to the level at price of the ladder orders, and to the order index.'''
+		level = orders[price]
+		level.add_order(id, volume)
+		self.order_index[id] = (orders, level)
+
+	def fill_level(self, price_q, id, volume, order_crosses):
+		'''
+		Fill up to volume shares for the incoming order id from the level price_q, appending the crosses
+		to order_crosses and dropping fully filled orders from the order index. Returns the volume filled.
+		'''
+		(filled, fulfilling_orders) = price_q.fill_order(volume)
+		order_q = price_q.order_q
+		for (fulfilling_order_id, cross_volume) in fulfilling_orders:
+			order_crosses.append(((id, fulfilling_order_id), price_q.price, cross_volume))
+			if fulfilling_order_id not in order_q:
+				del self.order_index[fulfilling_order_id]
+		return filled
+
+	def _match_buy(self, id, price, volume, enter_into_book, order_crosses):
+		'''
+		Match a buy against the asks and rest the remainder, appending crosses to order_crosses.
+		The BBO is left for the caller to update. Returns the entered order or None.
+		'''
 		entered_order = None
-		bbo_update = None
 		volume_to_fill = volume
 		if price >= self.ask:
 			for price_q in self.asks.ascending_items():
 				if price_q.price > price:
 					break
 				
-				(filled, fulfilling_orders) = price_q.fill_order(volume_to_fill)
-				for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-					order_crosses.append(((id, fulfilling_order_id), price_q.price, cross_volume))
-					volume_to_fill -= cross_volume
+				volume_to_fill -= self.fill_level(price_q, id, volume_to_fill, order_crosses)
 				
 				if price_q.interest==0:
 					self.asks.remove(price_q.price)
-				bbo_update = self.update_ask()
 
 				if volume_to_fill <= 0:
 					break					
 
-
 		if volume_to_fill > 0 and enter_into_book:
-			self.bids[price].add_order(id, volume_to_fill)
-			bbo_update = self.update_bid()
+			self.rest_order(self.bids, id, price, volume_to_fill)
 			entered_order = (id, price, volume_to_fill)
-		return (order_crosses, entered_order, bbo_update) 
+		return entered_order
 
-	def enter_sell(self, id, price, volume, enter_into_book):
+	def _match_sell(self, id, price, volume, enter_into_book, order_crosses):
 		'''
-		Enter a limit order to sell at price price: first try and fulfill as much as possible, then enter the
-		remaining as a limit sell
-
-		Args:
-			id: order_token of the order to enter into the book
-			price: An int representing the price of the book
-			volume: An int representing the amount of shares in the order
-			enter_into_book: A bool representing whether to store the order in the book
-
-		Returns: 
-			A Tuple containing any orders that were traded, the order entered in the book, new best buy/sell offer 
+		Match a sell against the bids and rest the remainder, appending crosses to order_crosses.
+		The BBO is left for the caller to update. Returns the entered order or None.
 		'''
-		order_crosses=[]
 		entered_order = None
-		bbo_update = None
 		volume_to_fill = volume
 		if price <= self.bid:
 			for price_q in self.bids.ascending_items():
 				if price_q.price < price:
 					break
 				
-				(filled, fulfilling_orders) = price_q.fill_order(volume_to_fill)
-				for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-					order_crosses.append(((id, fulfilling_order_id), price_q.price, cross_volume))
-					volume_to_fill -= cross_volume
+				volume_to_fill -= self.fill_level(price_q, id, volume_to_fill, order_crosses)
 				
 				if price_q.interest==0:
 					self.bids.remove(price_q.price)
-				bbo_update = self.update_bid()
 
 				if volume_to_fill <= 0:
 					break					
 			
 		if volume_to_fill > 0 and enter_into_book:
-			self.asks[price].add_order(id, volume_to_fill)
-			bbo_update = self.update_ask()
+			self.rest_order(self.asks, id, price, volume_to_fill)
 			entered_order = (id, price, volume_to_fill)
+		return entered_order
 
-		return (order_crosses, entered_order, bbo_update) 
+	def enter_many(self, orders):
+		'''
+		Enter a batch of limit orders in one pass, in order, publishing the BBO once at the end.
+		The exchange does not batch yet: it enters every client order through enter_buy/enter_sell.
+
+		Args:
+			orders: iterable of (id, buy_sell_indicator, price, volume, enter_into_book) tuples, with the
+				same meaning as the arguments of enter_buy/enter_sell. Subclasses taking extra arguments
+				(IEXBook's midpoint_peg) expect them appended to the tuple.
+		Returns:
+			a batch_result holding the crosses and the entered orders column by column, and the final
+			BBO update (None if unchanged)
+		'''
+		order_crosses = []
+		entered_ids = []
+		entered_prices = []
+		entered_volumes = []
+		for (id, buy_sell_indicator, price, volume, enter_into_book, *extra) in orders:
+			crosses_before = len(order_crosses)
+			# keep best bid/ask current for the next order's matching, without publishing
+			if buy_sell_indicator == b'B':
+				entered_order = self._match_buy(id, price, volume, enter_into_book, order_crosses, *extra)
+				if entered_order is not None:
+					self.refresh_bid()
+				if len(order_crosses) > crosses_before:
+					self.refresh_ask()
+			else:
+				entered_order = self._match_sell(id, price, volume, enter_into_book, order_crosses, *extra)
+				if entered_order is not None:
+					self.refresh_ask()
+				if len(order_crosses) > crosses_before:
+					self.refresh_bid()
+			if entered_order:
+				entered_ids.append(entered_order[0])
+				entered_prices.append(entered_order[1])
+				entered_volumes.append(entered_order[2])
+		taker_ids = []
+		maker_ids = []
+		cross_prices = []
+		cross_volumes = []
+		for ((taker_id, maker_id), price, volume) in order_crosses:
+			taker_ids.append(taker_id)
+			maker_ids.append(maker_id)
+			cross_prices.append(price)
+			cross_volumes.append(volume)
+		return batch_result(taker_ids, maker_ids, cross_prices, cross_volumes,
+			entered_ids, entered_prices, entered_volumes, self.publish_bbo())
 
 def test():
 	book = CDABook()
@@ -1,6 +1,9 @@
 from exchange.order_books.fba_book_price_q import FBABookPriceQ
 from exchange.order_books.list_elements import SortedIndexedDefaultList
 import heapq
+import random
+import numpy as np
+import json
 import math
 import logging as log
 from itertools import count
@@ -50,15 +53,180 @@ def merge(ait, bit, key):
                 yield from ait 
                 return
 
+def merge_clearing_price(asks, bids):
+    """
+    Clearing price of a batch, or None if it can not clear: walks the levels of both sides from the
+    highest price down (asks first at equal prices), until their cumulated interest exceeds the
+    asks' total interest.
+    """
+    asks_volume = sum([price_book.interest for price_book in asks.ascending_items()])
+    log.debug('total volume offered in batch: %d', asks_volume)
+    all_orders_descending = merge(
+        asks.descending_items(),
+        bids.ascending_items(), 
+        key= lambda bpq: -bpq.price)
+    debug = log.getLogger().isEnabledFor(log.DEBUG)
+    if debug:
+        log.debug('ask prices=%s:%s, \n bid prices=%s:%s', 
+            [(p.price, p.interest) for p in asks.ascending_items()],
+            [(p.price, p.interest) for p in asks.descending_items()], 
+            [(p.price, p.interest) for p in bids.ascending_items()],
+            [(p.price, p.interest) for p in bids.descending_items()])
+        assert len([p.price for p in asks.descending_items()])==len([p.price for p in asks.ascending_items()]) 
+    orders_volume = prior_orders_volume = 0
+    clearing_price=None
+    log.debug('calculating clearing price..')
+    bpq=prior_bpq=None
+
+    min_real_price = None
+    max_real_price = None
+
+    if debug:
+        log.debug('all orders descending: %s', [(b.price,b.interest) for b in merge(
+            asks.descending_items(),
+            bids.ascending_items(), 
+            key= lambda bpq: -bpq.price)])
+    
+    for bpq in all_orders_descending:
+        #update min/max prices
+        if MIN_BID<bpq.price<MAX_ASK:
+            if max_real_price is None or max_real_price < bpq.price:
+                max_real_price = bpq.price
+            if min_real_price is None or bpq.price<min_real_price:
+                min_real_price = bpq.price
+        #process and deal with volumes
+        prior_orders_volume = orders_volume
+        orders_volume += bpq.interest
+        log.debug('  checking price %s, vol %s/%s', bpq.price, orders_volume, asks_volume)
+        if orders_volume > asks_volume:
+            break
+        prior_bpq=bpq
+
+    #if bpq.price is still at MAX_ASK, loop until price is less than max_ask and use that price
+    if bpq is not None and bpq.price==MAX_ASK:
+        for bpq in all_orders_descending:
+            if max_real_price is None or max_real_price<bpq.price<MAX_ASK:
+                max_real_price = bpq.price
+            if min_real_price is None or MIN_BID<bpq.price<min_real_price:
+                min_real_price = bpq.price
+            log.debug(' looping until price <%s: current price:%s', MAX_ASK, bpq.price)
+            if bpq.price<MAX_ASK:
+                break
+
+    #If prior_orders_volume exactly hit asks and loop was able to continue, price is averaged, otherwise its the first price that pushed over limit.
+    if max_real_price is None and min_real_price is None:
+        clearing_price = None #no real prices - can't match if all bids/offers are market orders
+    elif prior_orders_volume==asks_volume and prior_bpq is not None:
+        if prior_bpq.price==MAX_ASK and MIN_BID<bpq.price<MAX_ASK:
+            clearing_price=bpq.price
+            log.debug(' clearing price set as bpq: %s -> %s', bpq.price, clearing_price)
+        elif prior_bpq.price<MAX_ASK and MIN_BID<bpq.price:
+            clearing_price = math.ceil((prior_bpq.price+bpq.price)/2)
+            log.debug(' clearing price is the average of %s and %s -> %s', prior_bpq.price, bpq.price, clearing_price)
+        elif MIN_BID<prior_bpq.price<MAX_ASK and MIN_BID==bpq.price:
+            clearing_price=prior_bpq.price
+            log.debug(' clearing price set as prior bpq: %s -> %s', prior_bpq.price, clearing_price)
+        elif prior_bpq.price==MIN_BID:
+            clearing_price=min_real_price
+            log.debug(' clearing price set as min real price: %s', clearing_price)
+    elif orders_volume>asks_volume:
+        clearing_price = max(bpq.price, min_real_price)
+        log.debug(' clearing price set as max of bpq and min real price: %s:%s -> %s', bpq.price, min_real_price, clearing_price)
+    return clearing_price
+
+
+def numpy_clearing_price(asks, bids):
+    """
+    Same clearing price as merge_clearing_price, from the level prices and interests copied into
+    arrays: the walk down the levels is a cumsum, and where it stops a searchsorted.
+    """
+    levels = list(asks.descending_items())
+    ask_count = len(levels)
+    levels.extend(bids.ascending_items())
+    count = len(levels)
+    if not count:
+        return None
+    level_prices = np.fromiter((bpq.price for bpq in levels), dtype=np.int64, count=count)
+    interests = np.fromiter((bpq.interest for bpq in levels), dtype=np.int64, count=count)
+    asks_volume = int(interests[:ask_count].sum())
+    # both sides are already sorted by descending price: a stable sort merges them, asks first on ties
+    order = np.argsort(-level_prices, kind='stable')
+    prices = level_prices[order]
+    cumulated = np.cumsum(interests[order])
+    # the first level whose cumulated interest exceeds the asks'
+    stop = int(np.searchsorted(cumulated, asks_volume, side='right'))
+    if stop < count:
+        index, prior_index = stop, stop - 1
+    else:
+        # never exceeded: the walk ends on the last level
+        index = prior_index = count - 1
+    orders_volume = int(cumulated[index])
+    prior_orders_volume = int(cumulated[index - 1]) if index > 0 else 0
+
+    # real prices among the levels walked are a prefix of the descending order, bar the bounds
+    real = np.flatnonzero((prices[:index + 1] > MIN_BID) & (prices[:index + 1] < MAX_ASK))
+    max_real_price = int(prices[real[0]]) if len(real) else None
+    min_real_price = int(prices[real[-1]]) if len(real) else None
+
+    price = int(prices[index])
+    #if the walk stopped at MAX_ASK, go on until a price less than max_ask and use that price
+    if price == MAX_ASK:
+        for next_index in range(stop + 1, count):
+            price = int(prices[next_index])
+            if max_real_price is None or max_real_price < price < MAX_ASK:
+                max_real_price = price
+            if min_real_price is None or MIN_BID < price < min_real_price:
+                min_real_price = price
+            if price < MAX_ASK:
+                break
+    prior_price = int(prices[prior_index]) if prior_index >= 0 else None
+
+    clearing_price = None
+    if max_real_price is None and min_real_price is None:
+        clearing_price = None #no real prices - can't match if all bids/offers are market orders
+    elif prior_orders_volume == asks_volume and prior_price is not None:
+        if prior_price == MAX_ASK and MIN_BID < price < MAX_ASK:
+            clearing_price = price
+        elif prior_price < MAX_ASK and MIN_BID < price:
+            clearing_price = math.ceil((prior_price + price) / 2)
+        elif MIN_BID < prior_price < MAX_ASK and MIN_BID == price:
+            clearing_price = prior_price
+        elif prior_price == MIN_BID:
+            clearing_price = min_real_price
+    elif orders_volume > asks_volume:
+        clearing_price = max(price, min_real_price)
+    return clearing_price
+
+
+# clearing price engines of an FBABook, by name
+CLEARING_ENGINES = {
+    'merge': merge_clearing_price,
+    'numpy': numpy_clearing_price,
+}
+
 class FBABook:
-    def __init__(self):
-        self.bids = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-                            initializer = lambda p: FBABookPriceQ(p),
+    def __init__(self, ladder = SortedIndexedDefaultList, price_q = FBABookPriceQ, clearing = numpy_clearing_price,
+                 seed = None):
+        '''
+        clearing: function of (asks, bids) giving the clearing price of a batch, see CLEARING_ENGINES
+        seed: seed of the random priority given to the orders of a batch at a price, for reproducible auctions
+        '''
+        self.ladder = ladder
+        self.price_q = price_q
+        self.clearing = clearing
+        self.seed = seed
+        self.rng = random.Random(seed)
+        # levels with orders entered in the current batch, shuffled when it is auctioned (a dict used as an ordered set)
+        self.open_levels = {}
+        self.bids = ladder(index_func = lambda bq: bq.price, 
+                            initializer = price_q,
                             index_multiplier = -1)
-        self.asks = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-                            initializer = lambda p: FBABookPriceQ(p))
+        self.asks = ladder(index_func = lambda bq: bq.price, 
+                            initializer = price_q)
         self.batch_counter = count(1, 1)
         self.batch_number = 1
+        # order id -> (ladder, level) of every resting order, so cancels go straight to the order
+        self.order_index = {}
 
     def __str__(self):
         return """
@@ -68,8 +236,11 @@ class FBABook:
   Asks:
 {}""".format(self.bids, self.asks)
 
+    def as_json(self):
+        return json.dumps({"bids": self.bids.as_dict(), "asks" : self.asks.as_dict()})
+
     def reset_book(self):						#jason
-        self.__init__()     # I can't see anything wrong with this
+        self.__init__(ladder = self.ladder, price_q = self.price_q, clearing = self.clearing, seed = self.seed)     # I can't see anything wrong with this
         # log.debug('Clearing All Entries from Order Book')
         # self.bid = MIN_BID
         # self.ask = MAX_ASK
@@ -78,6 +249,10 @@ class FBABook:
         # for id in list(self.bids.index):
         #             self.bids.remove(id)
 
+    def valid_price(self, price):
+        '''Whether an order at price can rest in the book, i.e. the price ladder accepts it.'''
+        return self.bids.valid_price(price)
+
     @property
     def bbo(self):
         best_bid = self.bids.start.data.price if self.bids.start else MIN_BID
@@ -99,27 +274,29 @@ class FBABook:
         return best_bid, best_ask, next_bid, next_ask, volume_at_best_bid, volume_at_best_ask
 
 
-    def cancel_order(self, id, price, volume, buy_sell_indicator):
+    def cancel_order(self, id, price = None, volume = 0, buy_sell_indicator = None):
         '''
         Cancel all or part of an order. Volume refers to the desired remaining shares to be executed: if it is 0, the order is
         fully cancelled, otherwise an order of volume volume remains.
+        price and buy_sell_indicator are unused, the order index locates the order.
         '''
-        orders = self.bids if buy_sell_indicator == b'B' else self.asks
-        
-        if price not in orders or id not in orders[price].order_q:
+        handle = self.order_index.get(id)
+        if handle is None:
             log.debug('No order in the book to cancel, cancel ignored.')
             return [], None
         else:
+            (orders, level) = handle
             amount_canceled = 0
-            current_volume, _ = orders[price].order_q[id]
+            current_volume, _ = level.order_q[id]
             if volume == 0:
                 current_batch_number = self.batch_number
-                orders[price].cancel_order(id, current_batch_number)
+                level.cancel_order(id, current_batch_number)
+                del self.order_index[id]
                 amount_canceled = current_volume
-                if orders[price].interest == 0:
-                    orders.remove(price)
+                if level.interest == 0:
+                    orders.remove(level.price)
             elif volume < current_volume:
-                orders[price].reduce_order(id, volume)      
+                level.reduce_order(id, volume)      
                 amount_canceled = current_volume - volume
             else:
                 amount_canceled = 0
@@ -132,7 +309,10 @@ class FBABook:
         '''
         if enter_into_book:
             current_batch_number = self.batch_number
-            self.bids[price].add_order(id, volume, current_batch_number)
+            level = self.bids[price]
+            level.add_order(id, volume, current_batch_number, self.rng)
+            self.open_levels[level] = None
+            self.order_index[id] = (self.bids, level)
             entered_order = (id, price, volume)
             return ([], entered_order, None)
         else:
@@ -144,7 +324,10 @@ class FBABook:
         '''
         if enter_into_book:
             current_batch_number = self.batch_number
-            self.asks[price].add_order(id, volume, current_batch_number)
+            level = self.asks[price]
+            level.add_order(id, volume, current_batch_number, self.rng)
+            self.open_levels[level] = None
+            self.order_index[id] = (self.asks, level)
             entered_order = (id, price, volume)
             return ([], entered_order, None) 
         else:
@@ -152,80 +335,12 @@ class FBABook:
 
     def batch_process(self):
         log.debug('Running batch auction..')
-        log.debug('order book=%s', self)
-        asks_volume = sum([price_book.interest for price_book in self.asks.ascending_items()])
-        log.debug('total volume offered in batch: %d', asks_volume)
-        all_orders_descending = merge(
-            self.asks.descending_items(),
-            self.bids.ascending_items(), 
-            key= lambda bpq: -bpq.price)
-        log.debug('ask prices=%s:%s, \n bid prices=%s:%s', 
-            [(p.price, p.interest) for p in self.asks.ascending_items()],
-            [(p.price, p.interest) for p in self.asks.descending_items()], 
-            [(p.price, p.interest) for p in self.bids.ascending_items()],
-            [(p.price, p.interest) for p in self.bids.descending_items()])
-        assert len([p.price for p in self.asks.descending_items()])==len([p.price for p in self.asks.ascending_items()]) 
-        orders_volume = prior_orders_volume = 0
-        clearing_price=None
-        log.debug('calculating clearing price..')
-        bpq=prior_bpq=None
-
-        min_real_price = None
-        max_real_price = None
-
-        log.debug('all orders descending: %s', [(b.price,b.interest) for b in merge(
-            self.asks.descending_items(),
-            self.bids.ascending_items(), 
-            key= lambda bpq: -bpq.price)])
-        
-        for bpq in all_orders_descending:
-            #update min/max prices
-            if MIN_BID<bpq.price<MAX_ASK:
-                if max_real_price is None or max_real_price < bpq.price:
-                    max_real_price = bpq.price
-                if min_real_price is None or bpq.price<min_real_price:
-                    min_real_price = bpq.price
-            #process and deal with volumes
-            prior_orders_volume = orders_volume
-            orders_volume += bpq.interest
-            log.debug('  checking price %s, vol %s/%s', bpq.price, orders_volume, asks_volume)
-            if orders_volume > asks_volume:
-                break
-            prior_bpq=bpq
-
-        #if bpq.price is still at MAX_ASK, loop until price is less than max_ask and use that price
-        if bpq is not None and bpq.price==MAX_ASK:
-            for bpq in all_orders_descending:
-                if max_real_price is None or max_real_price<bpq.price<MAX_ASK:
-                    max_real_price = bpq.price
-                if min_real_price is None or MIN_BID<bpq.price<min_real_price:
-                    min_real_price = bpq.price
-                log.debug(' looping until price <%s: current price:%s', MAX_ASK, bpq.price)
-                if bpq.price<MAX_ASK:
-                    break
-
-        #If prior_orders_volume exactly hit asks and loop was able to continue, price is averaged, otherwise its the first price that pushed over limit.
-        if max_real_price is None and min_real_price is None:
-            clearing_price = None #no real prices - can't match if all bids/offers are market orders
-        elif prior_orders_volume==asks_volume and prior_bpq is not None:
-            if prior_bpq.price==MAX_ASK and MIN_BID<bpq.price<MAX_ASK:
-                clearing_price=bpq.price
-                log.debug(' clearing price set as bpq: {} -> {}'.format(bpq.price, clearing_price))
-            elif prior_bpq.price<MAX_ASK and MIN_BID<bpq.price:
-                clearing_price = math.ceil((prior_bpq.price+bpq.price)/2)
-                log.debug(' clearing price is the average of {} and {} -> {}'.format(prior_bpq.price, bpq.price, clearing_price))
-            elif MIN_BID<prior_bpq.price<MAX_ASK and MIN_BID==bpq.price:
-                clearing_price=prior_bpq.price
-                log.debug(' clearing price set as prior bpq: {} -> {}'.format(prior_bpq.price, clearing_price))
-            elif prior_bpq.price==MIN_BID:
-                clearing_price=min_real_price
-                log.debug(' clearing price set as min real price: {}'.format(clearing_price))
-        elif orders_volume>asks_volume:
-            clearing_price = max(bpq.price, min_real_price)
-            log.debug(' clearing price set as max of bpq and min real price: {}:{} -> {}'.format(bpq.price, min_real_price, clearing_price))
-
-
-
+        for level in self.open_levels:
+            level.close_batch(self.rng)
+        self.open_levels.clear()
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug('order book=%s', self)
+        clearing_price = self.clearing(self.asks, self.bids)
         log.debug('market clears @ %s', clearing_price)
 
         matches = []
@@ -234,46 +349,50 @@ class FBABook:
             try:
                 ask_node = next(ask_it)
                 ask_price = ask_node.price
-                log.debug('check ask node:{}'.format(ask_node))
+                log.debug('check ask node:%s', ask_node)
                 #iterate over bids starting with highest
                 for bid_node in self.bids.ascending_items():
-                    log.debug('   check bid node:{}'.format(bid_node))
+                    log.debug('   check bid node:%s', bid_node)
                     bid_price = bid_node.price
-                    log.debug('bid price {}, ask price {}, clearing price {}'.format(bid_price, ask_price, clearing_price))
+                    log.debug('bid price %s, ask price %s, clearing price %s', bid_price, ask_price, clearing_price)
                     if bid_price<clearing_price or ask_price>clearing_price:
-                        log.debug('no cross at {}'.format(ask_price))
+                        log.debug('no cross at %s', ask_price)
                         break
                     else:
                         for (bid_id, (volume, _)) in list(bid_node.order_q.items()):
                             volume_filled = 0
-                            log.debug('      process bid {} with volume {}.'.format(bid_id, volume))
+                            log.debug('      process bid %s with volume %s.', bid_id, volume)
                             while volume_filled < volume and ask_price <= clearing_price:
                                 (filled, fulfilling_orders) = ask_node.fill_order(volume-volume_filled)
                                 volume_filled += filled
+                                for (ask_id, _) in fulfilling_orders:
+                                    if ask_id not in ask_node.order_q:
+                                        del self.order_index[ask_id]
                                 matches.extend([((bid_id, ask_id), clearing_price, volume) for (ask_id, (volume, _)) in fulfilling_orders])
-                                log.debug('      all matching orders at node {}'.format(matches))
+                                log.debug('      all matching orders at node %s', matches)
                                 if ask_node.interest == 0:
                                     log.debug('   no more interest at ask node, removing...')
                                     self.asks.remove(ask_price) 
                                 if volume_filled < volume:
-                                    log.debug('      bid is filled only partially {}/{}.'.format(volume_filled, volume))
+                                    log.debug('      bid is filled only partially %s/%s.', volume_filled, volume)
                                     try: 
                                         ask_node = next(ask_it)
                                         ask_price = ask_node.price
                                     except StopIteration as e:
-                                        log.debug(' stopped iteration at {}'.format(ask_price)) 
+                                        log.debug(' stopped iteration at %s', ask_price) 
                                         break
                             #update bid in book
                             assert volume_filled<=volume
                             if volume_filled==volume:
-                                log.debug('      bid {} is filled completely {}/{}.'.format(bid_id, volume_filled, volume))
+                                log.debug('      bid %s is filled completely %s/%s.', bid_id, volume_filled, volume)
                                 current_batch_number = self.batch_number
                                 bid_node.cancel_order(bid_id, current_batch_number)
+                                del self.order_index[bid_id]
                                 if bid_node.interest == 0:
                                     log.debug('    no more interest at bid node, removing...')
                                     self.bids.remove(bid_node.price)
                             elif volume_filled >0:
-                                log.debug('     reducing {} out of {}, bid id: {}'.format(volume_filled, volume, bid_id))
+                                log.debug('     reducing %s out of %s, bid id: %s', volume_filled, volume, bid_id)
                                 bid_node.reduce_order(bid_id, volume - volume_filled)
             except StopIteration:
                 pass
@@ -1,38 +1,44 @@
 from exchange.order_books.book_price_q import BookPriceQ   
-from random import randint
+from exchange.order_books.array_price_q import ArrayBookPriceQ, COMPACT_MIN_TOMBSTONES
+import random
 from itertools import count
 import logging as log
 
 class FBABookPriceQ(BookPriceQ):
+    """
+    BookPriceQ of an FBA book. Orders of earlier batches keep their priority, the orders entered
+    in the current batch are appended after them, and close_batch gives those a random priority
+    among themselves with one shuffle when the batch is auctioned.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.current_batch_number = 0
-        self.batch_marker = 0
-    
-    def add_order(self, order_id, volume, order_batch_number):
+        # live orders entered in the current batch, in order of entry (a dict used as an ordered set)
+        self.batch = {}
+
+    def add_order(self, order_id, volume, order_batch_number, rng = random):
+        if self.current_batch_number != order_batch_number:
+            self.close_batch(rng)
+            self.current_batch_number = order_batch_number
         self.interest += volume
         self.order_q[order_id] = (volume, order_batch_number)
-        if self.current_batch_number == order_batch_number:
-            batch_start_index = self.batch_marker
-            batch_end_index = len(self.order_q) - 1
-            random_index = randint(batch_start_index, batch_end_index)
-            rest_of_batch = list(self.order_q.keys())[random_index : -1]
-            if rest_of_batch:
-                for o in rest_of_batch:
-                    self.order_q.move_to_end(o)
-        else:
-            self.order_q[order_id] = (volume, order_batch_number)
-            self.batch_marker = len(self.order_q) - 1
-            self.current_batch_number = order_batch_number
-        
-    def cancel_order(self, order_id, live_batch_number):
-        volume, order_batch_number = self.order_q[order_id]
+        self.batch[order_id] = None
+
+    def close_batch(self, rng = random):
+        """Shuffle the orders of the current batch, which are the last ones of order_q"""
+        if self.batch:
+            batch = list(self.batch)
+            self.batch.clear()
+            rng.shuffle(batch)
+            for order_id in batch:
+                self.order_q.move_to_end(order_id)
+
+    def cancel_order(self, order_id, live_batch_number = None):
+        volume, _ = self.order_q.pop(order_id)
         self.interest -= volume
-        del self.order_q[order_id]
-        if order_batch_number != live_batch_number:
-            self.batch_marker -= 1      
-    
+        self.batch.pop(order_id, None)
+
     def reduce_order(self, order_id, new_volume):
         volume, _ = self.order_q[order_id]
         assert new_volume <= volume
@@ -48,11 +54,100 @@ class FBABookPriceQ(BookPriceQ):
             if next_order_volume > volume_to_fill:
                 assert self.order_q[next_order_id][0] == next_order_volume
                 self.order_q[next_order_id] = (next_order_volume - volume_to_fill, _)
-                fulfilling_orders.append((next_order_id, volume_to_fill))
+                # same (id, (volume, batch number)) shape as a whole order
+                fulfilling_orders.append((next_order_id, (volume_to_fill, _)))
                 self.interest -= volume_to_fill	
                 volume_to_fill = 0			
             else:
                 volume_to_fill -= next_order_volume
                 fulfilling_orders.append(self.order_q.popitem(last=False))
                 self.interest -= next_order_volume
+                self.batch.pop(next_order_id, None)
         return (volume - volume_to_fill, fulfilling_orders)
+
+
+class ArrayFBABookPriceQ(ArrayBookPriceQ):
+    """
+    Drop-in replacement for FBABookPriceQ on top of ArrayBookPriceQ. Orders of the current
+    batch are appended like any other, and close_batch shuffles them over the slots they hold.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []       #batch number of each order, parallel to ids
+        self.current_batch_number = 0
+        self.batch = {}         #live orders of the current batch, in order of entry
+
+    def entry(self, i):
+        return (self.volumes[i], self.batches[i])
+
+    def add_order(self, order_id, volume, order_batch_number, rng = random):
+        if self.current_batch_number != order_batch_number:
+            self.close_batch(rng)
+            self.current_batch_number = order_batch_number
+        super().add_order(order_id, volume)
+        self.batches.append(order_batch_number)
+        self.batch[order_id] = None
+
+    def close_batch(self, rng = random):
+        """Shuffle the orders of the current batch among the slots they hold"""
+        if self.batch:
+            batch = list(self.batch)
+            self.batch.clear()
+            slots = self.slots
+            # orders were appended, so the slots of the batch are ascending in order of entry
+            positions = [slots[order_id] for order_id in batch]
+            entries = {order_id: (self.volumes[i], self.batches[i]) for (order_id, i) in zip(batch, positions)}
+            rng.shuffle(batch)
+            for (order_id, i) in zip(batch, positions):
+                self.ids[i] = order_id
+                (self.volumes[i], self.batches[i]) = entries[order_id]
+                slots[order_id] = i
+
+    def cancel_order(self, order_id, live_batch_number = None):
+        self.batch.pop(order_id, None)
+        super().cancel_order(order_id)
+
+    def fill_order(self, volume):
+        volume_to_fill = volume
+        fulfilling_orders = []
+        ids = self.ids
+        volumes = self.volumes
+        head = self.head
+        end = len(ids)
+        while volume_to_fill > 0 and head < end:
+            next_order_id = ids[head]
+            if next_order_id is None:
+                head += 1
+                continue
+            next_order_volume = volumes[head]
+            if next_order_volume > volume_to_fill:
+                volumes[head] = next_order_volume - volume_to_fill
+                fulfilling_orders.append((next_order_id, (volume_to_fill, self.batches[head])))
+                self.interest -= volume_to_fill
+                volume_to_fill = 0
+            else:
+                volume_to_fill -= next_order_volume
+                fulfilling_orders.append((next_order_id, (next_order_volume, self.batches[head])))
+                self.interest -= next_order_volume
+                del self.slots[next_order_id]
+                self.batch.pop(next_order_id, None)
+                ids[head] = None
+                head += 1
+        self.head = head
+        if 2 * head >= end and head >= COMPACT_MIN_TOMBSTONES or not self.slots:
+            self.compact()
+        return (volume - volume_to_fill, fulfilling_orders)
+
+    def compact(self):
+        batches = self.batches
+        live = super().compact()
+        self.batches = [batches[i] for i in live]
+        return live
+
+
+# price level queues selectable by FBABook, keyed by their command line name
+FBA_PRICE_QUEUES = {
+    'ordered': FBABookPriceQ,
+    'array': ArrayFBABookPriceQ,
+}
@@ -4,8 +4,8 @@ from .cda_book import CDABook, bbo
 
 class IEXBook(CDABook):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
         self.peg_price = None
         self.pegged_bids = OrderedDict()
@@ -59,6 +59,13 @@ Peg Price: ${}
         else:
             return super().cancel_order(order_id, price, volume, buy_sell_indicator)
     
+    def _cancel_order(self, order_id, price, volume, buy_sell_indicator, midpoint_peg = False):
+        if midpoint_peg:
+            cancelled_orders, _ = self.cancel_pegged_order(order_id, volume, buy_sell_indicator)
+            return cancelled_orders[0][1] if cancelled_orders else None
+        else:
+            return super()._cancel_order(order_id, price, volume, buy_sell_indicator)
+
     def cancel_pegged_order(self, order_id, volume, buy_sell_indicator):
         order_queue = self.pegged_bids if buy_sell_indicator == b'B' else self.pegged_asks
         if order_id not in order_queue:
@@ -80,15 +87,24 @@ Peg Price: ${}
         Enter a limit order to buy at price price: first, try and fulfill as much as possible, then enter if required
         '''
         order_crosses = []
+        entered_order = self._match_buy(order_id, price, volume, enter_into_book, order_crosses, midpoint_peg)
+        # crosses with pegged orders and pegged entries leave the lit book untouched, refreshing it anyway is harmless
+        bbo_update = self.update_bbo(bid_touched = bool(entered_order), ask_touched = len(order_crosses) > 0)
+        return (order_crosses, entered_order, bbo_update) 
+
+    def _match_buy(self, order_id, price, volume, enter_into_book, order_crosses, midpoint_peg = False):
+        '''
+        Match a buy against pegged and lit orders and enter the remainder, appending crosses to order_crosses.
+        The BBO is left for the caller to update. Returns the entered order, or () if a pegged order is dropped.
+        '''
         entered_order = None
-        bbo_update = None
 
         if midpoint_peg and not self.peg_price:
             log.warn('pegged order entered before peg price is set, dropping order')
-            return ([], (), None)
+            return ()
         # if this order is pegged and its start price isn't aggressive, just drop it
         if midpoint_peg and price < self.peg_price: 
-            return ([], (), None)
+            return ()
 
         # if this order is pegged and it is aggressive enough, use peg point as the price
         if midpoint_peg:
@@ -118,17 +134,10 @@ Peg Price: ${}
             if price_q.price > effective_price:
                 break
             
-            (filled, fulfilling_orders) = price_q.fill_order(volume_to_fill)
-
-            for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-                order_crosses.append(((order_id, fulfilling_order_id), price_q.price, cross_volume))
-                volume_to_fill -= cross_volume
+            volume_to_fill -= self.fill_level(price_q, order_id, volume_to_fill, order_crosses)
             
             if price_q.interest==0:
                 self.asks.remove(price_q.price)
-                new_bbo = self.update_ask()
-                if new_bbo:
-                    bbo_update = new_bbo
 
             if volume_to_fill <= 0:
                 break                    
@@ -137,28 +146,34 @@ Peg Price: ${}
             if midpoint_peg:
                 self.pegged_bids[order_id] = volume_to_fill
             else:
-                self.bids[price].add_order(order_id, volume_to_fill)
-                new_bbo = self.update_bid()
-                if new_bbo:
-                    bbo_update = new_bbo
+                self.rest_order(self.bids, order_id, price, volume_to_fill)
             entered_order = (order_id, effective_price, volume_to_fill)
 
-        return (order_crosses, entered_order, bbo_update) 
+        return entered_order
 
     def enter_sell(self, order_id, price, volume, enter_into_book, midpoint_peg):
         '''
         Enter a limit order to sell at price price: first, try and fulfill as much as possible, then enter if required
         '''
         order_crosses = []
+        entered_order = self._match_sell(order_id, price, volume, enter_into_book, order_crosses, midpoint_peg)
+        # crosses with pegged orders and pegged entries leave the lit book untouched, refreshing it anyway is harmless
+        bbo_update = self.update_bbo(bid_touched = len(order_crosses) > 0, ask_touched = bool(entered_order))
+        return (order_crosses, entered_order, bbo_update) 
+
+    def _match_sell(self, order_id, price, volume, enter_into_book, order_crosses, midpoint_peg = False):
+        '''
+        Match a sell against pegged and lit orders and enter the remainder, appending crosses to order_crosses.
+        The BBO is left for the caller to update. Returns the entered order, or () if a pegged order is dropped.
+        '''
         entered_order = None
-        bbo_update = None
 
         if midpoint_peg and not self.peg_price:
             log.warn('pegged order entered before peg price is set, dropping order')
-            return ([], (), None)
+            return ()
         # if this order is pegged and its start price isn't aggressive, just drop it
         if midpoint_peg and price > self.peg_price: 
-            return ([], (), None)
+            return ()
 
         # if this order is pegged and it is aggressive enough, use peg point as the price
         if midpoint_peg:
@@ -189,17 +204,10 @@ Peg Price: ${}
             if price_q.price < effective_price:
                 break
             
-            (filled, fulfilling_orders) = price_q.fill_order(volume_to_fill)
-
-            for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-                order_crosses.append(((order_id, fulfilling_order_id), price_q.price, cross_volume))
-                volume_to_fill -= cross_volume
+            volume_to_fill -= self.fill_level(price_q, order_id, volume_to_fill, order_crosses)
             
             if price_q.interest==0:
                 self.bids.remove(price_q.price)
-                new_bbo = self.update_bid()
-                if new_bbo:
-                    bbo_update = new_bbo
 
             if volume_to_fill <= 0:
                 break                    
@@ -208,13 +216,10 @@ Peg Price: ${}
             if midpoint_peg:
                 self.pegged_asks[order_id] = volume_to_fill
             else:
-                self.asks[price].add_order(order_id, volume_to_fill)
-                new_bbo = self.update_ask()
-                if new_bbo:
-                    bbo_update = new_bbo
+                self.rest_order(self.asks, order_id, price, volume_to_fill)
             entered_order = (order_id, effective_price, volume_to_fill)
 
-        return (order_crosses, entered_order, bbo_update) 
+        return entered_order
     
     # check whether any pegged bids have crossed with non-pegged asks
     # and return crosses/new bbo if they have
@@ -228,9 +233,7 @@ Peg Price: ${}
                 break
 
             for (pegged_order_id, pegged_order_volume) in list(self.pegged_bids.items()):
-                (filled, fulfilling_orders) = price_q.fill_order(pegged_order_volume)
-                for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-                    order_crosses.append(((pegged_order_id, fulfilling_order_id), price_q.price, cross_volume))
+                filled = self.fill_level(price_q, pegged_order_id, pegged_order_volume, order_crosses)
 
                 self.pegged_bids[pegged_order_id] -= filled
                 # if filling this order used all the peg's volume, remove the peg
@@ -257,9 +260,7 @@ Peg Price: ${}
                 break
 
             for (pegged_order_id, pegged_order_volume) in list(self.pegged_asks.items()):
-                (filled, fulfilling_orders) = price_q.fill_order(pegged_order_volume)
-                for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-                    order_crosses.append(((pegged_order_id, fulfilling_order_id), price_q.price, cross_volume))
+                filled = self.fill_level(price_q, pegged_order_id, pegged_order_volume, order_crosses)
 
                 self.pegged_asks[pegged_order_id] -= filled
                 # if filling this order used all the peg's volume, remove the peg
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from bisect import bisect_left
 import logging as log
 from .book_price_q import BookPriceQ
 
@@ -72,6 +73,9 @@ class SortedIndexedDefaultList:
 	def __contains__(self, index):
 		return index in self.index
 
+	def valid_price(self, index):
+		return True
+
 	def __getitem__(self, index):
 		if index not in self.index:
 			return self.insert(self.initializer(index))
@@ -112,3 +116,200 @@ class SortedIndexedDefaultList:
 		while current is not None:
 			yield current.data
 			current = current.prev
+
+
+class BisectIndexedDefaultList(SortedIndexedDefaultList):
+	'''
+	Same linked list and index as SortedIndexedDefaultList, but it also keeps the nodes in a
+	sorted array so the insertion point is found by binary search instead of walking from the start.
+	Delete: O(log n) search + O(n) memmove
+	Insert: O(log n) search + O(n) memmove
+	Read: : O(1)
+
+	The linked nodes are kept so that start/end, .next/.prev and the item iterators behave
+	exactly like SortedIndexedDefaultList.
+	'''
+	def __init__(self, index_func, initializer, index_multiplier = 1):
+		super().__init__(index_func, initializer, index_multiplier)
+		self.keys = []	#index_multiplier * id, ascending
+		self.nodes = []	#nodes in the same order as keys
+
+	def insert(self, data):
+		id = self.index_func(data)
+		if id in self.index:
+			raise KeyError
+		n = Node(data = data)
+		self.index[id] = n
+		key = self.index_multiplier*id
+		position = bisect_left(self.keys, key)
+		prev = self.nodes[position - 1] if position > 0 else None
+		next = self.nodes[position] if position < len(self.nodes) else None
+		self.keys.insert(position, key)
+		self.nodes.insert(position, n)
+
+		n.prev = prev
+		n.next = next
+		if prev is None:
+			self.start = n
+		else:
+			prev.next = n
+		if next is None:
+			self.end = n
+		else:
+			next.prev = n
+		return n.data
+
+	def remove(self, index):
+		if index in self.index:
+			position = bisect_left(self.keys, self.index_multiplier*index)
+			del self.keys[position]
+			del self.nodes[position]
+		super().remove(index)
+
+
+class LadderCursor:
+	'''
+	Node-like view of an occupied level of a TickIndexedLadder so that code written against
+	SortedIndexedDefaultList.start (.data, .next, .prev) keeps working.
+	'''
+	__slots__ = ('ladder', 'slot')
+
+	def __init__(self, ladder, slot):
+		self.ladder = ladder
+		self.slot = slot
+
+	def __repr__(self):
+		return '<cursor  price:{}>'.format(self.data.price)
+
+	@property
+	def data(self):
+		return self.ladder.levels[self.slot]
+
+	@property
+	def next(self):
+		return self.ladder._cursor(self.ladder._following(self.slot))
+
+	@property
+	def prev(self):
+		return self.ladder._cursor(self.ladder._preceding(self.slot))
+
+class TickIndexedLadder:
+	'''
+	Price ladder for a bounded price band. Levels live in a preallocated array indexed by
+	(price - min_price) // tick, next to a byte map of the non-empty levels and a cursor on the best level.
+	Delete: O(1), plus a memchr scan of the byte map when the best level empties
+	Insert: O(1)
+	Read: : O(1)
+
+	Same interface as SortedIndexedDefaultList. Prices outside [min_price, max_price] or off the
+	tick grid are rejected with a ValueError; valid_price can be used to check them beforehand.
+	The band has no default: the ladder allocates a slot for every tick of it.
+	'''
+	def __init__(self, index_func, initializer, min_price, max_price, index_multiplier = 1, tick = 1):
+		if tick <= 0 or max_price < min_price:
+			raise ValueError('invalid price band [{}, {}] with tick {}'.format(min_price, max_price, tick))
+		self.index_func = index_func
+		self.index_multiplier = index_multiplier
+		self.initializer = initializer
+		self.min_price = min_price
+		self.max_price = max_price
+		self.tick = tick
+		size = (max_price - min_price) // tick + 1
+		self.levels = [None] * size
+		self.occupied = bytearray(size)
+		self.best = -1		#slot of the best level, -1 if the ladder is empty
+		self.count = 0
+
+	def __str__(self):
+		return ',\n'.join([str(i) for i in self.ascending_items()])
+	
+	def as_dict(self):
+		return [x.as_dict() for x in self.ascending_items()]
+
+	def valid_price(self, price):
+		offset = price - self.min_price
+		return 0 <= offset and price <= self.max_price and offset % self.tick == 0
+
+	def _slot(self, price):
+		if not self.valid_price(price):
+			raise ValueError('price {} is outside of the ladder band [{}, {}] or off tick {}'.format(
+				price, self.min_price, self.max_price, self.tick))
+		return (price - self.min_price) // self.tick
+
+	def _following(self, slot):
+		if self.index_multiplier > 0:
+			return self.occupied.find(1, slot + 1)
+		else:
+			return self.occupied.rfind(1, 0, slot)
+
+	def _preceding(self, slot):
+		if self.index_multiplier > 0:
+			return self.occupied.rfind(1, 0, slot)
+		else:
+			return self.occupied.find(1, slot + 1)
+
+	def _cursor(self, slot):
+		return None if slot < 0 else LadderCursor(self, slot)
+
+	@property
+	def start(self):
+		return self._cursor(self.best)
+
+	@property
+	def end(self):
+		return self._cursor(self.occupied.rfind(1) if self.index_multiplier > 0 else self.occupied.find(1))
+
+	def insert(self, data):
+		slot = self._slot(self.index_func(data))
+		if self.occupied[slot]:
+			raise KeyError
+		self.levels[slot] = data
+		self.occupied[slot] = 1
+		self.count += 1
+		if self.best < 0 or self.index_multiplier*slot < self.index_multiplier*self.best:
+			self.best = slot
+		return data
+
+	def __contains__(self, price):
+		return self.valid_price(price) and self.occupied[(price - self.min_price) // self.tick] == 1
+
+	def __getitem__(self, price):
+		slot = self._slot(price)
+		if self.occupied[slot]:
+			return self.levels[slot]
+		else:
+			return self.insert(self.initializer(price))
+
+	def __len__(self):
+		return self.count
+
+	def remove(self, price):
+		if price not in self:
+			log.debug('level at {} already removed'.format(price))
+			return
+		slot = (price - self.min_price) // self.tick
+		self.levels[slot] = None
+		self.occupied[slot] = 0
+		self.count -= 1
+		if slot == self.best:
+			self.best = self._following(slot)
+
+	def ascending_items(self):
+		slot = self.best
+		while slot >= 0:
+			yield self.levels[slot]
+			slot = self._following(slot)
+
+	def descending_items(self):
+		cursor = self.end
+		slot = -1 if cursor is None else cursor.slot
+		while slot >= 0:
+			yield self.levels[slot]
+			slot = self._preceding(slot)
+
+
+# price ladder backends selectable by the order books, keyed by their command line name
+PRICE_LADDERS = {
+	'linked': SortedIndexedDefaultList,
+	'bisect': BisectIndexedDefaultList,
+}
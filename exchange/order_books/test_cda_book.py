@@ -0,0 +1,107 @@
+import unittest
+from exchange.order_books.cda_book import CDABook, MIN_BID, MAX_ASK
+
+class TestCDABook(unittest.TestCase):
+
+    def test_sweep_publishes_final_bbo_once(self):
+        book = CDABook()
+        for (id, price) in enumerate((10, 11, 12, 13), start=1):
+            book.enter_sell(id, price, 2, True)
+        book.enter_buy(5, 5, 4, True)
+
+        # sweeps three levels and rests the remainder at 12
+        (crossed_orders, entered_order, new_bbo) = book.enter_buy(6, 12, 7, True)
+        self.assertEqual([price for (_, price, _) in crossed_orders], [10, 11, 12])
+        self.assertEqual(entered_order, (6, 12, 1))
+        self.assertEqual(new_bbo.best_bid, 12)
+        self.assertEqual(new_bbo.volume_at_best_bid, 1)
+        self.assertEqual(new_bbo.next_bid, 5)
+        self.assertEqual(new_bbo.best_ask, 13)
+        self.assertEqual(new_bbo.volume_at_best_ask, 2)
+        self.assertEqual(new_bbo.next_ask, MAX_ASK)
+        self.assertIs(book.bbo, new_bbo)
+
+    def test_unchanged_bbo_is_not_published(self):
+        book = CDABook()
+        book.enter_buy(1, 10, 2, True)
+        (_, _, new_bbo) = book.enter_buy(2, 8, 2, True)
+        self.assertEqual(new_bbo.next_bid, 8)
+        # a level behind next_bid does not change the BBO
+        (_, _, new_bbo) = book.enter_buy(3, 7, 2, True)
+        self.assertIsNone(new_bbo)
+        (_, new_bbo) = book.cancel_order(3, 7, 0, b'B')
+        self.assertIsNone(new_bbo)
+        # removing the next level does
+        (_, new_bbo) = book.cancel_order(2, 8, 0, b'B')
+        self.assertEqual(new_bbo.next_bid, MIN_BID)
+
+    def test_partial_fill_updates_volume_at_best(self):
+        book = CDABook()
+        book.enter_sell(1, 10, 5, True)
+        (crossed_orders, entered_order, new_bbo) = book.enter_buy(2, 10, 2, True)
+        self.assertEqual(crossed_orders, [((2, 1), 10, 2)])
+        self.assertIsNone(entered_order)
+        self.assertEqual((new_bbo.best_ask, new_bbo.volume_at_best_ask), (10, 3))
+
+    def test_enter_many_matches_one_by_one(self):
+        orders = [(1, b'S', 10, 2, True), (2, b'S', 11, 3, True), (3, b'B', 9, 4, True),
+                  (4, b'B', 11, 4, True), (5, b'S', 8, 6, True), (6, b'B', 12, 1, False)]
+        single = CDABook()
+        expected_crosses = []
+        expected_entered = []
+        for (id, side, price, volume, enter_into_book) in orders:
+            enter = single.enter_buy if side == b'B' else single.enter_sell
+            (crossed_orders, entered_order, _) = enter(id, price, volume, enter_into_book)
+            expected_crosses.extend(crossed_orders)
+            if entered_order:
+                expected_entered.append(entered_order)
+
+        batched = CDABook()
+        result = batched.enter_many(orders)
+        self.assertEqual(list(zip(zip(result.taker_ids, result.maker_ids), result.cross_prices, result.cross_volumes)),
+                         expected_crosses)
+        self.assertEqual(list(zip(result.entered_ids, result.entered_prices, result.entered_volumes)),
+                         expected_entered)
+        self.assertEqual(result.bbo, single.bbo)
+        self.assertEqual(str(batched), str(single))
+
+    def test_cancel_many(self):
+        book = CDABook()
+        book.enter_many([(1, b'B', 10, 2, True), (2, b'B', 9, 2, True), (3, b'S', 12, 5, True)])
+        result = book.cancel_many([(1, 10, 0, b'B'), (7, 10, 0, b'B'), (3, 12, 1, b'S')])
+        self.assertEqual(result.canceled_ids, [1, 3])
+        self.assertEqual(result.canceled_volumes, [2, 4])
+        self.assertEqual((result.bbo.best_bid, result.bbo.best_ask, result.bbo.volume_at_best_ask), (9, 12, 1))
+        self.assertIsNone(book.cancel_many([]).bbo)
+
+    def test_cancel_many_takes_the_side_from_the_book(self):
+        book = CDABook()
+        book.enter_many([(1, b'B', 10, 2, True), (2, b'B', 9, 2, True), (3, b'S', 12, 5, True)])
+        # no side, or the wrong one, given by the caller
+        result = book.cancel_many([(1, None, 0, None), (3, None, 0, b'B')])
+        self.assertEqual((result.bbo.best_bid, result.bbo.best_ask), (9, MAX_ASK))
+        self.assertEqual((book.bid, book.volume_at_best_bid), (9, 2))
+
+    def test_order_index(self):
+        book = CDABook()
+        book.enter_buy(1, 10, 5, True)
+        book.enter_buy(2, 10, 2, True)
+        book.enter_buy(3, 9, 2, True)
+        self.assertEqual(set(book.order_index), {1, 2, 3})
+        # reduce and cancel by id alone
+        self.assertEqual(book.cancel_order(1, volume=3)[0], [(1, 2)])
+        self.assertEqual(book.bids[10].order_q[1], 3)
+        (cancelled_orders, new_bbo) = book.cancel_order(3)
+        self.assertEqual(cancelled_orders, [(3, 2)])
+        self.assertNotIn(9, book.bids)
+        self.assertEqual(new_bbo.next_bid, MIN_BID)
+        # fully filled orders leave the index, partially filled ones stay
+        book.enter_sell(4, 10, 4, True)
+        self.assertEqual(set(book.order_index), {2})
+        self.assertEqual(book.cancel_order(1), ([], None))
+        self.assertNotIn(7, book.bids)
+        book.cancel_order(2)
+        self.assertEqual((book.order_index, len(book.bids)), ({}, 0))
+
+if __name__ == '__main__':
+    unittest.main()
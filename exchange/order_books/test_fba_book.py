@@ -0,0 +1,66 @@
+import random
+import unittest
+from exchange.order_books.fba_book import FBABook, merge_clearing_price, numpy_clearing_price, MIN_BID, MAX_ASK
+from exchange.order_books.fba_book_price_q import FBA_PRICE_QUEUES
+from exchange.order_books.list_elements import BisectIndexedDefaultList
+
+
+def random_book(rng, orders, prices, clearing = numpy_clearing_price, seed = None):
+    book = FBABook(clearing = clearing, seed = seed)
+    for order_id in range(orders):
+        price = rng.choice(prices)
+        volume = rng.randint(1, 10)
+        if rng.random() < 0.5:
+            book.enter_buy(order_id, price, volume, True)
+        else:
+            book.enter_sell(order_id, price, volume, True)
+    return book
+
+
+class TestFBAClearing(unittest.TestCase):
+
+    def test_engines_agree_on_random_books(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            # few prices, so levels of both sides often share a price; market orders at the bounds
+            prices = rng.sample(range(1, 20), rng.randint(1, 6)) + rng.choice([[], [MIN_BID], [MAX_ASK], [MIN_BID, MAX_ASK]])
+            book = random_book(rng, rng.randint(0, 12), prices)
+            self.assertEqual(numpy_clearing_price(book.asks, book.bids), merge_clearing_price(book.asks, book.bids),
+                             msg = str(book))
+
+    def test_engines_give_the_same_batches(self):
+        results = []
+        for clearing in (merge_clearing_price, numpy_clearing_price):
+            book = random_book(random.Random(5), 500, list(range(90, 111)), clearing, seed = 3)
+            results.append(book.batch_process())
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(results[0][0])
+
+    def test_one_sided_and_empty_books(self):
+        book = FBABook()
+        self.assertIsNone(book.clearing(book.asks, book.bids))
+        self.assertEqual(book.batch_process(), ([], 0))
+        book.enter_buy(1, 10, 5, True)
+        self.assertEqual(book.batch_process(), ([], 10))
+
+    def test_seeded_batches_are_reproducible(self):
+        results = []
+        for price_q in FBA_PRICE_QUEUES.values():
+            for _ in range(2):
+                book = FBABook(price_q = price_q, seed = 11)
+                for order_id in range(40):
+                    book.enter_buy(order_id, 10, 1, True)
+                book.enter_sell(100, 10, 25, True)
+                results.append(book.batch_process())
+        self.assertTrue(all(result == results[0] for result in results))
+        # 25 of the 40 bids are filled, not the first 25 entered
+        self.assertNotEqual([bid_id for ((bid_id, _), _, _) in results[0][0]], list(range(25)))
+
+    def test_reset_keeps_the_engine(self):
+        book = FBABook(ladder = BisectIndexedDefaultList, clearing = merge_clearing_price)
+        book.reset_book()
+        self.assertIs(book.clearing, merge_clearing_price)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,5 @@
 import unittest
-from iex_book import IEXBook
+from exchange.order_books.iex_book import IEXBook
 
 class TestIEXBook(unittest.TestCase):
 
@@ -303,5 +303,24 @@ class TestIEXBook(unittest.TestCase):
         self.assertEqual(len(book.pegged_asks), 0)
 
 
+    def test_enter_and_cancel_many(self):
+        book = IEXBook()
+        book.update_peg_price(9)
+        result = book.enter_many([
+            (1, b'B', 10, 2, True, False),
+            (2, b'S', 2, 1, True, True),
+            (3, b'S', 12, 3, True, False),
+            (4, b'B', 11, 1, True, True),
+        ])
+        self.assertEqual(list(zip(result.taker_ids, result.maker_ids, result.cross_prices)), [(2, 1, 10)])
+        self.assertEqual(result.entered_ids, [1, 3, 4])
+        self.assertEqual(result.entered_prices, [10, 12, 9])
+        self.assertEqual((result.bbo.best_bid, result.bbo.volume_at_best_bid, result.bbo.best_ask), (10, 1, 12))
+
+        result = book.cancel_many([(4, 9, 0, b'B', True), (3, 12, 0, b'S', False)])
+        self.assertEqual(result.canceled_ids, [4, 3])
+        self.assertEqual(len(book.pegged_bids), 0)
+        self.assertEqual(result.bbo.best_ask, 2147483647)
+
 if __name__ == '__main__':
     unittest.main()
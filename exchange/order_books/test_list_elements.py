@@ -0,0 +1,100 @@
+import random
+import unittest
+from functools import partial
+from exchange.order_books.book_price_q import BookPriceQ
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.iex_book import IEXBook
+from exchange.order_books.list_elements import PRICE_LADDERS, TickIndexedLadder
+
+LADDERS = list(PRICE_LADDERS.values()) + [partial(TickIndexedLadder, min_price = 0, max_price = 400)]
+
+def make_ladder(ladder_cls, index_multiplier = 1):
+    return ladder_cls(index_func = lambda bq: bq.price,
+                      initializer = lambda p: BookPriceQ(p),
+                      index_multiplier = index_multiplier)
+
+class TestPriceLadders(unittest.TestCase):
+
+    def test_backends_keep_same_order(self):
+        rng = random.Random(7)
+        operations = [(rng.random() < 0.3, rng.randint(1, 300)) for _ in range(2000)]
+        for index_multiplier in (1, -1):
+            ladders = [make_ladder(cls, index_multiplier) for cls in LADDERS]
+            for ladder in ladders:
+                for (remove, price) in operations:
+                    if remove:
+                        ladder.remove(price)
+                    else:
+                        ladder[price]
+            expected = [bq.price for bq in ladders[0].ascending_items()]
+            self.assertEqual(expected, sorted(expected, key = lambda p: index_multiplier * p))
+            for ladder in ladders[1:]:
+                self.assertEqual([bq.price for bq in ladder.ascending_items()], expected)
+                self.assertEqual([bq.price for bq in ladder.descending_items()], expected[::-1])
+                self.assertEqual(ladder.start.data.price, expected[0])
+                self.assertEqual(ladder.end.data.price, expected[-1])
+
+    def test_remove_missing_level_is_ignored(self):
+        for cls in LADDERS:
+            ladder = make_ladder(cls)
+            ladder[10]
+            ladder.remove(11)
+            ladder.remove(10)
+            ladder.remove(10)
+            self.assertEqual(len(ladder), 0)
+            self.assertIsNone(ladder.start)
+            self.assertIsNone(ladder.end)
+
+    def test_books_match_on_every_backend(self):
+        for book_cls in (CDABook, IEXBook):
+            for ladder in LADDERS:
+                book = book_cls(ladder = ladder)
+                extra = {'midpoint_peg': False} if book_cls is IEXBook else {}
+                book.enter_buy(1, 10, 2, True, **extra)
+                book.enter_buy(2, 11, 3, True, **extra)
+                book.enter_buy(4, 9, 1, True, **extra)
+                (crossed_orders, entered_order, new_bbo) = book.enter_sell(3, 8, 6, True, **extra)
+                self.assertEqual(crossed_orders, [((3, 2), 11, 3), ((3, 1), 10, 2), ((3, 4), 9, 1)])
+                self.assertIsNone(entered_order)
+                self.assertEqual(book.bid, 0)
+                book.reset_book()
+                self.assertIs(book.ladder, ladder)
+
+    def test_tick_ladder_band(self):
+        ladder = make_ladder(partial(TickIndexedLadder, min_price = 100, max_price = 200, tick = 5), -1)
+        self.assertTrue(ladder.valid_price(105))
+        self.assertFalse(ladder.valid_price(95))
+        self.assertFalse(ladder.valid_price(205))
+        self.assertFalse(ladder.valid_price(103))
+        self.assertNotIn(95, ladder)
+        with self.assertRaises(ValueError):
+            ladder[103]
+        ladder[150]
+        ladder[200]
+        ladder[100]
+        self.assertEqual(ladder.start.data.price, 200)
+        self.assertEqual(ladder.start.next.data.price, 150)
+        self.assertIsNone(ladder.start.next.next.next)
+        ladder.remove(200)
+        self.assertEqual(ladder.start.data.price, 150)
+        self.assertEqual(ladder.end.data.price, 100)
+        self.assertEqual(ladder.end.prev.data.price, 150)
+        # the band is preallocated, it must be given
+        with self.assertRaises(TypeError):
+            make_ladder(TickIndexedLadder)
+
+    def test_book_price_band(self):
+        book = CDABook(ladder = partial(TickIndexedLadder, min_price = 100, max_price = 200))
+        self.assertTrue(book.valid_price(150))
+        self.assertFalse(book.valid_price(201))
+        self.assertTrue(CDABook().valid_price(201))
+        book.enter_sell(1, 120, 5, True)
+        (crossed_orders, entered_order, new_bbo) = book.enter_buy(2, 130, 2, True)
+        self.assertEqual(crossed_orders, [((2, 1), 120, 2)])
+        self.assertEqual(new_bbo.best_ask, 120)
+        self.assertEqual(new_bbo.volume_at_best_ask, 3)
+        book.cancel_order(1, 120, 0, b'S')
+        self.assertEqual(book.ask, 2147483647)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import random
+import unittest
+from exchange.order_books.array_price_q import ArrayBookPriceQ, COMPACT_MIN_TOMBSTONES
+from exchange.order_books.book_price_q import BookPriceQ
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.fba_book import FBABook
+from exchange.order_books.fba_book_price_q import ArrayFBABookPriceQ, FBA_PRICE_QUEUES
+
+class TestArrayBookPriceQ(unittest.TestCase):
+
+    def test_matches_ordered_dict_queue(self):
+        rng = random.Random(3)
+        reference = BookPriceQ(10)
+        queue = ArrayBookPriceQ(10)
+        next_id = 0
+        for _ in range(5000):
+            action = rng.random()
+            live = list(reference.order_q)
+            if action < 0.5 or not live:
+                volume = rng.randint(1, 10)
+                reference.add_order(next_id, volume)
+                queue.add_order(next_id, volume)
+                next_id += 1
+            elif action < 0.7:
+                order_id = rng.choice(live)
+                reference.cancel_order(order_id)
+                queue.cancel_order(order_id)
+            elif action < 0.8:
+                order_id = rng.choice(live)
+                new_volume = rng.randint(0, reference.order_q[order_id])
+                reference.reduce_order(order_id, new_volume)
+                queue.reduce_order(order_id, new_volume)
+            else:
+                volume = rng.randint(1, 40)
+                self.assertEqual(queue.fill_order(volume), reference.fill_order(volume))
+            self.assertEqual(queue.interest, reference.interest)
+        self.assertEqual(list(queue.order_q.items()), list(reference.order_q.items()))
+        self.assertEqual(len(queue.order_q), len(reference.order_q))
+
+    def test_compaction_keeps_handles(self):
+        queue = ArrayBookPriceQ(10)
+        for order_id in range(4 * COMPACT_MIN_TOMBSTONES):
+            queue.add_order(order_id, 1)
+        for order_id in range(0, 4 * COMPACT_MIN_TOMBSTONES, 2):
+            queue.cancel_order(order_id)
+        queue.fill_order(COMPACT_MIN_TOMBSTONES // 2)
+        self.assertLess(len(queue.ids), 3 * COMPACT_MIN_TOMBSTONES)
+        for (order_id, volume) in queue.order_q.items():
+            self.assertEqual(queue.ids[queue.slots[order_id]], order_id)
+        queue.fill_order(10**6)
+        self.assertEqual((queue.interest, len(queue.order_q), queue.ids), (0, 0, []))
+
+    def test_cda_book_with_array_queue(self):
+        book = CDABook(price_q = ArrayBookPriceQ)
+        book.enter_buy(1, 10, 2, True)
+        book.enter_buy(2, 10, 3, True)
+        book.cancel_order(1, 10, 0, b'B')
+        (crossed_orders, entered_order, new_bbo) = book.enter_sell(3, 9, 4, True)
+        self.assertEqual(crossed_orders, [((3, 2), 10, 3)])
+        self.assertEqual(entered_order, (3, 9, 1))
+        book.reset_book()
+        self.assertIs(book.price_q, ArrayBookPriceQ)
+
+class TestArrayFBABookPriceQ(unittest.TestCase):
+
+    def test_batches_stay_in_order(self):
+        queue = ArrayFBABookPriceQ(10)
+        for order_id in range(300):
+            queue.add_order(order_id, 1, order_id // 100 + 1)
+            if order_id % 7 == 0:
+                queue.cancel_order(order_id, order_id // 100 + 1)
+        queue.fill_order(20)
+        batches = [batch for (volume, batch) in queue.order_q.values()]
+        self.assertEqual(batches, sorted(batches))
+        self.assertEqual(queue.interest, len(queue.order_q))
+        for order_id in queue.order_q:
+            self.assertEqual(queue.ids[queue.slots[order_id]], order_id)
+        # every id of the live batch is there exactly once
+        self.assertEqual(sorted(o for o in queue.order_q if o >= 200), [o for o in range(200, 300) if o % 7])
+
+    def test_batch_is_shuffled_when_closed(self):
+        orders = {}
+        for (name, queue_cls) in FBA_PRICE_QUEUES.items():
+            queue = queue_cls(10)
+            rng = random.Random(4)
+            for order_id in range(10):
+                queue.add_order(order_id, 1, 1, rng)
+            queue.close_batch(rng)
+            for order_id in range(10, 100):
+                queue.add_order(order_id, 1, 2, rng)
+                if order_id % 3 == 0:
+                    queue.cancel_order(order_id, 2)
+            # the open batch is still in order of entry
+            self.assertEqual(list(queue.order_q)[10:15], [10, 11, 13, 14, 16])
+            queue.close_batch(rng)
+            orders[name] = list(queue.order_q)
+            self.assertEqual(sorted(orders[name][10:]), [o for o in range(10, 100) if o % 3])
+            self.assertNotEqual(orders[name][10:], sorted(orders[name][10:]))
+        # same seed, same priorities whatever the queue
+        self.assertEqual(orders['ordered'], orders['array'])
+
+    def test_every_batch_order_is_equally_likely(self):
+        rng = random.Random(5)
+        for queue_cls in FBA_PRICE_QUEUES.values():
+            permutations = {}
+            for _ in range(3000):
+                queue = queue_cls(10)
+                queue.add_order(0, 1, 1, rng)
+                for order_id in range(1, 5):
+                    queue.add_order(order_id, 1, 2, rng)
+                queue.cancel_order(2, 2)
+                queue.close_batch(rng)
+                permutation = tuple(queue.order_q)
+                permutations[permutation] = permutations.get(permutation, 0) + 1
+            # order 0 of the earlier batch always comes first, the 3! orders of the others are as frequent
+            self.assertEqual(len(permutations), 6)
+            self.assertTrue(all(permutation[0] == 0 for permutation in permutations))
+            self.assertTrue(all(400 < n < 600 for n in permutations.values()), permutations)
+
+    def test_filled_orders_leave_the_batch(self):
+        for queue_cls in FBA_PRICE_QUEUES.values():
+            queue = queue_cls(10)
+            for order_id in range(4):
+                queue.add_order(order_id, 2, 1)
+            self.assertEqual(queue.fill_order(5), (5, [(0, (2, 1)), (1, (2, 1)), (2, (1, 1))]))
+            self.assertEqual(list(queue.batch), [2, 3])
+            queue.close_batch()
+            self.assertEqual(sorted(queue.order_q), [2, 3])
+            self.assertEqual(queue.interest, 3)
+
+    def test_fba_book_with_array_queue(self):
+        book = FBABook(price_q = ArrayFBABookPriceQ)
+        book.enter_buy(1, 12, 2, True)
+        book.enter_sell(2, 10, 2, True)
+        book.enter_sell(3, 11, 5, True)
+        book.cancel_order(3, 11, 0, b'S')
+        (matches, clearing_price) = book.batch_process()
+        self.assertEqual(matches, [((1, 2), clearing_price, 2)])
+
+if __name__ == '__main__':
+    unittest.main()
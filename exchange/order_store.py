@@ -1,17 +1,40 @@
 import logging as log
+from collections import deque
+
+from exchange_logging.event_journal import CLIENT_MESSAGE, SERVER_MESSAGE
+
+# default number of retired order tokens still rejected as a RepeatID
+RECENT_TOKENS = 65536
 
 
 class OrderStore:
 	'''
-	An order store keeps tracks of orders submitted to the exchange and their
-	status.
+	An order store keeps tracks of the live orders submitted to the exchange and
+	their status. An order's entry lives from its EnterOrder (or ReplaceOrder) until
+	the exchange retires it, once it no longer rests in a book: filled, cancelled,
+	replaced or expired.
+
+	Entries are compact records of what the exchange needs to answer for an order,
+	not its messages. If history is given, it is called with (record type, timestamp,
+	message) for every message of every order, the client message that opened it
+	(CLIENT_MESSAGE) and the responses added to it (SERVER_MESSAGE), e.g. to write
+	them to a journal.
+
+	The tokens of the last recent_tokens retired orders stay used: an order reusing
+	one is rejected as a repeat, like one reusing a live order's token. Older tokens
+	can be used again, until then memory only grows with the live orders.
 	'''
 
-	def __init__(self):
+	def __init__(self, history = None, recent_tokens = RECENT_TOKENS):
 		self.orders = dict()
+		self.history = history
+		self.recent_tokens = recent_tokens
+		# retired tokens, oldest first, and the same as a set
+		self.retired = deque()
+		self.retired_tokens = set()
 
 	def __str__(self):
-		return """  
+		return """
   Oderstore:
 {}
 """.format( self.orders)
@@ -25,43 +48,115 @@ class OrderStore:
 	# 	for id in list(self.bids.index):
     #             	self.bids.r
 
-	def store_order(self, id, message, original_enter_message = None, executed_quantity = 0):
+	def token_used(self, id):
+		'''Whether an order token is live, or was retired recently'''
+		return id in self.orders or id in self.retired_tokens
+
+	def store_order(self, id, message, replaced_entry = None, executed_quantity = 0, timestamp = 0):
 		'''
-		Called to create a new order store entry, either with an EnterOrder message, or a replace order message that creates a new order.
+		Called to create a new order store entry, either with an EnterOrder message, or a replace order message that creates a new order
+		in place of the one of replaced_entry.
 
 		Returns true if successful in storing it; false if unsuccesful because the order token is already used.
 		'''
-		if id in self.orders:
-			log.info('Ignoring store_order command: id %s already in the order store', id)
+		if self.token_used(id):
+			log.info('Ignoring store_order command: id %s already used', id)
 			return False
 		else:
-			self.orders[id] = OrderStoreEntry(message, original_enter_message = original_enter_message, executed_quantity = executed_quantity)
+			self.orders[id] = OrderStoreEntry.from_message(message, replaced_entry, executed_quantity)
+			if self.history is not None:
+				self.history(CLIENT_MESSAGE, timestamp, message)
 			return self.orders[id]
 
 	def add_to_order(self, id, message):
 		'''
 		Called to add a message an existing order.
 		'''
-		if id not in self.orders:
+		entry = self.orders.get(id)
+		if entry is None:
 			log.error('Unknown existing order %s', id)
 			return False
 		else:
-			self.orders[id].add_to_order(message)
+			entry.add_to_order(message)
+			if self.history is not None:
+				self.history(SERVER_MESSAGE, message['timestamp'], message)
 
 	def execute_quantity(self, id, quantity):
 		self.orders[id].executed_quantity += quantity
 
-	def clear_order_store(self):				
+	def retire_order(self, id):
+		'''
+		Called once an order is done with, to drop its entry. Its token stays used for the next
+		recent_tokens retirements.
+		'''
+		entry = self.orders.pop(id, None)
+		if entry is not None and self.recent_tokens > 0:
+			self.remember_retired(id)
+		return entry
+
+	def remember_retired(self, id):
+		if len(self.retired) >= self.recent_tokens:
+			self.retired_tokens.discard(self.retired.popleft())
+		self.retired.append(id)
+		self.retired_tokens.add(id)
+
+	def clear_order_store(self):
 		self.orders.clear()
+		self.retired.clear()
+		self.retired_tokens.clear()
 		log.info('orderstore after clear: %s' % str(self.orders))
 
 class OrderStoreEntry:
-	def __init__(self, message,  executed_quantity, original_enter_message = None):
-		self.history = []
+	'''
+	Live order: what its responses need, taken from the message that opened it (price, shares, time in force
+	and the client's meta) and from its EnterOrder (stock, side, firm and midpoint peg flag), which replacements
+	keep.
+	'''
+	__slots__ = ('stock', 'buy_sell_indicator', 'price', 'shares', 'time_in_force', 'firm', 'midpoint_peg',
+				 'meta', 'executed_quantity', 'accepted_at')
+
+	def __init__(self, stock, buy_sell_indicator, price, shares, time_in_force, firm, midpoint_peg, meta,
+				 executed_quantity = 0, accepted_at = None):
+		self.stock = stock
+		self.buy_sell_indicator = buy_sell_indicator
+		self.price = price
+		self.shares = shares
+		self.time_in_force = time_in_force
+		self.firm = firm
+		self.midpoint_peg = midpoint_peg
+		# the client's connection, where responses go
+		self.meta = meta
 		self.executed_quantity = executed_quantity
-		self.first_message = message
-		self.original_enter_message = original_enter_message if original_enter_message is not None else message
-		self.history.append(message)
+		# timestamp of the Accepted (or Replaced) response, when the order's time in force started
+		self.accepted_at = accepted_at
+
+	@classmethod
+	def from_message(cls, message, replaced_entry = None, executed_quantity = 0):
+		'''Entry of an order opened by message, an EnterOrder, or a ReplaceOrder of replaced_entry's order'''
+		if replaced_entry is None:
+			return cls(message['stock'], message['buy_sell_indicator'], message['price'], message['shares'],
+					   message['time_in_force'], message['firm'], message['midpoint_peg'], message.meta,
+					   executed_quantity)
+		return cls(replaced_entry.stock, replaced_entry.buy_sell_indicator, message['price'], message['shares'],
+				   message['time_in_force'], replaced_entry.firm, replaced_entry.midpoint_peg, message.meta,
+				   executed_quantity)
 
 	def add_to_order(self, message):
-		self.history.append(message)
+		if self.accepted_at is None:
+			self.accepted_at = message['timestamp']
+
+	def as_tuple(self):
+		'''Plain values of the entry but its meta, see from_tuple'''
+		return (self.stock, self.buy_sell_indicator, self.price, self.shares, self.time_in_force, self.firm,
+				self.midpoint_peg, self.executed_quantity, self.accepted_at)
+
+	@classmethod
+	def from_tuple(cls, values, meta = None):
+		(stock, buy_sell_indicator, price, shares, time_in_force, firm, midpoint_peg, executed_quantity,
+		 accepted_at) = values
+		return cls(stock, buy_sell_indicator, price, shares, time_in_force, firm, midpoint_peg, meta,
+				   executed_quantity, accepted_at)
+
+	def __repr__(self):
+		return 'OrderStoreEntry({} {} {}@{}, executed_quantity={})'.format(
+			self.stock, self.buy_sell_indicator, self.shares, self.price, self.executed_quantity)
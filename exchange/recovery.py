@@ -0,0 +1,186 @@
+"""Write-ahead log and state snapshots, so a restarted exchange gets back the books and order store
+it had when it stopped.
+
+Every client message an exchange handles (and every order expiry) is appended to the write-ahead log,
+with its timestamp, before it is applied. The log is a sequence of segments, event journals of
+CLIENT_MESSAGE records (see exchange_logging.event_journal), written by a LogWriter thread that fsyncs
+after each write: everything buffered while one fsync runs goes out with the next, one fsync per group.
+Matching never waits for the disk; with wait_commit, responses are only sent once the messages that
+caused them are durable.
+
+Every snapshot_interval seconds the exchange's state (Exchange.snapshot_state) is written to
+snapshot.pickle, and the log moves on to a new segment: the snapshot names the first segment it does
+not cover, and older segments are deleted once it is on disk. Recovery loads the snapshot and
+replays the segments after it, so it takes at most snapshot_interval worth of messages.
+
+Directory layout:
+    snapshot.pickle
+    wal_000001.bin, wal_000002.bin, ...
+"""
+
+import logging as log
+import os
+import pickle
+import re
+import time
+from collections import deque
+
+from exchange_logging import event_journal
+from exchange_logging.exchange_loggers import LogWriter
+
+SNAPSHOT_FILE = 'snapshot.pickle'
+SEGMENT_FILE = 'wal_%06d.bin'
+SEGMENT_PATTERN = re.compile(r'wal_(\d+)\.bin$')
+
+
+class WriteAheadLog:
+    '''
+    Write-ahead log and snapshots of one exchange, kept in a directory. Exchange creates it when
+    given a wal_dir: recover() before the exchange takes messages, then start().
+    '''
+
+    def __init__(self, wal_dir, loop, snapshot_interval = 60, wait_commit = True):
+        '''
+        Args:
+            wal_dir: directory of the log segments and the snapshot, created if missing
+            loop: event loop of the exchange
+            snapshot_interval: seconds between two snapshots
+            wait_commit: whether committed() waits for the fsync of the messages appended so far
+        '''
+        os.makedirs(wal_dir, exist_ok = True)
+        self.wal_dir = wal_dir
+        self.loop = loop
+        self.snapshot_interval = snapshot_interval
+        self.wait_commit = wait_commit
+        self.writer = None
+        self.segment = None
+        self.segment_file = None
+        # messages appended, and durable, since start()
+        self.appended = 0
+        self.durable = 0
+        # (number of messages, future) of the tasks waiting in committed()
+        self.waiters = deque()
+        self.snapshot_handle = None
+        self.snapshot_task = None
+
+    def path(self, name):
+        return os.path.join(self.wal_dir, name)
+
+    def segments(self):
+        '''Numbers of the segments in the directory, ascending'''
+        numbers = []
+        for name in os.listdir(self.wal_dir):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def recover(self, exchange):
+        '''
+        Restore exchange from the snapshot and replay the segments written after it. Call it before the
+        exchange's wal is set, so the replayed messages are not logged again.
+        Returns the number of messages replayed.
+        '''
+        start = time.perf_counter()
+        first_segment = 0
+        snapshot_path = self.path(SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+            first_segment = snapshot['segment']
+            exchange.restore_state(snapshot['state'])
+        replayed = 0
+        for segment in self.segments():
+            if segment < first_segment:
+                continue
+            # a record cut short by the crash ends the segment
+            for (_, timestamp, message) in event_journal.read_journal(
+                    self.path(SEGMENT_FILE % segment), (event_journal.CLIENT_MESSAGE,)):
+                exchange.handle_message(message, timestamp)
+                replayed += 1
+        if replayed or first_segment:
+            log.info('Recovered from %s: snapshot of segment %d, %d messages replayed in %.3fs',
+                     self.wal_dir, first_segment, replayed, time.perf_counter() - start)
+        return replayed
+
+    def start(self, exchange):
+        '''Take a snapshot of the (recovered) exchange, then log to a new segment, snapshotting every snapshot_interval'''
+        self.writer = LogWriter(fsync = True, on_written = self.written)
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self.snapshot(exchange)
+
+    def open_segment(self, segment):
+        '''Direct the messages appended from now on to a new segment, return the file of the previous one'''
+        previous = self.segment_file
+        self.segment = segment
+        self.segment_file = self.writer.open(self.path(SEGMENT_FILE % segment), binary = True)
+        return previous
+
+    def append(self, timestamp, message):
+        '''Log a message about to be applied; the writer thread packs, writes and fsyncs it'''
+        self.writer.put_record(self.segment_file, event_journal.encode_message,
+                               (timestamp, event_journal.CLIENT_MESSAGE, message))
+        self.appended += 1
+
+    def written(self, count):
+        # writer thread: count more messages are on disk
+        self.loop.call_soon_threadsafe(self.commit, count)
+
+    def commit(self, count):
+        self.durable += count
+        while self.waiters and self.waiters[0][0] <= self.durable:
+            future = self.waiters.popleft()[1]
+            if not future.done():
+                future.set_result(None)
+
+    async def committed(self):
+        '''Wait until the messages appended so far are durable (at once without wait_commit)'''
+        if not self.wait_commit or self.durable >= self.appended:
+            return
+        future = self.loop.create_future()
+        self.waiters.append((self.appended, future))
+        await future
+
+    def snapshot(self, exchange):
+        '''
+        Copy the exchange's state and switch segments now, between two messages, then write the snapshot
+        and drop the segments it covers on a worker thread
+        '''
+        if self.snapshot_task is not None and not self.snapshot_task.done():
+            # the last snapshot is still being written, try again later
+            self.snapshot_handle = self.loop.call_later(self.snapshot_interval, self.snapshot, exchange)
+            return
+        state = pickle.dumps({'segment': self.segment + 1, 'state': exchange.snapshot_state()},
+                             protocol = pickle.HIGHEST_PROTOCOL)
+        previous = self.open_segment(self.segment + 1)
+        self.snapshot_task = self.loop.run_in_executor(None, self.write_snapshot, state, previous, self.segment)
+        self.snapshot_handle = self.loop.call_later(self.snapshot_interval, self.snapshot, exchange)
+
+    def write_snapshot(self, state, previous_file, first_segment):
+        '''Worker thread: make the snapshot durable, then delete the segments before first_segment'''
+        temporary_path = self.path(SNAPSHOT_FILE + '.tmp')
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(state)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.path(SNAPSHOT_FILE))
+        directory = os.open(self.wal_dir, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        if previous_file is not None:
+            self.writer.close_file(previous_file)
+        for segment in self.segments():
+            if segment < first_segment:
+                os.remove(self.path(SEGMENT_FILE % segment))
+        log.debug('Snapshot of %s written, %d bytes, log continues in segment %d',
+                  self.wal_dir, len(state), first_segment)
+
+    def close(self):
+        '''Stop snapshotting and write (and fsync) what is buffered'''
+        if self.snapshot_handle is not None:
+            self.snapshot_handle.cancel()
+        if self.writer is not None:
+            self.writer.close()
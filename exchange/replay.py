@@ -0,0 +1,227 @@
+"""Deterministic replay of a recorded session through an Exchange, without sockets.
+
+The client actions of a session (a ClientActionLogger's JSON action log, or the CLIENT_MESSAGE records
+of an event journal) are turned back into OuchClientMessages and fed through Exchange.handle_message
+and publish, each with the timestamp it was logged at. The server messages the exchange broadcasts and
+its final books are the result, so the same log replayed before and after a matching change must give
+the same ReplayResult.digest.
+
+The replay runs as fast as possible, or with speed set, paced so that logged time passes speed times
+faster than real time. Either way the exchange runs on a SimulatedClock set to the logged time of each
+action, so its market logs are timestamped as the recorded ones were, and its timers (time-in-force
+expiries, BBO conflation flushes) fire when the clock passes them. An expiry is in the log as a cancel
+too, which finds the order gone if the replay expired it first; the replay sweeps expiries on its own
+tick grid, so it may expire an order up to a tick before or after the recorded exchange did.
+
+Run from the repository root: python run_replay.py --help
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import time
+
+from OuchServer.clock import SimulatedClock
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from exchange.exchange import Exchange, DEFAULT_STOCK
+from exchange.order_books.cda_book import CDABook
+from exchange_logging import event_journal
+from exchange_logging.exchange_loggers import book_levels, PLACE_LIMIT_ORDER_ACTION, CANCEL_LIMIT_ORDER_ACTION
+
+# the JSON action log keeps the token, stock, side, price, shares and time in force of an order, the rest is filled in
+ENTER_DEFAULTS = dict(firm = b'FIRM', display = b'Y', capacity = b'P',
+    intermarket_sweep_eligibility = b'N', minimum_quantity = 1, cross_type = b'N', customer_type = b' ',
+    midpoint_peg = False)
+
+
+def read_actions(log_filepath):
+    """Load the client actions of a session.
+    Args:
+        log_filepath: a JSON action log, or an event journal
+    Returns:
+        list of (timestamp, OuchClientMessage), in the order the exchange handled them
+    """
+    with open(log_filepath, 'rb') as log_file:
+        is_json = log_file.read(1) == b'{'
+    if not is_json:
+        return [(timestamp, message) for (_, timestamp, message)
+                in event_journal.read_journal(log_filepath, (event_journal.CLIENT_MESSAGE,))]
+    actions = []
+    with open(log_filepath) as log_file:
+        for line in log_file:
+            entry = json.loads(line)
+            action_type = entry["action"]["action_type"]
+            data = entry["action"]["action_data"]
+            if action_type == PLACE_LIMIT_ORDER_ACTION:
+                if "time_in_force" not in data:
+                    raise ValueError('%s records no time in force of its orders, replay the journal of the session '
+                                     'instead' % log_filepath)
+                m = OuchClientMessages.EnterOrder(order_token = data["token"].encode(),
+                    buy_sell_indicator = data["direction"].encode(), shares = data["shares"],
+                    stock = data["stock"].encode(), price = data["price"], time_in_force = data["time_in_force"],
+                    **ENTER_DEFAULTS)
+            elif action_type == CANCEL_LIMIT_ORDER_ACTION:
+                m = OuchClientMessages.CancelOrder(order_token = data["token"].encode(), shares = data["shares"])
+            else:
+                continue
+            m.meta = None
+            actions.append((entry["timestamp"], m))
+    return actions
+
+
+class ReplayTimer:
+    '''Callback scheduled on a ReplayLoop'''
+    __slots__ = ('callback', 'args', 'cancelled')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ReplayLoop:
+    '''The event loop as the replayed exchange sees it: its time is the SimulatedClock's, and its timers
+    wait until replay moves the clock past them, see run_timers
+    '''
+
+    def __init__(self, loop, clock):
+        self.loop = loop
+        self.clock = clock
+        # (timestamp due, sequence number, ReplayTimer), the sequence keeps timers due together in order
+        self.timers = []
+        self.sequence = itertools.count()
+
+    def time(self):
+        return self.clock() / 10**9
+
+    def call_later(self, delay, callback, *args):
+        timer = ReplayTimer(callback, args)
+        heapq.heappush(self.timers, (self.clock() + max(0, round(delay * 10**9)), next(self.sequence), timer))
+        return timer
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def next_timer(self, timestamp):
+        '''Take the next timer due by timestamp: (timestamp due, ReplayTimer), None if there is none'''
+        while self.timers and self.timers[0][0] <= timestamp:
+            (due, _, timer) = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                return (due, timer)
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self.loop, name)
+
+
+class ReplayResult:
+    '''Outcome of a replay
+    Attributes:
+        messages: server messages broadcast by the exchange, in order
+        books: dict of stock -> {"bids": {price: quantity}, "asks": {price: quantity}}
+        events: number of client actions replayed
+        seconds: time taken to replay them
+    '''
+
+    def __init__(self, messages, books, events, seconds):
+        self.messages = messages
+        self.books = books
+        self.events = events
+        self.seconds = seconds
+
+    @property
+    def events_per_second(self):
+        return self.events / self.seconds if self.seconds else 0
+
+    @property
+    def transactions(self):
+        return [m for m in self.messages if m.message_type == OuchServerMessages.Executed]
+
+    def digest(self):
+        '''SHA-256 of the broadcast messages and the final books, equal for equal replays'''
+        h = hashlib.sha256()
+        for m in self.messages:
+            h.update(bytes(m))
+        for stock in sorted(self.books):
+            h.update(json.dumps([stock.decode('ascii', 'replace'), sorted(self.books[stock]["bids"].items()),
+                sorted(self.books[stock]["asks"].items())]).encode())
+        return h.hexdigest()
+
+    def __str__(self):
+        return '%d events in %.3fs (%.0f events/s), %d messages, %d executions, digest %s' % (
+            self.events, self.seconds, self.events_per_second, len(self.messages),
+            len(self.transactions), self.digest()[:16])
+
+
+async def replay(actions, book_factory = CDABook, multi_symbol = False, stock = DEFAULT_STOCK, speed = None,
+                 book_log = 'replay_book_log.txt', transaction_log = 'replay_transaction_log.txt',
+                 action_log = 'replay_action_log.txt', journal_log = 'replay_journal.bin', **exchange_kwargs):
+    """Replay client actions through a new Exchange.
+    Args:
+        actions: list of (timestamp, OuchClientMessage), as read_actions returns
+        book_factory: creates the order book(s)
+        multi_symbol: one book per stock, as the recorded exchange had with a book_factory
+        stock: symbol of the book in single book mode
+        speed: None to replay as fast as possible, else how many times faster than recorded
+        book_log, transaction_log, action_log, journal_log, exchange_kwargs: logging options of the
+            Exchange, which writes its market logs under exchange/market_logs like a live one
+    Returns:
+        ReplayResult
+    """
+    messages = []
+
+    async def order_reply(m):
+        pass
+
+    async def message_broadcast(m):
+        messages.append(m)
+
+    first_timestamp = actions[0][0] if actions else 0
+    clock = SimulatedClock(first_timestamp)
+    loop = ReplayLoop(asyncio.get_running_loop(), clock)
+    exchange = Exchange(order_book = None if multi_symbol else book_factory(), order_reply = order_reply,
+        message_broadcast = message_broadcast, loop = loop,
+        book_factory = book_factory if multi_symbol else None, stock = stock, book_log = book_log,
+        transaction_log = transaction_log, action_log = action_log, journal_log = journal_log, clock = clock,
+        **exchange_kwargs)
+    start = time.perf_counter()
+
+    async def pace(timestamp):
+        if speed is not None:
+            delay = (timestamp - first_timestamp) / 10**9 / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def run_timers(timestamp):
+        """Fire the timers due by timestamp, each at its time"""
+        while True:
+            due = loop.next_timer(timestamp)
+            if due is None:
+                return
+            (due_timestamp, timer) = due
+            clock.set(due_timestamp)
+            await pace(clock())
+            timer.callback(*timer.args)
+            # the callbacks send their messages from tasks, let them run before the next event
+            await asyncio.sleep(0)
+
+    for (timestamp, message) in actions:
+        await run_timers(timestamp)
+        # logs of older sessions timestamp expirations with the time of their order, the clock never steps back
+        clock.set(timestamp)
+        await pace(clock())
+        exchange.handle_message(message, timestamp)
+        await exchange.publish()
+    await run_timers(clock())
+    # BBO updates still held would have gone out at the next flush
+    await exchange.send_conflated_bbos()
+    seconds = time.perf_counter() - start
+    exchange.close()
+    books = {symbol: {"bids": dict(book_levels(book.bids)), "asks": dict(book_levels(book.asks))}
+             for (symbol, book) in exchange.order_books.items()}
+    return ReplayResult(messages, books, len(actions), seconds)
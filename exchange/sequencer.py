@@ -0,0 +1,104 @@
+"""Inbound sequencer: decouples matching from client I/O.
+
+Client reader tasks only push decoded messages onto one ordered queue. A single matching
+coroutine drains the queue in batches and applies each message to the exchange, and a
+separate publisher coroutine sends out the responses matching queued. Every message gets a
+global sequence number in arrival order, the order in which it is matched.
+"""
+
+import asyncio
+import itertools
+import logging as log
+import time
+
+
+class StageDelay:
+    '''Running count, mean and max of the time messages wait before a stage'''
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, delay_ns):
+        self.count += 1
+        self.total_ns += delay_ns
+        if delay_ns > self.max_ns:
+            self.max_ns = delay_ns
+
+    @property
+    def mean_ns(self):
+        return self.total_ns / self.count if self.count else 0
+
+    def __str__(self):
+        return 'n=%d mean=%.1fus max=%.1fus' % (self.count, self.mean_ns / 1000, self.max_ns / 1000)
+
+
+class Sequencer:
+    '''
+    Stage between a ProtocolMessageServer and an exchange: register submit as the server's
+    listener in place of exchange.process_message, then start().
+    '''
+
+    def __init__(self, exchange, max_batch = 1024):
+        '''
+        Args:
+            exchange: Exchange (or subclass) matching the messages, through handle_message and publish
+            max_batch: most messages matched before the publisher gets a turn
+        '''
+        self.exchange = exchange
+        self.max_batch = max_batch
+        # (sequence number, time queued, message)
+        self.inbound = asyncio.Queue()
+        self.sequence_numbers = itertools.count(1)
+        self.last_sequence_number = 0
+        self.publish_ready = asyncio.Event()
+        self.matched_at = None
+        # queued -> matched, and matched -> published
+        self.match_delay = StageDelay()
+        self.publish_delay = StageDelay()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.ensure_future(self.run_matching()),
+                      asyncio.ensure_future(self.run_publisher())]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def submit(self, message):
+        '''Listener for the server: sequence the message and return without matching it'''
+        self.inbound.put_nowait((next(self.sequence_numbers), time.monotonic_ns(), message))
+
+    def take_batch(self, first):
+        batch = [first]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.inbound.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def run_matching(self):
+        while True:
+            batch = self.take_batch(await self.inbound.get())
+            for (sequence_number, queued_at, message) in batch:
+                self.match_delay.record(time.monotonic_ns() - queued_at)
+                self.last_sequence_number = sequence_number
+                self.exchange.handle_message(message)
+            if self.matched_at is None:
+                self.matched_at = time.monotonic_ns()
+            self.publish_ready.set()
+            # let the publisher and the readers run before the next batch
+            await asyncio.sleep(0)
+
+    async def run_publisher(self):
+        while True:
+            await self.publish_ready.wait()
+            self.publish_ready.clear()
+            self.publish_delay.record(time.monotonic_ns() - self.matched_at)
+            self.matched_at = None
+            await self.exchange.publish()
+            log.debug('Published up to message %d; queue delay %s, publish delay %s',
+                      self.last_sequence_number, self.match_delay, self.publish_delay)
@@ -0,0 +1,260 @@
+"""Symbol-sharded exchange: the books are split across worker processes so matching of
+different stocks runs on different cores.
+
+The server process keeps accepting connections and hands every client message to the
+ShardedExchange listener, which sends it to the worker owning the message's stock. Each
+worker runs an ordinary multi-symbol Exchange (or FBAExchange/IEXExchange) on its own
+event loop, and the messages it replies or broadcasts are relayed back to the server.
+Messages of one stock always go through the same worker queue, so they keep their order.
+"""
+
+import asyncio
+import logging as log
+import multiprocessing
+import queue
+import zlib
+from collections import deque
+
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from OuchServer.ouch_server import default_clock
+from exchange.order_store import RECENT_TOKENS
+
+HEADER_SIZE = OuchClientMessages.get_message_class().get_header_class().size
+
+# what a worker wants done with a message it sent out
+REPLY = 0
+BROADCAST = 1
+# not a message: the worker's exchange forgot an order, its token can leave the front end's map
+RETIRED = 2
+
+
+def shard_for(stock, shards):
+    '''
+    Index of the worker owning stock. crc32 rather than hash(), which is salted per process
+    and would move stocks between workers on every restart.
+    '''
+    return zlib.crc32(stock.rstrip(b'\x00 ')) % shards
+
+def decode(message_types, message_bytes, meta):
+    message_type = message_types.lookup_by_header_bytes(message_bytes[:HEADER_SIZE])
+    message = message_type.from_bytes(message_bytes)
+    message.meta = meta
+    return message
+
+
+def run_shard(shard, exchange_class, book_factory, exchange_kwargs, inbox, outbox):
+    '''
+    Worker process body: run a multi-symbol exchange fed by inbox until it yields None.
+    Args:
+        shard: index of the worker, used to keep its market logs apart
+        exchange_class: Exchange or one of its subclasses
+        book_factory: callable creating the order book of a stock
+        exchange_kwargs: extra keyword arguments of exchange_class (e.g. interval, delay)
+        inbox: queue of (message bytes, meta) client messages
+        outbox: queue of (REPLY or BROADCAST, message bytes, meta) server messages, and of
+            (RETIRED, order token, (shard, messages taken from inbox so far)) retirements
+    '''
+    handled = 0
+
+    async def order_reply(m):
+        # every worker answers a SystemStart, the client gets the answer of the first one
+        if shard and m.message_type == OuchServerMessages.SystemEvent:
+            return
+        outbox.put((REPLY, bytes(m), m.meta))
+
+    async def message_broadcast(m):
+        # market data made by the exchange itself (e.g. PostBatch) has no client meta
+        outbox.put((BROADCAST, bytes(m), getattr(m, 'meta', None)))
+
+    def order_retired(order_token):
+        outbox.put((RETIRED, order_token, (shard, handled)))
+
+    async def main():
+        nonlocal handled
+        loop = asyncio.get_running_loop()
+        if exchange_kwargs.get('order_history_log') is not None:
+            exchange_kwargs['order_history_log'] = 'order_history_shard%d.bin' % shard
+        exchange = exchange_class(order_book = None,
+                                  order_reply = order_reply,
+                                  message_broadcast = message_broadcast,
+                                  loop = loop,
+                                  book_factory = book_factory,
+                                  book_log = 'book_log_shard%d.txt' % shard,
+                                  transaction_log = 'transaction_log_shard%d.txt' % shard,
+                                  action_log = 'action_log_shard%d.txt' % shard,
+                                  journal_log = 'journal_shard%d.bin' % shard,
+                                  order_retired = order_retired,
+                                  **exchange_kwargs)
+        if hasattr(exchange, 'start'):
+            exchange.start()
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item is None:
+                # flush what the handlers left queued before the loop goes away
+                await exchange.send_outgoing_broadcast_messages()
+                await exchange.send_conflated_bbos()
+                exchange.close()
+                break
+            message_bytes, meta = item
+            handled += 1
+            await exchange.process_message(decode(OuchClientMessages, message_bytes, meta))
+
+    asyncio.run(main())
+
+
+class ShardedExchange:
+    '''
+    Front end of the worker pool, registered as the ProtocolMessageServer listener in place
+    of an Exchange.
+
+    Cancel and replace messages carry no stock, so the shard of every order token is
+    remembered when its EnterOrder (or ReplaceOrder) is routed, and forgotten when the worker
+    reports the order retired. Messages naming no order at all (SystemStart,
+    ExternalFeedChange) go to every worker.
+
+    Every worker has its own order store, so tokens are checked here: an EnterOrder reusing the
+    token of a live order, or of one of the last recent_tokens retired orders, is rejected as a
+    RepeatID whatever shard its stock belongs to, as a single exchange would.
+    '''
+
+    def __init__(self, shards, exchange_class, book_factory, order_reply, message_broadcast, loop, **exchange_kwargs):
+        '''
+        Args:
+            shards: number of worker processes
+            exchange_class: Exchange class run by every worker
+            book_factory: picklable callable creating the order book of a stock
+            order_reply, message_broadcast: the server's send_server_response/broadcast_server_message
+            exchange_kwargs: extra keyword arguments of exchange_class
+        '''
+        self.shards = shards
+        self.exchange_class = exchange_class
+        self.book_factory = book_factory
+        self.exchange_kwargs = exchange_kwargs
+        self.order_reply = order_reply
+        self.message_broadcast = message_broadcast
+        self.loop = loop
+        # order token -> (shard, number of messages put in the shard's inbox up to the token's order)
+        self.token_shards = {}
+        self.routed = [0] * shards
+        # the window of recently retired tokens of OrderStore, over all shards
+        self.recent_tokens = exchange_kwargs.get('recent_tokens', RECENT_TOKENS)
+        self.retired = deque()
+        self.retired_tokens = set()
+        self.clock = exchange_kwargs.get('clock') or default_clock
+        self.workers = []
+        self.inboxes = []
+        self.outbox = None
+        self.relay_task = None
+
+    def start(self):
+        # spawn: workers must not inherit the server's running event loop
+        context = multiprocessing.get_context('spawn')
+        self.outbox = context.Queue()
+        for shard in range(self.shards):
+            inbox = context.Queue()
+            worker = context.Process(target = run_shard, name = 'exchange-shard-%d' % shard, daemon = True,
+                args = (shard, self.exchange_class, self.book_factory, self.exchange_kwargs, inbox, self.outbox))
+            worker.start()
+            self.inboxes.append(inbox)
+            self.workers.append(worker)
+        self.relay_task = asyncio.ensure_future(self.relay())
+
+    async def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        # the relay keeps draining the outbox meanwhile, a worker can not exit with unsent messages
+        for worker in self.workers:
+            await self.loop.run_in_executor(None, worker.join)
+        self.outbox.put(None)
+        await self.relay_task
+
+    def route(self, message):
+        '''
+        Shards that must see a client message, an empty list if it names an unknown order.
+        '''
+        message_type = message.message_type
+        if message_type == OuchClientMessages.EnterOrder:
+            if self.token_used(message['order_token']):
+                log.info('Order token %s already used, order dropped', message['order_token'])
+                return []
+            shard = shard_for(message['stock'], self.shards)
+            # a token is reusable once it left the window of retired ones, maybe for a stock of another shard
+            self.token_shards[message['order_token']] = (shard, self.routed[shard] + 1)
+        elif message_type == OuchClientMessages.ReplaceOrder:
+            if self.token_used(message['replacement_order_token']):
+                # as the exchange does, a replacement naming a used token is silently ignored
+                log.info('Replacement token %s already used, replace dropped', message['replacement_order_token'])
+                return []
+            shard = self.shard_of(message['existing_order_token'])
+            if shard is not None:
+                self.token_shards[message['replacement_order_token']] = (shard, self.routed[shard] + 1)
+        elif 'order_token' in message:
+            shard = self.shard_of(message['order_token'])
+        else:
+            if message_type == OuchClientMessages.SystemStart:
+                # every worker clears its order store
+                self.token_shards.clear()
+                self.retired.clear()
+                self.retired_tokens.clear()
+            return range(self.shards)
+        if shard is None:
+            log.info('No shard holds the order of %s, message dropped', message)
+            return []
+        return [shard]
+
+    def token_used(self, order_token):
+        '''Whether an order token is live on any shard, or was retired recently'''
+        return order_token in self.token_shards or order_token in self.retired_tokens
+
+    def shard_of(self, order_token):
+        entry = self.token_shards.get(order_token)
+        return None if entry is None else entry[0]
+
+    def order_retired(self, order_token, shard, handled):
+        '''
+        Forget the shard of a token its worker retired after taking handled messages from its inbox, unless
+        the token was routed again since: to another shard, or to the same one after the retiring message.
+        '''
+        entry = self.token_shards.get(order_token)
+        if entry is not None and entry[0] == shard and entry[1] <= handled:
+            del self.token_shards[order_token]
+            if self.recent_tokens > 0:
+                if len(self.retired) >= self.recent_tokens:
+                    self.retired_tokens.discard(self.retired.popleft())
+                self.retired.append(order_token)
+                self.retired_tokens.add(order_token)
+
+    async def process_message(self, message):
+        if message.message_type == OuchClientMessages.EnterOrder and self.token_used(message['order_token']):
+            log.info('Order already stored with id %s, order rejected', message['order_token'])
+            m = OuchServerMessages.Rejected(timestamp = self.clock(), order_token = message['order_token'],
+                reason = b'RepeatID', price = message['price'], shares = message['shares'])
+            m.meta = message.meta
+            await self.order_reply(m)
+            return
+        message_bytes = bytes(message)
+        for shard in self.route(message):
+            self.routed[shard] += 1
+            self.inboxes[shard].put((message_bytes, message.meta))
+
+    async def relay(self):
+        '''Send the messages of all workers on to the clients, in the order the workers produced them'''
+        while True:
+            items = [await self.loop.run_in_executor(None, self.outbox.get)]
+            try:
+                while True:
+                    items.append(self.outbox.get_nowait())
+            except queue.Empty:
+                pass
+            for item in items:
+                if item is None:
+                    return
+                destination, message_bytes, meta = item
+                if destination == RETIRED:
+                    self.order_retired(message_bytes, *meta)
+                    continue
+                m = decode(OuchServerMessages, message_bytes, meta)
+                if destination == REPLY:
+                    await self.order_reply(m)
+                else:
+                    await self.message_broadcast(m)
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from exchange.exchange import Exchange
+from exchange.fba_exchange import FBAExchange
+from exchange.iex_exchange import IEXExchange
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.fba_book import FBABook
+from exchange.order_books.iex_book import IEXBook
+from exchange.sequencer import Sequencer
+from exchange_logging.exchange_loggers import read_book_deltas, journal_to_json
+from exchange_logging import event_journal
+
+
+def enter_order(token, buy_sell_indicator, price, shares, stock, time_in_force = 99999):
+    m = OuchClientMessages.EnterOrder(
+        order_token = token.ljust(32).encode(), buy_sell_indicator = buy_sell_indicator,
+        shares = shares, stock = stock, price = price, time_in_force = time_in_force,
+        firm = b'FIRM', display = b'Y', capacity = b'P', intermarket_sweep_eligibility = b'N',
+        minimum_quantity = 1, cross_type = b'N', customer_type = b' ', midpoint_peg = False)
+    m.meta = None
+    return m
+
+def cancel_order(token):
+    m = OuchClientMessages.CancelOrder(order_token = token.ljust(32).encode(), shares = 0)
+    m.meta = None
+    return m
+
+
+class ShiftedLoop:
+    '''An event loop whose clock can be moved ahead'''
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.offset = 0
+
+    def time(self):
+        return self.loop.time() + self.offset
+
+    def __getattr__(self, name):
+        return getattr(self.loop, name)
+
+
+class TestMultiSymbolExchange(unittest.TestCase):
+
+    def setUp(self):
+        # the exchange loggers write to exchange/market_logs relative to the working directory
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'exchange', 'market_logs'))
+        os.chdir(self.tmp.name)
+        self.broadcast = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def reply(self, m):
+        pass
+
+    async def message_broadcast(self, m):
+        self.broadcast.append(m)
+
+    def run_messages(self, exchange_class, book_class, messages, **kwargs):
+        async def run():
+            exchange = exchange_class(order_book = None, order_reply = self.reply,
+                message_broadcast = self.message_broadcast, loop = asyncio.get_running_loop(),
+                book_factory = book_class, **kwargs)
+            for m in messages:
+                await exchange.process_message(m)
+            await asyncio.sleep(0)
+            return exchange
+        exchange = asyncio.run(run())
+        self.addCleanup(exchange.close)
+        return exchange
+
+    def test_close_writes_the_logs_and_stops_the_writer(self):
+        exchange = self.run_messages(Exchange, CDABook, [enter_order('a', b'B', 10, 5, b'AAPL')])
+        exchange.close()
+        self.assertFalse(exchange.log_writer.thread.is_alive())
+        with open('exchange/market_logs/action_log.txt') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_orders_route_to_their_symbol(self):
+        exchange = self.run_messages(Exchange, CDABook, [
+            enter_order('a', b'B', 10, 5, b'AAPL'),
+            # would cross 'a' if both symbols shared a book
+            enter_order('b', b'S', 9, 3, b'MSFT'),
+            enter_order('c', b'S', 10, 2, b'AAPL'),
+            cancel_order('b'),
+        ])
+        self.assertEqual(set(exchange.order_books), {b'AAPL', b'MSFT'})
+        self.assertEqual(exchange.order_books[b'AAPL'].bid, 10)
+        self.assertEqual(exchange.order_books[b'AAPL'].volume_at_best_bid, 3)
+        self.assertFalse(exchange.order_books[b'MSFT'].asks.as_dict())
+
+        executed = [m for m in self.broadcast if m.message_type == OuchServerMessages.Executed]
+        self.assertEqual(len(executed), 2)
+        bbo_stocks = [m['stock'] for m in self.broadcast if m.message_type == OuchServerMessages.BestBidAndOffer]
+        self.assertEqual(bbo_stocks, [b'AAPL', b'MSFT', b'AAPL', b'MSFT'])
+
+    def test_post_batch_per_symbol(self):
+        exchange = self.run_messages(FBAExchange, FBABook, [
+            enter_order('a', b'B', 10, 5, b'AAPL'),
+            enter_order('b', b'S', 9, 3, b'MSFT'),
+        ], interval = 1)
+        exchange.run_batch_atomic()
+        post_batches = [m for m in exchange.outgoing_broadcast_messages if m.message_type == OuchServerMessages.PostBatch]
+        self.assertEqual([m['stock'] for m in post_batches], [b'AAPL', b'MSFT'])
+        self.assertEqual([m['transacted_volume'] for m in post_batches], [0, 0])
+
+    def test_single_book_mode_keeps_configured_symbol(self):
+        async def run():
+            exchange = Exchange(order_book = CDABook(), order_reply = self.reply,
+                message_broadcast = self.message_broadcast, loop = asyncio.get_running_loop(), stock = b'FIRST')
+            await exchange.process_message(enter_order('a', b'B', 10, 5, b'AAPL'))
+            await exchange.process_message(enter_order('b', b'S', 11, 5, b'MSFT'))
+            return exchange
+        exchange = asyncio.run(run())
+        self.assertEqual(list(exchange.order_books), [b'FIRST'])
+        bbo_stocks = [m['stock'] for m in self.broadcast if m.message_type == OuchServerMessages.BestBidAndOffer]
+        self.assertEqual(bbo_stocks, [b'FIRST', b'FIRST'])
+
+    def test_bbo_conflation(self):
+        messages = [enter_order('a', b'B', 10, 5, b'AAPL'), enter_order('b', b'B', 11, 5, b'AAPL'),
+                    enter_order('c', b'S', 11, 2, b'AAPL'), enter_order('d', b'S', 20, 1, b'MSFT')]
+        self.run_messages(Exchange, CDABook, messages, bbo_conflation = 0)
+        kinds = [m.message_type for m in self.broadcast]
+        # accepts and executions go out unconflated, ahead of the one quote per stock
+        self.assertEqual(kinds.count(OuchServerMessages.Accepted), 4)
+        self.assertEqual(kinds.count(OuchServerMessages.Executed), 2)
+        quotes = [m for m in self.broadcast if m.message_type == OuchServerMessages.BestBidAndOffer]
+        self.assertEqual([m['stock'] for m in quotes], [b'AAPL', b'MSFT'])
+        self.assertEqual((quotes[0]['best_bid'], quotes[0]['volume_at_best_bid']), (11, 3))
+        self.assertEqual(kinds.index(OuchServerMessages.BestBidAndOffer), len(kinds) - 2)
+
+    def test_expired_orders_are_cancelled_in_one_sweep(self):
+        async def run():
+            loop = ShiftedLoop(asyncio.get_running_loop())
+            exchange = Exchange(order_book = None, order_reply = self.reply,
+                message_broadcast = self.message_broadcast, loop = loop, book_factory = CDABook)
+            for m in [enter_order('a', b'B', 10, 5, b'AAPL', time_in_force = 2),
+                      enter_order('b', b'B', 9, 5, b'AAPL', time_in_force = 2),
+                      enter_order('c', b'S', 20, 5, b'MSFT', time_in_force = 2),
+                      enter_order('d', b'B', 8, 5, b'AAPL', time_in_force = 10),
+                      # fills 'a', cancels 'c': both leave nothing to expire
+                      enter_order('e', b'S', 10, 5, b'AAPL'), cancel_order('c')]:
+                await exchange.process_message(m)
+            self.assertEqual(len(exchange.expiries), 2)
+            self.broadcast.clear()
+            loop.offset = 3
+            exchange.expire_orders()
+            await asyncio.sleep(0)
+            return exchange
+        exchange = asyncio.run(run())
+        cancelled = [m['order_token'].rstrip() for m in self.broadcast if m.message_type == OuchServerMessages.Canceled]
+        self.assertEqual(cancelled, [b'b'])
+        self.assertEqual(exchange.order_books[b'AAPL'].bids.as_dict(), [{'price': 8, 'quantity': 5}])
+        self.assertEqual([token.rstrip() for token in exchange.order_store.orders], [b'd'])
+        # 'd' is still pending, so the sweep rescheduled itself
+        self.assertEqual(len(exchange.expiries), 1)
+        self.assertIsNotNone(exchange.expiry_handle)
+
+    def test_order_store_keeps_only_live_orders(self):
+        exchange = self.run_messages(Exchange, CDABook, [
+            enter_order('a', b'B', 10, 5, b'AAPL'), enter_order('b', b'B', 10, 4, b'AAPL'),
+            # fills 'a' and part of 'b'
+            enter_order('c', b'S', 10, 7, b'AAPL'),
+            # partly filled, the rest is not entered
+            enter_order('d', b'S', 10, 5, b'AAPL', time_in_force = 0),
+            enter_order('e', b'S', 12, 3, b'AAPL'), enter_order('f', b'S', 13, 3, b'AAPL'), cancel_order('f'),
+        ], order_history_log = 'order_history.bin')
+        exchange.close()
+        self.assertEqual([token.rstrip() for token in exchange.order_store.orders], [b'e'])
+        self.assertEqual(exchange.order_store.orders[b'e'.ljust(32)].executed_quantity, 0)
+        history = {}
+        for record in event_journal.read_journal('exchange/market_logs/order_history.bin'):
+            token = record.value['order_token'].rstrip()
+            history.setdefault(token, []).append(record.value.message_type)
+        self.assertEqual(history[b'a'], [OuchClientMessages.EnterOrder, OuchServerMessages.Accepted,
+                                         OuchServerMessages.Executed])
+        self.assertEqual(history[b'd'], [OuchClientMessages.EnterOrder, OuchServerMessages.Accepted,
+                                         OuchServerMessages.Executed])
+        self.assertEqual(len(history[b'c']), 4)
+
+    def test_recently_retired_tokens_are_repeats(self):
+        exchange = self.run_messages(Exchange, CDABook, [
+            enter_order('a', b'B', 10, 5, b'AAPL'), cancel_order('a'),
+            # 'a' was just retired
+            enter_order('a', b'B', 11, 5, b'AAPL'),
+            # retiring 'b' pushes 'a' out of the window of one token
+            enter_order('b', b'B', 10, 5, b'AAPL'), cancel_order('b'),
+            enter_order('a', b'B', 12, 5, b'AAPL'),
+        ], recent_tokens = 1)
+        rejected = [m for m in exchange.outgoing_messages if m.message_type == OuchServerMessages.Rejected]
+        self.assertEqual([(m['order_token'].rstrip(), m['reason'].rstrip(), m['price']) for m in rejected],
+                         [(b'a', b'RepeatID', 11)])
+        entry = exchange.order_store.orders[b'a'.ljust(32)]
+        self.assertEqual((entry.stock.rstrip(b'\x00'), entry.buy_sell_indicator, entry.price, entry.shares),
+                         (b'AAPL', b'B', 12, 5))
+        self.assertEqual(list(exchange.order_store.retired), [b'b'.ljust(32)])
+
+    def test_book_delta_log_rebuilds_books(self):
+        messages = [enter_order('a', b'B', 10, 5, b'AAPL'), enter_order('b', b'B', 9, 4, b'AAPL'),
+                    enter_order('c', b'S', 12, 3, b'MSFT'), enter_order('d', b'S', 9, 7, b'AAPL'),
+                    enter_order('e', b'S', 13, 2, b'MSFT'), cancel_order('c'), enter_order('f', b'B', 8, 1, b'AAPL')]
+        exchange = self.run_messages(Exchange, CDABook, messages, book_log_mode = 'delta', book_snapshot_every = 2)
+        exchange.close()
+        books = read_book_deltas('exchange/market_logs/book_log.txt')
+        self.assertEqual(books, {
+            'AAPL': {'bids': {8: 1, 9: 2}, 'asks': {}},
+            'MSFT': {'bids': {}, 'asks': {13: 2}},
+        })
+        with open('exchange/market_logs/book_log.txt') as f:
+            entries = [json.loads(line)['book_delta'] for line in f]
+        aapl = [entry for entry in entries if entry['stock'] == 'AAPL']
+        self.assertEqual([entry['seq'] for entry in aapl], [1, 2, 3, 4])
+        self.assertEqual([bool(entry.get('snapshot')) for entry in aapl], [True, False, False, True])
+        # 'd' swept the 10 level and took part of the 9 level
+        self.assertEqual(sorted(map(tuple, aapl[2]['levels'])), [('B', 9, 2), ('B', 10, 0), ('S', 9, 0)])
+
+    def test_journal_converts_to_the_json_logs(self):
+        messages = [enter_order('a', b'B', 10, 5, b'AAPL'), enter_order('b', b'S', 12, 3, b'MSFT'),
+                    enter_order('c', b'S', 10, 2, b'AAPL'), cancel_order('a')]
+        def logs(directory):
+            entries = []
+            for name in ('book_log.txt', 'transaction_log.txt', 'action_log.txt'):
+                with open(os.path.join(directory, name)) as f:
+                    entries.append([{k: v for (k, v) in json.loads(line).items() if k != 'timestamp'} for line in f])
+            return entries
+        for book_log_mode in ('snapshot', 'delta'):
+            for log_format in ('json', 'journal'):
+                exchange = self.run_messages(Exchange, CDABook, messages, book_log_mode = book_log_mode, log_format = log_format)
+                exchange.close()
+            journal = 'exchange/market_logs/journal.bin'
+            kinds = [record.record_type for record in event_journal.read_journal(journal)]
+            self.assertEqual(kinds.count(event_journal.SERVER_MESSAGE), 2)
+            self.assertEqual(kinds.count(event_journal.CLIENT_MESSAGE), 4)
+            os.makedirs('converted', exist_ok = True)
+            journal_to_json(journal, 'converted/book_log.txt', 'converted/transaction_log.txt', 'converted/action_log.txt')
+            self.assertEqual(logs('converted'), logs('exchange/market_logs'))
+            self.assertLess(os.path.getsize(journal), sum(os.path.getsize('exchange/market_logs/' + name)
+                for name in ('book_log.txt', 'transaction_log.txt', 'action_log.txt')))
+
+
+    def test_sequencer_matches_in_arrival_order(self):
+        async def run():
+            exchange = Exchange(order_book = None, order_reply = self.reply,
+                message_broadcast = self.message_broadcast, loop = asyncio.get_running_loop(),
+                book_factory = CDABook)
+            sequencer = Sequencer(exchange, max_batch = 2)
+            sequencer.start()
+            for m in [enter_order('a', b'B', 10, 5, b'AAPL'), enter_order('b', b'S', 10, 2, b'AAPL'),
+                      enter_order('c', b'S', 9, 1, b'AAPL'), cancel_order('a')]:
+                await sequencer.submit(m)
+            # nothing is matched on the submitting task
+            self.assertFalse(exchange.order_books)
+            for _ in range(10):
+                await asyncio.sleep(0)
+            sequencer.stop()
+            return exchange, sequencer
+        (exchange, sequencer) = asyncio.run(run())
+
+        self.assertEqual(sequencer.last_sequence_number, 4)
+        self.assertEqual(sequencer.match_delay.count, 4)
+        self.assertEqual(sequencer.publish_delay.count, 2)
+        executed = [(m['order_token'].strip(), m['executed_shares']) for m in self.broadcast
+                    if m.message_type == OuchServerMessages.Executed]
+        self.assertEqual(executed, [(b'b', 2), (b'a', 2), (b'c', 1), (b'a', 1)])
+        canceled = [m['decrement_shares'] for m in self.broadcast if m.message_type == OuchServerMessages.Canceled]
+        self.assertEqual(canceled, [2])
+
+    def test_iex_exchange_handles_messages_at_their_timestamp(self):
+        async def run():
+            replies = []
+            async def reply(m):
+                replies.append(m)
+            exchange = IEXExchange(0.01, order_book = None, order_reply = reply,
+                message_broadcast = self.message_broadcast, loop = asyncio.get_running_loop(),
+                book_factory = IEXBook)
+            self.addCleanup(exchange.close)
+            exchange.handle_message(enter_order('a', b'B', 10, 5, b'AAPL'), 1000)
+            await asyncio.sleep(0.05)
+            return replies
+        replies = asyncio.run(run())
+        accepted = [m for m in replies if m.message_type == OuchServerMessages.Accepted]
+        # handled once the speed bump is passed
+        self.assertEqual([m['timestamp'] for m in accepted], [1000 + 10**7])
+
+
+if __name__ == '__main__':
+    unittest.main()
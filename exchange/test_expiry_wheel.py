@@ -0,0 +1,75 @@
+import unittest
+from exchange.expiry_wheel import ExpiryWheel
+
+
+class TestExpiryWheel(unittest.TestCase):
+
+    def expire_all(self, wheel, until):
+        '''Advance one tick at a time, returns tick -> tokens expired at that tick'''
+        expired = {}
+        for tick in range(1, until + 1):
+            tokens = wheel.advance(tick)
+            if tokens:
+                expired[tick] = tokens
+        return expired
+
+    def test_orders_expire_at_their_tick(self):
+        wheel = ExpiryWheel(0)
+        wheel.add(b'a', 0, 3)
+        wheel.add(b'b', 0.5, 2)
+        wheel.add(b'c', 0, 3)
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(self.expire_all(wheel, 5), {3: [b'a', b'b', b'c']})
+        self.assertEqual(len(wheel), 0)
+
+    def test_due_ticks_round_up_and_never_land_now(self):
+        wheel = ExpiryWheel(0)
+        wheel.add(b'a', 0.2, 1)
+        wheel.add(b'b', 0.2, 0)
+        self.assertEqual(self.expire_all(wheel, 3), {1: [b'b'], 2: [b'a']})
+
+    def test_far_expiries_cascade_down_the_levels(self):
+        wheel = ExpiryWheel(0, slots = 4, levels = 2)
+        delays = [1, 3, 4, 5, 15, 16, 17, 40]
+        for delay in delays:
+            wheel.add(delay, 0, delay)
+        # 16 and above only fit in the overflow
+        self.assertEqual(set(wheel.overflow), {16, 17, 40})
+        self.assertEqual(self.expire_all(wheel, 50), {delay: [delay] for delay in delays})
+
+    def test_advance_skips_ahead_over_many_ticks(self):
+        wheel = ExpiryWheel(0, slots = 4, levels = 2)
+        for delay in (2, 9, 30):
+            wheel.add(delay, 0, delay)
+        self.assertEqual(wheel.advance(10), [2, 9])
+        self.assertEqual(wheel.advance(100), [30])
+        self.assertEqual(wheel.current, 100)
+
+    def test_removed_and_readded_orders(self):
+        wheel = ExpiryWheel(0)
+        wheel.add(b'a', 0, 2)
+        wheel.add(b'b', 0, 2)
+        wheel.remove(b'a')
+        wheel.remove(b'unknown')
+        wheel.add(b'b', 0, 5)
+        self.assertNotIn(b'a', wheel)
+        self.assertEqual(self.expire_all(wheel, 6), {5: [b'b']})
+
+    def test_idle_wheel_catches_up_to_the_clock(self):
+        wheel = ExpiryWheel(100)
+        wheel.add(b'a', 1000.5, 1)
+        self.assertEqual(wheel.next_tick_time(), 1001)
+        self.assertEqual(wheel.advance(1001), [])
+        self.assertEqual(wheel.advance(1002), [b'a'])
+
+    def test_clear(self):
+        wheel = ExpiryWheel(0, slots = 4, levels = 1)
+        wheel.add(b'a', 0, 2)
+        wheel.add(b'b', 0, 20)
+        wheel.clear()
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(self.expire_all(wheel, 30), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from functools import partial
+from OuchServer.clock import SimulatedClock
+from OuchServer.ouch_messages import OuchServerMessages
+from exchange.exchange import Exchange
+from exchange.fba_exchange import FBAExchange
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.fba_book import FBABook
+from exchange.recovery import WriteAheadLog, SEGMENT_FILE
+from exchange.test_exchange import enter_order, cancel_order
+from exchange_logging.exchange_loggers import book_levels
+
+# symbols as they come off the wire, and out of the write-ahead log
+AAPL = b'AAPL\x00\x00\x00\x00'
+MSFT = b'MSFT\x00\x00\x00\x00'
+
+class TestRecovery(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'exchange', 'market_logs'))
+        os.chdir(self.tmp.name)
+        self.wal_dir = os.path.join(self.tmp.name, 'wal')
+        self.broadcast = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def reply(self, m):
+        pass
+
+    async def message_broadcast(self, m):
+        self.broadcast.append(m)
+
+    def new_exchange(self, **kwargs):
+        return Exchange(order_book = None, order_reply = self.reply, message_broadcast = self.message_broadcast,
+            loop = asyncio.get_running_loop(), book_factory = CDABook, wal_dir = self.wal_dir, **kwargs)
+
+    async def crash(self, exchange):
+        """Stop using an exchange as a crash would, once what it logged is on disk"""
+        await exchange.wal.snapshot_task
+        exchange.close()
+
+    def books(self, exchange):
+        return {stock: (book_levels(book.bids), book_levels(book.asks)) for (stock, book) in exchange.order_books.items()}
+
+    def test_restart_restores_books_and_order_store(self):
+        async def run():
+            exchange = self.new_exchange()
+            for m in [enter_order('a', b'B', 10, 5, AAPL), enter_order('b', b'B', 10, 4, AAPL),
+                      enter_order('c', b'S', 12, 3, MSFT), enter_order('d', b'S', 10, 2, AAPL),
+                      enter_order('e', b'S', 13, 1, MSFT), cancel_order('e')]:
+                await exchange.process_message(m)
+            await self.crash(exchange)
+
+            recovered = self.new_exchange()
+            self.assertEqual(self.books(recovered), self.books(exchange))
+            self.assertEqual(set(recovered.order_store.orders), set(exchange.order_store.orders))
+            self.assertEqual(recovered.next_match_number, exchange.next_match_number)
+            # time priority is kept: the next sell fills what is left of 'a' before 'b'
+            self.broadcast.clear()
+            await recovered.process_message(enter_order('f', b'S', 10, 4, AAPL))
+            executed = [m for m in self.broadcast if m.message_type == OuchServerMessages.Executed]
+            self.assertEqual([(m['order_token'].rstrip(), m['executed_shares']) for m in executed],
+                             [(b'f', 3), (b'a', 3), (b'f', 1), (b'b', 1)])
+            self.assertEqual(executed[0]['match_number'], exchange.next_match_number)
+            await recovered.process_message(cancel_order('c'))
+            self.assertEqual(self.books(recovered)[MSFT], ([], []))
+            await self.crash(recovered)
+        asyncio.run(run())
+
+    def test_recovery_replays_only_after_the_snapshot(self):
+        async def run():
+            exchange = self.new_exchange()
+            for i in range(10):
+                await exchange.process_message(enter_order('a%d' % i, b'B', 10 + i, 1, AAPL))
+            await exchange.wal.snapshot_task
+            exchange.wal.snapshot(exchange)
+            for i in range(3):
+                await exchange.process_message(enter_order('b%d' % i, b'S', 30 + i, 1, AAPL))
+            await self.crash(exchange)
+            # the segments the snapshot covers are gone
+            self.assertEqual(len(exchange.wal.segments()), 1)
+
+            fresh = Exchange(order_book = None, order_reply = self.reply, message_broadcast = self.message_broadcast,
+                loop = asyncio.get_running_loop(), book_factory = CDABook)
+            self.assertEqual(WriteAheadLog(self.wal_dir, asyncio.get_running_loop()).recover(fresh), 3)
+            self.assertEqual(self.books(fresh), self.books(exchange))
+        asyncio.run(run())
+
+    def test_torn_record_ends_the_log(self):
+        async def run():
+            exchange = self.new_exchange()
+            await exchange.process_message(enter_order('a', b'B', 10, 5, AAPL))
+            await self.crash(exchange)
+            with open(os.path.join(self.wal_dir, SEGMENT_FILE % exchange.wal.segment), 'ab') as segment:
+                segment.write(b'\x00\x00\x00\x40\x01')
+            recovered = self.new_exchange()
+            self.assertEqual(self.books(recovered), self.books(exchange))
+            await self.crash(recovered)
+        asyncio.run(run())
+
+    def test_responses_wait_for_their_messages_to_be_durable(self):
+        durable_when_sent = []
+
+        async def run():
+            exchange = self.new_exchange()
+
+            async def message_broadcast(m):
+                durable_when_sent.append(exchange.wal.durable >= exchange.wal.appended)
+            exchange.message_broadcast = message_broadcast
+            for i in range(5):
+                await exchange.process_message(enter_order('a%d' % i, b'B', 10, 1, AAPL))
+            self.assertEqual(exchange.wal.appended, 5)
+            await self.crash(exchange)
+        asyncio.run(run())
+        self.assertTrue(durable_when_sent)
+        self.assertTrue(all(durable_when_sent))
+
+    def test_replayed_orders_keep_their_expiry(self):
+        async def run():
+            exchange = self.new_exchange(clock = SimulatedClock(10**12))
+            await exchange.process_message(enter_order('a', b'B', 10, 5, AAPL, time_in_force = 100))
+            await self.crash(exchange)
+            # restarted a minute later, the order has 40 of its 100 seconds left
+            recovered = self.new_exchange(clock = SimulatedClock(10**12 + 60 * 10**9))
+            token = b'a'.ljust(32)
+            wheel = recovered.expiries
+            due = wheel.buckets[token][token]
+            self.assertIn(due - wheel.tick_at(asyncio.get_running_loop().time()), (40, 41))
+            await self.crash(recovered)
+        asyncio.run(run())
+
+    def test_only_a_cda_exchange_recovers(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            with self.assertRaises(ValueError):
+                FBAExchange(1, order_book = None, order_reply = self.reply, message_broadcast = self.message_broadcast,
+                    loop = loop, book_factory = FBABook, wal_dir = self.wal_dir)
+            with self.assertRaises(ValueError):
+                Exchange(order_book = None, order_reply = self.reply, message_broadcast = self.message_broadcast,
+                    loop = loop, book_factory = partial(FBABook, seed = 1), wal_dir = self.wal_dir)
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from OuchServer.ouch_messages import OuchServerMessages
+from exchange.exchange import Exchange
+from exchange.order_books.cda_book import CDABook
+from exchange.replay import read_actions, replay
+from exchange.test_exchange import enter_order, cancel_order
+from exchange_logging.exchange_loggers import book_levels
+
+
+def session(other_stock):
+    return [
+        enter_order('a', b'B', 10, 5, b'AAPL'), enter_order('b', b'B', 9, 4, b'AAPL'),
+        enter_order('c', b'S', 12, 3, other_stock), enter_order('d', b'S', 9, 7, b'AAPL'),
+        cancel_order('c'), enter_order('e', b'S', 11, 2, b'AAPL'), enter_order('f', b'B', 12, 3, b'AAPL'),
+        cancel_order('unknown'), enter_order('g', b'B', 8, 1, other_stock),
+    ]
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'exchange', 'market_logs'))
+        os.chdir(self.tmp.name)
+        self.broadcast = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def reply(self, m):
+        pass
+
+    async def message_broadcast(self, m):
+        self.broadcast.append(m)
+
+    def record(self, multi_symbol, **kwargs):
+        """Run a session through a live exchange, return it once its logs are written"""
+        async def run():
+            exchange = Exchange(order_book = None if multi_symbol else CDABook(), order_reply = self.reply,
+                message_broadcast = self.message_broadcast, loop = asyncio.get_running_loop(),
+                book_factory = CDABook if multi_symbol else None, stock = b'AAPL', **kwargs)
+            for m in session(b'MSFT' if multi_symbol else b'AAPL'):
+                await exchange.process_message(m)
+            await asyncio.sleep(0)
+            exchange.close()
+            return exchange
+        return asyncio.run(run())
+
+    def check_replay(self, exchange, log_filepath, multi_symbol):
+        actions = read_actions(log_filepath)
+        result = asyncio.run(replay(actions, multi_symbol = multi_symbol, stock = b'AAPL'))
+        self.assertEqual(result.events, len(actions))
+        self.assertGreater(result.events_per_second, 0)
+        # the timestamps are the logged ones, so the messages are the very same
+        self.assertEqual([bytes(m) for m in result.messages], [bytes(m) for m in self.broadcast])
+        self.assertEqual(len(result.transactions), 6)
+        self.assertGreater(len(result.messages), len(result.transactions))
+        # stocks decoded from the journal are NUL padded, as they come off the wire
+        books = {stock.rstrip(b'\x00'): book for (stock, book) in result.books.items()}
+        self.assertEqual(set(books), set(exchange.order_books))
+        for (stock, book) in exchange.order_books.items():
+            self.assertEqual(books[stock], {"bids": dict(book_levels(book.bids)), "asks": dict(book_levels(book.asks))})
+        # replaying again changes nothing
+        again = asyncio.run(replay(actions, multi_symbol = multi_symbol, stock = b'AAPL'))
+        self.assertEqual(again.digest(), result.digest())
+
+    def test_replay_json_action_log(self):
+        exchange = self.record(multi_symbol = False)
+        self.check_replay(exchange, 'exchange/market_logs/action_log.txt', multi_symbol = False)
+        self.assertTrue(os.path.exists('exchange/market_logs/replay_action_log.txt'))
+
+    def test_replay_journal(self):
+        exchange = self.record(multi_symbol = True, log_format = 'journal')
+        self.check_replay(exchange, 'exchange/market_logs/journal.bin', multi_symbol = True)
+
+    def test_replay_changed_session_changes_digest(self):
+        self.record(multi_symbol = False)
+        actions = read_actions('exchange/market_logs/action_log.txt')
+        result = asyncio.run(replay(actions))
+        dropped = asyncio.run(replay(actions[:-1]))
+        self.assertNotEqual(dropped.digest(), result.digest())
+
+    def test_replay_at_scaled_clock(self):
+        actions = [(0, enter_order('a', b'B', 10, 5, b'AAPL')), (4 * 10**8, enter_order('b', b'S', 10, 5, b'AAPL'))]
+        start = time.perf_counter()
+        result = asyncio.run(replay(actions, speed = 2))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        executed = [m for m in result.messages if m.message_type == OuchServerMessages.Executed]
+        self.assertEqual([m['timestamp'] for m in executed], [4 * 10**8] * 2)
+        # the replayed exchange's own logs keep the logged time too
+        with open('exchange/market_logs/replay_transaction_log.txt') as transaction_log:
+            self.assertEqual([json.loads(line)['timestamp'] for line in transaction_log], [4 * 10**8] * 2)
+
+    def test_json_action_log_keeps_time_in_force_and_stock(self):
+        async def run():
+            exchange = Exchange(order_book = None, order_reply = self.reply, message_broadcast = self.message_broadcast,
+                loop = asyncio.get_running_loop(), book_factory = CDABook)
+            for m in (enter_order('a', b'B', 10, 5, b'MSFT', time_in_force = 0), enter_order('b', b'S', 10, 5, b'MSFT')):
+                await exchange.process_message(m)
+            exchange.close()
+        asyncio.run(run())
+        actions = read_actions('exchange/market_logs/action_log.txt')
+        self.assertEqual([(m['stock'], m['time_in_force']) for (_, m) in actions], [(b'MSFT', 0), (b'MSFT', 99999)])
+        # the immediate or cancel buy never rests, so the sell finds nothing to cross
+        result = asyncio.run(replay(actions, multi_symbol = True))
+        self.assertEqual(result.transactions, [])
+        self.assertEqual(result.books, {b'MSFT': {"bids": {}, "asks": {10: 5}}})
+
+    def test_older_json_action_log_is_refused(self):
+        with open('action_log.txt', 'w') as log_file:
+            log_file.write(json.dumps({"timestamp": 1, "action": {"action_type": "place_limit_order",
+                "action_data": {"token": "a", "direction": "B", "price": 10, "shares": 5}}}) + '\n')
+        with self.assertRaises(ValueError):
+            read_actions('action_log.txt')
+
+    def test_replay_fires_timers_on_the_logged_clock(self):
+        actions = [(0, enter_order('a', b'B', 10, 5, b'AAPL', time_in_force = 2)),
+                   (5 * 10**9, enter_order('b', b'S', 10, 5, b'AAPL'))]
+        result = asyncio.run(replay(actions, stock = b'AAPL', bbo_conflation = 1))
+        # the buy expired before the sell came in
+        self.assertEqual(result.transactions, [])
+        canceled = [m for m in result.messages if m.message_type == OuchServerMessages.Canceled]
+        self.assertEqual(len(canceled), 1)
+        self.assertTrue(2 * 10**9 <= canceled[0]['timestamp'] < 5 * 10**9)
+        # and the held BBO updates went out
+        self.assertTrue(any(m.message_type == OuchServerMessages.BestBidAndOffer for m in result.messages))
+        self.assertEqual(result.books, {b'AAPL': {"bids": {}, "asks": {10: 5}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import queue
+import tempfile
+import unittest
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from exchange.exchange import Exchange
+from exchange.fba_exchange import FBAExchange
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.fba_book import FBABook
+from exchange.sharded_exchange import ShardedExchange, shard_for
+from exchange.test_exchange import enter_order, cancel_order
+
+
+class TestShardedExchange(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'exchange', 'market_logs'))
+        os.chdir(self.tmp.name)
+        self.replies = []
+        self.broadcast = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def reply(self, m):
+        self.replies.append(m)
+
+    async def message_broadcast(self, m):
+        self.broadcast.append(m)
+
+    def test_route(self):
+        # retired tokens can be used again right away
+        exchange = ShardedExchange(4, Exchange, CDABook, self.reply, self.message_broadcast, loop = None,
+                                   recent_tokens = 0)
+        enter = enter_order('a', b'B', 10, 5, b'AAPL')
+        self.assertEqual(list(exchange.route(enter)), [shard_for(b'AAPL', 4)])
+        self.assertEqual(shard_for(b'AAPL\x00\x00\x00\x00', 4), shard_for(b'AAPL', 4))
+        # the cancel follows its order
+        self.assertEqual(list(exchange.route(cancel_order('a'))), [shard_for(b'AAPL', 4)])
+        self.assertEqual(list(exchange.route(cancel_order('unknown'))), [])
+        # a retired token is reused for a stock of another shard
+        exchange.order_retired(b'a'.ljust(32), shard_for(b'AAPL', 4), 1)
+        self.assertEqual(list(exchange.route(cancel_order('a'))), [])
+        other = next(stock for stock in (b'MSFT', b'GOOG', b'IBM', b'ORCL') if shard_for(stock, 4) != shard_for(b'AAPL', 4))
+        exchange.route(enter_order('a', b'B', 10, 5, other))
+        # a late retirement by the old shard leaves the new order alone
+        exchange.order_retired(b'a'.ljust(32), shard_for(b'AAPL', 4), 1)
+        self.assertEqual(list(exchange.route(cancel_order('a'))), [shard_for(other, 4)])
+        start = OuchClientMessages.SystemStart(timestamp = 0, event_code = b'S')
+        self.assertEqual(list(exchange.route(start)), [0, 1, 2, 3])
+        self.assertEqual(exchange.token_shards, {})
+
+    def test_used_token_is_a_repeat_on_every_shard(self):
+        exchange = ShardedExchange(4, Exchange, CDABook, self.reply, self.message_broadcast, loop = None)
+        exchange.inboxes = [queue.SimpleQueue() for _ in range(4)]
+        other = next(stock for stock in (b'MSFT', b'GOOG', b'IBM', b'ORCL') if shard_for(stock, 4) != shard_for(b'AAPL', 4))
+        async def run():
+            await exchange.process_message(enter_order('a', b'B', 10, 5, b'AAPL'))
+            # live on the AAPL shard
+            await exchange.process_message(enter_order('a', b'S', 11, 3, other))
+            exchange.order_retired(b'a'.ljust(32), shard_for(b'AAPL', 4), 1)
+            # retired recently
+            await exchange.process_message(enter_order('a', b'S', 11, 4, other))
+        asyncio.run(run())
+        self.assertEqual([(m.message_type, m['reason'], m['shares']) for m in self.replies],
+                         [(OuchServerMessages.Rejected, b'RepeatID', 3), (OuchServerMessages.Rejected, b'RepeatID', 4)])
+        self.assertEqual([inbox.qsize() for inbox in exchange.inboxes],
+                         [1 if shard == shard_for(b'AAPL', 4) else 0 for shard in range(4)])
+        self.assertEqual(list(exchange.route(cancel_order('a'))), [])
+
+    def test_workers_match_and_relay(self):
+        stocks = [b'AAPL', b'MSFT', b'GOOG', b'IBM']
+        async def run():
+            exchange = ShardedExchange(2, Exchange, CDABook, self.reply, self.message_broadcast,
+                loop = asyncio.get_running_loop())
+            exchange.start()
+            for (i, stock) in enumerate(stocks):
+                await exchange.process_message(enter_order('b%d' % i, b'B', 10, 5, stock))
+                await exchange.process_message(enter_order('s%d' % i, b'S', 10, 2, stock))
+            await exchange.process_message(cancel_order('b0'))
+            # 4 x (2 accepts, 2 executions, 2 quotes) + cancel and quote
+            for _ in range(500):
+                if len(self.broadcast) >= 26:
+                    break
+                await asyncio.sleep(0.01)
+            await exchange.stop()
+        asyncio.run(run())
+
+        executed = [m for m in self.broadcast if m.message_type == OuchServerMessages.Executed]
+        self.assertEqual(len(executed), 8)
+        quotes = [m for m in self.broadcast if m.message_type == OuchServerMessages.BestBidAndOffer]
+        # stocks come back NUL padded from the wire
+        last_quote = {m['stock'].rstrip(b'\x00'): m for m in quotes}
+        self.assertEqual(sorted(last_quote), sorted(stocks))
+        self.assertEqual(last_quote[b'AAPL']['volume_at_best_bid'], 0)
+        self.assertEqual(last_quote[b'MSFT']['volume_at_best_bid'], 3)
+
+    def test_system_start_answered_once_and_tokens_forgotten(self):
+        async def run():
+            # the FBA exchange sends its replies with every batch
+            exchange = ShardedExchange(3, FBAExchange, FBABook, self.reply, self.message_broadcast,
+                loop = asyncio.get_running_loop(), interval = 0.05)
+            exchange.start()
+            start = OuchClientMessages.SystemStart(timestamp = 0, event_code = b'S')
+            start.meta = None
+            await exchange.process_message(start)
+            await exchange.process_message(enter_order('b', b'B', 10, 5, b'AAPL'))
+            await exchange.process_message(enter_order('s', b'S', 10, 5, b'AAPL'))
+            await exchange.process_message(enter_order('r', b'B', 10, 5, b'MSFT'))
+            for _ in range(500):
+                if not set(exchange.token_shards) - {b'r'.ljust(32)} and self.replies:
+                    break
+                await asyncio.sleep(0.01)
+            await exchange.stop()
+            return exchange.token_shards
+        token_shards = asyncio.run(run())
+        # the filled orders left the map, the resting one is still routed
+        self.assertEqual(list(token_shards), [b'r'.ljust(32)])
+        events = [m for m in self.replies if m.message_type == OuchServerMessages.SystemEvent]
+        self.assertEqual(len(events), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Binary event journal: the exchange logs as length-prefixed binary records rather than JSON lines.
+
+Every record is a RECORD_HEADER (payload length, record type, timestamp in nanoseconds) followed by
+its payload. Client and server messages are stored as their OUCH encoding, header included, so the
+journal reuses the wire format and decodes with the same message classes. Books are stored as
+packed (price, quantity) levels.
+
+The encode_* functions build whole records; loggers given a journal (see exchange_loggers) hand them
+to a LogWriter, whose thread writes them through a large buffered file. read_journal streams the
+records back, and exchange_loggers.journal_to_json converts a journal to the JSON logs.
+"""
+
+import struct
+from collections import namedtuple
+
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+
+# payload length, record type, timestamp (nanoseconds since midnight)
+RECORD_HEADER = struct.Struct('!IBQ')
+
+# record types
+CLIENT_MESSAGE = 1  # payload: an OUCH client message, header included (ClientActionLogger)
+SERVER_MESSAGE = 2  # payload: an OUCH server message, header included (TransactionLogger)
+BOOK = 3            # payload: BOOK_HEADER and its levels (BookLogger)
+BOOK_SNAPSHOT = 4   # payload: BOOK_HEADER and its levels (BookDeltaLogger)
+BOOK_DELTA = 5      # payload: DELTA_HEADER and its levels (BookDeltaLogger)
+CLIENT_STATE = 6    # payload: UTF-8 JSON (ClientStateLogger)
+
+# stock (NUL padded, empty for a single book exchange), sequence number, number of bid levels, number of ask levels
+BOOK_HEADER = struct.Struct('!8sIII')
+# stock, sequence number, number of levels
+DELTA_HEADER = struct.Struct('!8sII')
+
+# one record read back; value is a decoded message, a book_record, a delta_record or JSON text
+journal_record = namedtuple('JournalRecord', 'record_type timestamp value')
+# levels are lists of (price, quantity), best first
+book_record = namedtuple('BookRecord', 'stock seq bids asks')
+# levels is a list of (buy_sell_indicator, price, quantity)
+delta_record = namedtuple('DeltaRecord', 'stock seq levels')
+
+MESSAGE_TYPES = {CLIENT_MESSAGE: OuchClientMessages, SERVER_MESSAGE: OuchServerMessages}
+HEADER_SIZE = OuchServerMessages.get_message_class().get_header_class().size
+
+
+def encode_record(record_type, timestamp, payload):
+    return RECORD_HEADER.pack(len(payload), record_type, timestamp) + payload
+
+def encode_message(timestamp, record_type, message):
+    """CLIENT_MESSAGE or SERVER_MESSAGE record of a message (or MessageRecord)"""
+    return encode_record(record_type, timestamp, bytes(message))
+
+def encode_book(timestamp, record_type, stock, seq, bids, asks):
+    """BOOK or BOOK_SNAPSHOT record; bids and asks are lists of (price, quantity)"""
+    levels = [value for level in bids for value in level]
+    levels.extend(value for level in asks for value in level)
+    payload = (BOOK_HEADER.pack(stock or b'', seq, len(bids), len(asks)) +
+               struct.pack('!%dI' % len(levels), *levels))
+    return encode_record(record_type, timestamp, payload)
+
+def encode_delta(timestamp, stock, seq, levels):
+    """BOOK_DELTA record; levels is a list of (buy_sell_indicator, price, quantity)"""
+    values = [value for level in levels for value in level]
+    payload = (DELTA_HEADER.pack(stock or b'', seq, len(levels)) +
+               struct.pack('!' + 'cII' * len(levels), *values))
+    return encode_record(BOOK_DELTA, timestamp, payload)
+
+def encode_state(timestamp, state_json):
+    return encode_record(CLIENT_STATE, timestamp, state_json.encode('utf-8'))
+
+
+def decode_stock(stock):
+    stock = stock.rstrip(b'\x00')
+    return stock if stock else None
+
+def decode_payload(record_type, payload):
+    if record_type in MESSAGE_TYPES:
+        message_type = MESSAGE_TYPES[record_type].lookup_by_header_bytes(payload[:HEADER_SIZE])
+        message = message_type.from_bytes(payload)
+        message.meta = None
+        return message
+    elif record_type in (BOOK, BOOK_SNAPSHOT):
+        (stock, seq, bid_count, ask_count) = BOOK_HEADER.unpack_from(payload)
+        values = struct.unpack_from('!%dI' % (2 * (bid_count + ask_count)), payload, BOOK_HEADER.size)
+        levels = list(zip(values[0::2], values[1::2]))
+        return book_record(decode_stock(stock), seq, levels[:bid_count], levels[bid_count:])
+    elif record_type == BOOK_DELTA:
+        (stock, seq, count) = DELTA_HEADER.unpack_from(payload)
+        values = struct.unpack_from('!' + 'cII' * count, payload, DELTA_HEADER.size)
+        levels = list(zip(values[0::3], values[1::3], values[2::3]))
+        return delta_record(decode_stock(stock), seq, levels)
+    elif record_type == CLIENT_STATE:
+        return payload.decode('utf-8')
+    raise ValueError('Unknown journal record type %d' % record_type)
+
+def read_journal(journal_filepath, record_types=None):
+    """Stream the records of a journal.
+    Args:
+        journal_filepath: file written by journal loggers
+        record_types: if given, only records of these types are decoded and yielded
+    Yields:
+        journal_record tuples, in the order they were written. A record cut short at the end of
+        the file (the exchange stopped while writing it) ends the stream.
+    """
+    with open(journal_filepath, 'rb', buffering=1 << 20) as journal:
+        while True:
+            header = journal.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            (length, record_type, timestamp) = RECORD_HEADER.unpack(header)
+            payload = journal.read(length)
+            if len(payload) < length:
+                return
+            if record_types is None or record_type in record_types:
+                yield journal_record(record_type, timestamp, decode_payload(record_type, payload))
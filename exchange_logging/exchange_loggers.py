@@ -1,49 +1,383 @@
 import logging as log
+import atexit
 import json
+import os
+import threading
+from collections import deque
+
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from exchange_logging import event_journal
 
 # Names for the ClientActionLogger's "action_type" parameter
 PLACE_LIMIT_ORDER_ACTION = "place_limit_order"
 CANCEL_LIMIT_ORDER_ACTION = "cancel_limit_order"
 
-class BookLogger():
+# What a full LogWriter buffer does with a new record:
+#   block: the caller waits for the writer thread to make room, nothing is lost
+#   drop: the record is dropped (and counted), the caller never waits
+LOG_OVERFLOW_POLICIES = ('block', 'drop')
+
+class LogWriter():
+    """Background thread writing the entries of any number of loggers.
+       A logger given a LogWriter only puts a record (the raw values of the entry and the function
+       turning them into a JSON line or a journal record) in the writer's bounded buffer. The thread
+       takes everything buffered at once, serializes it and writes it with one write per file, so
+       the caller never pays for json.dumps, struct packing or file I/O.
+    Attributes:
+        max_records: bound of the buffer
+        overflow_policy: one of LOG_OVERFLOW_POLICIES
+        dropped: number of records dropped by the drop policy
+        failed: number of records that could not be encoded or written, logged and dropped
+        stopped: whether the thread is gone (closed, or died); records are then dropped and nobody waits
+        fsync: whether every write is followed by an fsync, making the records it holds durable
+        on_written: if given, called on the writer thread with the number of records of every batch
+            once it is written (and fsynced)
+    """
+
+    def __init__(self, max_records=65536, overflow_policy='block', fsync=False, on_written=None):
+        if overflow_policy not in LOG_OVERFLOW_POLICIES:
+            raise ValueError('Unknown log overflow policy %s' % overflow_policy)
+        self.max_records = max_records
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.failed = 0
+        self.fsync = fsync
+        self.on_written = on_written
+        # (file, encode function, arguments)
+        self.records = deque()
+        # number of records buffered, and written, since the start
+        self.buffered = 0
+        self.written = 0
+        self.condition = threading.Condition()
+        self.files = []
+        self.closed = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+        # the thread is a daemon, so records still buffered at exit are written first
+        atexit.register(self.flush)
+
+    def open(self, log_filepath, binary=False):
+        """Open (truncating) a file written by this writer, a binary one with a large buffer for journals"""
+        log_file = open(log_filepath, 'wb', buffering=1 << 20) if binary else open(log_filepath, 'w')
+        self.files.append(log_file)
+        return log_file
+
+    def put(self, log_file, key, timestamp, format_entry, values):
+        """Buffer the entry format_entry(*values), to be written to log_file as
+           {"timestamp": timestamp, "<key>": entry}
+        """
+        self.put_record(log_file, json_line, (key, timestamp, format_entry, values))
+
+    def put_record(self, log_file, encode, args):
+        """Buffer encode(*args), the str or bytes to write to log_file"""
+        with self.condition:
+            if self.closed or self.stopped:
+                return
+            if len(self.records) >= self.max_records:
+                if self.overflow_policy == 'drop':
+                    self.dropped += 1
+                    return
+                while len(self.records) >= self.max_records and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            self.records.append((log_file, encode, args))
+            self.buffered += 1
+            self.condition.notify_all()
+
+    def run(self):
+        try:
+            self.write_records()
+        except Exception:
+            log.exception('Log writer thread died, later log records are dropped')
+        finally:
+            # wake up callers waiting for room or for a flush, they would wait forever
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+
+    def write_records(self):
+        while True:
+            with self.condition:
+                while not self.records and not self.closed:
+                    self.condition.wait()
+                if not self.records:
+                    return
+                batch = self.records
+                self.records = deque()
+                # room for blocked callers
+                self.condition.notify_all()
+            chunks = {}
+            for (log_file, encode, args) in batch:
+                try:
+                    chunk = encode(*args)
+                except Exception:
+                    log.exception('Could not encode a record of %s, dropped', log_file.name)
+                    self.failed += 1
+                    continue
+                chunks.setdefault(log_file, []).append(chunk)
+            for (log_file, file_chunks) in chunks.items():
+                try:
+                    # '' or b'', whichever the file takes
+                    log_file.write(file_chunks[0][:0].join(file_chunks))
+                    log_file.flush()
+                    if self.fsync:
+                        os.fsync(log_file.fileno())
+                except Exception:
+                    log.exception('Could not write %d records to %s, dropped', len(file_chunks), log_file.name)
+                    self.failed += len(file_chunks)
+            if self.on_written is not None:
+                self.on_written(len(batch))
+            with self.condition:
+                self.written += len(batch)
+                self.condition.notify_all()
+
+    def flush(self):
+        """Wait until every record buffered so far is written"""
+        with self.condition:
+            buffered = self.buffered
+            while self.written < buffered and not self.stopped:
+                self.condition.wait()
+
+    def close_file(self, log_file):
+        """Write what is buffered, then close one of the files; it takes no more records"""
+        self.flush()
+        log_file.close()
+        self.files.remove(log_file)
+
+    def close(self):
+        """Write what is buffered, stop the thread and close the files; later records are ignored"""
+        atexit.unregister(self.flush)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        for log_file in self.files:
+            log_file.close()
+
+def book_levels(ladder):
+    """(price, quantity) of every level of one side of a book, best first"""
+    return [(level.price, level.interest) for level in ladder.ascending_items()]
+
+def json_line(key, timestamp, format_entry, values):
+    return '{"timestamp": %s, "%s": %s}\n' % (timestamp, key, format_entry(*values))
+
+class JsonLineLogger():
+    """Base of the loggers below: each entry is one line {"timestamp": timestamp, "<key>": entry}.
+       Without a LogWriter entries are serialized and written through logging on the caller's thread,
+       with one they are handed to the writer's thread.
+       Given a journal (a binary file from LogWriter.open) instead of a log file path, the entries are
+       written as event_journal records; exchange_loggers.journal_to_json turns them back into lines.
+    """
+    key = None
+
+    def __init__(self, log_filepath, logger_name, writer=None, journal=None):
+        self.writer = writer
+        self.journal = journal
+        if journal is not None:
+            return
+        if writer is not None:
+            self.log_file = writer.open(log_filepath)
+            return
+        self.logger = log.getLogger(logger_name)
+        self.logger.setLevel(log.INFO)
+
+        self.log_formatter = log.Formatter('{\"timestamp\": %(timestamp)s, \"' + self.key + '\": %(message)s}')
+
+        self.logger_fh = log.FileHandler(filename=log_filepath, mode='w')
+        self.logger_fh.setLevel(log.INFO)
+        self.logger_fh.setFormatter(self.log_formatter)
+
+        self.logger.addHandler(self.logger_fh)
+        self.logger.propagate=False
+
+    def write_entry(self, timestamp, format_entry, *values):
+        """Log the entry format_entry(*values); values are captured now, serialized later if there is a writer"""
+        if self.writer is None:
+            self.logger.info(format_entry(*values), extra={"timestamp" : timestamp})
+        else:
+            self.writer.put(self.log_file, self.key, timestamp, format_entry, values)
+
+    def write_record(self, encode, *args):
+        """Write the journal record encode(*args); args are captured now, packed later if there is a writer"""
+        if self.writer is None:
+            self.journal.write(encode(*args))
+        else:
+            self.writer.put_record(self.journal, encode, args)
+
+class BookLogger(JsonLineLogger):
     """Object used by the Exchange and Client classes that log CDABook objects as JSON dictionaries to a specified logfile.
        Each log entry has a timestamp and a snapshot of the CDABook at that timestamp, and are added to the next new line in the logfile.
        Format of each log entry looks like this:
          {"timestamp" : timestamp, "book" : {"bids" : bids, "asks" : asks}}
+       Books of a multi-symbol exchange also carry their symbol:
+         {"timestamp" : timestamp, "book" : {"bids" : bids, "asks" : asks}, "stock" : stock}
     Attributes:
         logger: logger from logging
         log_formatter: log.Formatter object for self.logger
-        logger_fh: log.FileHandler object for self.logger
+        logger_fh: log.FileHandler object for self.logger (only without a LogWriter)
     """
+    key = "book"
 
-    def __init__(self, log_filepath, logger_name):
+    def __init__(self, log_filepath, logger_name, writer=None, journal=None):
         """Initialize BookLogger
         Args:
             log_filepath: file path specifying the file for the BookLogger to write to
             logger_name: name of the logger
+            writer: LogWriter serializing and writing the entries, None to write them on the caller's thread
+            journal: if given, binary file the entries are written to as journal records, in place of log_filepath
         """
-        self.logger = log.getLogger(logger_name)
-        self.logger.setLevel(log.INFO)
-        
-        self.log_formatter = log.Formatter('{\"timestamp\": %(timestamp)s, \"book\": %(message)s}')
-
-        self.logger_fh = log.FileHandler(filename=log_filepath, mode='w')
-        self.logger_fh.setLevel(log.INFO)
-        self.logger_fh.setFormatter(self.log_formatter)
-
-        self.logger.addHandler(self.logger_fh)
-        self.logger.propagate=False
+        super().__init__(log_filepath, logger_name, writer, journal)
 
-    def update_log(self, book, timestamp):
+    def update_log(self, book, timestamp, stock=None):
         """Enters a new log entry.
            The Exchange server + Clients should call this on their BookLogger whenever the order book gets updated.
         Args:
             book: CDABook object specifying the current CDABook to log
             timestamp: int specifying the timestamp of the log entry
+            stock: bytes symbol of the book, if the exchange trades several
+        """
+        # the levels are copied now as (price, quantity) tuples, the book keeps changing while the entry
+        # waits to be written; the dicts of the JSON line are built on the writer's thread
+        bids = book_levels(book.bids)
+        asks = book_levels(book.asks)
+        if self.journal is not None:
+            self.write_record(event_journal.encode_book, timestamp, event_journal.BOOK, stock, 0, bids, asks)
+            return
+        self.write_entry(timestamp, self.format_entry, bids, asks, stock)
+
+    @staticmethod
+    def format_entry(bids, asks, stock):
+        """JSON of a book whose bids and asks are lists of (price, quantity)"""
+        message = json.dumps({"bids": [{"price": price, "quantity": quantity} for (price, quantity) in bids],
+                              "asks": [{"price": price, "quantity": quantity} for (price, quantity) in asks]})
+        if stock is not None:
+            message = '%s, "stock": %s' % (message, json.dumps(stock.rstrip(b'\x00 ').decode('ascii', 'replace')))
+        return message
+
+class BookDeltaLogger(JsonLineLogger):
+    """Object used by the Exchange to log its books as the price levels that changed, rather than a full snapshot per update.
+       Each entry carries a sequence number, counted per book. Every snapshot_every entries of a book (or snapshot_interval
+       seconds, or whenever the whole book changed) the full book is written instead, so a reader can start from there.
+       Format of the entries (quantity 0 meaning the level is gone):
+         {"timestamp" : timestamp, "book_delta" : {"seq" : seq, "levels" : [[side, price, quantity], ...]}}
+         {"timestamp" : timestamp, "book_delta" : {"seq" : seq, "snapshot" : true, "bids" : [[price, quantity], ...], "asks" : [...]}}
+       Books of a multi-symbol exchange also carry their symbol, "stock" : stock, in the book_delta object.
+       read_book_deltas rebuilds the books from such a log.
+    Attributes:
+        logger: logger from logging
+        log_formatter: log.Formatter object for self.logger
+        logger_fh: log.FileHandler object for self.logger (only without a LogWriter)
+    """
+    key = "book_delta"
+
+    def __init__(self, log_filepath, logger_name, writer=None, snapshot_every=1000, snapshot_interval=None, journal=None):
+        """Initialize BookDeltaLogger
+        Args:
+            log_filepath: file path specifying the file for the BookDeltaLogger to write to
+            logger_name: name of the logger
+            writer: LogWriter serializing and writing the entries, None to write them on the caller's thread
+            snapshot_every: number of entries of a book between two of its snapshots
+            snapshot_interval: if given, seconds after which the next entry of a book is a snapshot
+            journal: if given, binary file the entries are written to as journal records, in place of log_filepath
+        """
+        super().__init__(log_filepath, logger_name, writer, journal)
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval_ns = None if snapshot_interval is None else int(snapshot_interval * 10**9)
+        # stock -> [sequence number of its last entry, entries since its last snapshot, timestamp of its last snapshot]
+        self.books = {}
+
+    def update_log(self, book, timestamp, levels, stock=None):
+        """Enters a new log entry.
+        Args:
+            book: order book (CDABook, FBABook, IEXBook) to log, None if it was dropped
+            timestamp: int specifying the timestamp of the log entry
+            levels: iterable of the (buy_sell_indicator, price) levels that changed since the last entry,
+                None if the whole book may have changed
+            stock: bytes symbol of the book, if the exchange trades several
         """
-        self.logger.info(book.as_json(), extra={"timestamp" : timestamp})        
+        state = self.books.get(stock)
+        if state is None:
+            state = self.books[stock] = [0, None, None]
+        state[0] += 1
+        journal = self.journal is not None
+        symbol = stock if journal or stock is None else stock.rstrip(b'\x00 ').decode('ascii', 'replace')
+        if (levels is None or state[1] is None or state[1] >= self.snapshot_every
+                or (self.snapshot_interval_ns is not None and timestamp - state[2] >= self.snapshot_interval_ns)):
+            if book is None:
+                bids, asks = [], []
+            else:
+                bids, asks = book_levels(book.bids), book_levels(book.asks)
+            state[1], state[2] = 0, timestamp
+            if journal:
+                self.write_record(event_journal.encode_book, timestamp, event_journal.BOOK_SNAPSHOT, symbol, state[0], bids, asks)
+            else:
+                self.write_entry(timestamp, self.format_snapshot, state[0], symbol, bids, asks)
+        else:
+            deltas = []
+            for (buy_sell_indicator, price) in levels:
+                ladder = book.bids if buy_sell_indicator == b'B' else book.asks
+                quantity = ladder[price].interest if price in ladder else 0
+                deltas.append((buy_sell_indicator, price, quantity))
+            state[1] += 1
+            if journal:
+                self.write_record(event_journal.encode_delta, timestamp, symbol, state[0], deltas)
+            else:
+                self.write_entry(timestamp, self.format_delta, state[0], symbol, deltas)
+
+    @staticmethod
+    def format_delta(seq, stock, deltas):
+        entry = {"seq": seq, "levels": [(side.decode('ascii'), price, quantity) for (side, price, quantity) in deltas]}
+        if stock is not None:
+            entry["stock"] = stock
+        return json.dumps(entry)
+
+    @staticmethod
+    def format_snapshot(seq, stock, bids, asks):
+        entry = {"seq": seq, "snapshot": True, "bids": bids, "asks": asks}
+        if stock is not None:
+            entry["stock"] = stock
+        return json.dumps(entry)
+
+def read_book_deltas(log_filepath, timestamp=None):
+    """Rebuild the books logged by a BookDeltaLogger.
+    Args:
+        log_filepath: the BookDeltaLogger's file
+        timestamp: if given, the books as they were after the last entry at or before timestamp
+    Returns:
+        dict of stock (str, None for a single book exchange) -> {"bids": {price: quantity}, "asks": {price: quantity}}.
+        A book whose sequence numbers skip (entries dropped by a full LogWriter) is left out until its next snapshot.
+    """
+    books = {}
+    last_seq = {}
+    with open(log_filepath) as log_file:
+        for line in log_file:
+            entry = json.loads(line)
+            if timestamp is not None and entry["timestamp"] > timestamp:
+                break
+            delta = entry["book_delta"]
+            stock = delta.get("stock")
+            seq = delta["seq"]
+            in_sequence = last_seq.get(stock) == seq - 1
+            last_seq[stock] = seq
+            if delta.get("snapshot"):
+                books[stock] = {"bids": {price: quantity for (price, quantity) in delta["bids"]},
+                                "asks": {price: quantity for (price, quantity) in delta["asks"]}}
+            elif not in_sequence:
+                if stock in books:
+                    log.warning('Book log of %s skips to entry %d, book unknown until the next snapshot', stock, seq)
+                books.pop(stock, None)
+            elif stock in books:
+                for (side, price, quantity) in delta["levels"]:
+                    levels = books[stock]["bids" if side == "B" else "asks"]
+                    if quantity:
+                        levels[price] = quantity
+                    else:
+                        levels.pop(price, None)
+    return books
 
-class TransactionLogger():
+class TransactionLogger(JsonLineLogger):
     """Object used by the Exchange and Client classes that log transactions that occur in the exchange as JSON dictionaries to a specified logfile
        Each log entry has a timestamp and the transaction that occurred at that timestamp, and are added to the next new line in the logfile.
        NOTE: transactions will be logged twice - once for each order that is in the transaction.
@@ -52,26 +386,19 @@ class TransactionLogger():
     Attributes:
         logger: logger from logging
         log_formatter: log.Formatter object for self.logger
-        logger_fh: log.FileHandler object for self.logger
+        logger_fh: log.FileHandler object for self.logger (only without a LogWriter)
     """
+    key = "transaction"
 
-    def __init__(self, log_filepath, logger_name):
+    def __init__(self, log_filepath, logger_name, writer=None, journal=None):
         """Initialize TransactionLogger
         Args:
             log_filepath: file path specifying the file for the TransactionLogger to write to
             logger_name: name of the logger
+            writer: LogWriter serializing and writing the entries, None to write them on the caller's thread
+            journal: if given, binary file the entries are written to as journal records, in place of log_filepath
         """
-        self.logger = log.getLogger(logger_name)
-        self.logger.setLevel(log.INFO)
-
-        self.log_formatter = log.Formatter('{\"timestamp\": %(timestamp)s, \"transaction\": %(message)s}')
-
-        self.logger_fh = log.FileHandler(filename=log_filepath, mode='w')
-        self.logger_fh.setLevel(log.INFO)
-        self.logger_fh.setFormatter(self.log_formatter)
-
-        self.logger.addHandler(self.logger_fh)
-        self.logger.propagate=False
+        super().__init__(log_filepath, logger_name, writer, journal)
     
     def update_log(self, transaction, timestamp):
         """Enters a new log entry.
@@ -80,14 +407,22 @@ class TransactionLogger():
             transaction: JSON dictionary specifying the transaction to log
             timestamp: int specifying the timestamp of the log entry
         """
+        if self.journal is not None:
+            # server messages are not changed once sent
+            self.write_record(event_journal.encode_message, timestamp, event_journal.SERVER_MESSAGE, transaction)
+            return
+        self.write_entry(timestamp, self.format_entry,
+            transaction['order_token'], transaction['executed_shares'], transaction['execution_price'])
+
+    @staticmethod
+    def format_entry(token, shares, price):
         transaction_data = {}
-        transaction_data["token"] = transaction['order_token'].decode()
-        transaction_data["shares"] = transaction['executed_shares']
-        transaction_data["price"] = transaction['execution_price']
-        transaction_json = json.dumps(transaction_data)
-        self.logger.info(transaction_json, extra={"timestamp" : timestamp})
+        transaction_data["token"] = token.decode()
+        transaction_data["shares"] = shares
+        transaction_data["price"] = price
+        return json.dumps(transaction_data)
 
-class ClientStateLogger():
+class ClientStateLogger(JsonLineLogger):
     """Object used by the Client class that logs snapshots of the Client's account information as JSON dictionaries to a specified logfile.
        Each log entry has a timestamp and the snapshot of the Client's account info at that timestamp, and are added to the next new line in the logfile.
        NOTE: Only gets used by Clients, and not the Exchange server
@@ -96,38 +431,33 @@ class ClientStateLogger():
     Attributes:
         logger: logger from logging
         log_formatter: log.Formatter object for self.logger
-        logger_fh: log.FileHandler object for self.logger
+        logger_fh: log.FileHandler object for self.logger (only without a LogWriter)
     """
+    key = "state"
 
-    def __init__(self, log_filepath, logger_name):
+    def __init__(self, log_filepath, logger_name, writer=None, journal=None):
         """Initialize ClientStateLogger
         Args:
             log_filepath: file path specifying the file for the ClientStateLogger to write to
             logger_name: name of the logger
+            writer: LogWriter serializing and writing the entries, None to write them on the caller's thread
+            journal: if given, binary file the entries are written to as journal records, in place of log_filepath
         """
-        self.logger = log.getLogger(logger_name)
-        self.logger.setLevel(log.INFO)
-
-        self.log_formatter = log.Formatter('{\"timestamp\": %(timestamp)s, \"state\": %(message)s}')
-
-        self.logger_fh = log.FileHandler(filename=log_filepath, mode='w')
-        self.logger_fh.setLevel(log.INFO)
-        self.logger_fh.setFormatter(self.log_formatter)
-
-        self.logger.addHandler(self.logger_fh)
-        self.logger.propagate=False
+        super().__init__(log_filepath, logger_name, writer, journal)
 
     def update_log(self, client_info, timestamp):
         """Enters a new log entry.
            The Clients should call this whenever their account/states gets updated
         Args:
-            client_info: dictionary specifying the current client information to log
+            client_info: dictionary specifying the current client information to log, not to be changed afterwards
             timestamp: int specifying the timestamp of the log entry
         """
-        client_info_json = json.dumps(client_info)
-        self.logger.info(client_info_json, extra={"timestamp" : timestamp})
+        if self.journal is not None:
+            self.write_record(event_journal.encode_state, timestamp, json.dumps(client_info))
+            return
+        self.write_entry(timestamp, json.dumps, client_info)
 
-class ClientActionLogger():
+class ClientActionLogger(JsonLineLogger):
     """Object used by the Exchange class that logs actions taken by Clients as JSON dictionaries to a specified logfile
        Each log entry has a timestamp and a JSON representation of the Client action at that timestamp, and are added to the next new line in the logfile.
        NOTE: Inside of "action", "action_type" should be accessed first in order to determine what action (i.e, place_order, cancel_order) the entry is. 
@@ -137,26 +467,19 @@ class ClientActionLogger():
     Attributes:
         logger: logger from logging
         log_formatter: log.Formatter object for self.logger
-        logger_fh: log.FileHandler object for self.logger
+        logger_fh: log.FileHandler object for self.logger (only without a LogWriter)
     """
+    key = "action"
 
-    def __init__(self, log_filepath, logger_name):
+    def __init__(self, log_filepath, logger_name, writer=None, journal=None):
         """Initialize ClientActionLogger
         Args:
             log_filepath: file path specifying the file for the ClientActionLogger to write to
             logger_name: name of the logger
+            writer: LogWriter serializing and writing the entries, None to write them on the caller's thread
+            journal: if given, binary file the entries are written to as journal records, in place of log_filepath
         """
-        self.logger = log.getLogger(logger_name)
-        self.logger.setLevel(log.INFO)
-
-        self.log_formatter = log.Formatter('{\"timestamp\": %(timestamp)s, \"action\": %(message)s}')
-        
-        self.logger_fh = log.FileHandler(filename=log_filepath, mode='w')
-        self.logger_fh.setLevel(log.INFO)
-        self.logger_fh.setFormatter(self.log_formatter)
-
-        self.logger.addHandler(self.logger_fh)
-        self.logger.propagate=False
+        super().__init__(log_filepath, logger_name, writer, journal)
     
     def update_log(self, action_type, client_action_msg, timestamp):
         """Enters a new log entry.
@@ -166,18 +489,72 @@ class ClientActionLogger():
             client_action_msg: dictionary specifying the data associated with the action being logged
             timestamp: int specifying the timestamp of the log entry
         """
+        if self.journal is not None:
+            # the action type follows from the message type, EnterOrder or CancelOrder
+            self.write_record(event_journal.encode_message, timestamp, event_journal.CLIENT_MESSAGE, client_action_msg)
+        elif action_type == PLACE_LIMIT_ORDER_ACTION:
+            self.write_entry(timestamp, self.format_entry, action_type, client_action_msg['order_token'],
+                client_action_msg['shares'], client_action_msg['buy_sell_indicator'], client_action_msg['price'],
+                client_action_msg['stock'], client_action_msg['time_in_force'])
+        elif action_type == CANCEL_LIMIT_ORDER_ACTION:
+            self.write_entry(timestamp, self.format_entry, action_type, client_action_msg['order_token'],
+                client_action_msg['shares'])
+        else:
+            self.write_entry(timestamp, self.format_entry, action_type, None, None)
+
+    @staticmethod
+    def format_entry(action_type, token, shares, direction=None, price=None, stock=None, time_in_force=None):
         action_data = {}
         
         if action_type == PLACE_LIMIT_ORDER_ACTION:
-            token_id = client_action_msg['order_token'].decode("utf-8")
-            direction = client_action_msg['buy_sell_indicator'].decode("utf-8")
-            order_price = client_action_msg['price']
-            order_shares = client_action_msg['shares']
-            action_data = {"token" : token_id, "direction" : direction, "price" : order_price, "shares" : order_shares}
+            token_id = token.decode("utf-8")
+            direction = direction.decode("utf-8")
+            action_data = {"token" : token_id, "direction" : direction, "price" : price, "shares" : shares,
+                           "stock" : stock.decode("utf-8"), "time_in_force" : time_in_force}
         elif action_type == CANCEL_LIMIT_ORDER_ACTION:
-            token_id = client_action_msg['order_token'].decode("utf-8")
-            canceled_shares = client_action_msg['shares']
-            action_data = {"token" : token_id, "shares" : canceled_shares}
+            token_id = token.decode("utf-8")
+            action_data = {"token" : token_id, "shares" : shares}
         
-        action_json = json.dumps({"action_type" : action_type, "action_data" : action_data})
-        self.logger.info(action_json, extra={"timestamp" : timestamp})
+        return json.dumps({"action_type" : action_type, "action_data" : action_data})
+
+def journal_to_json(journal_filepath, book_log, transaction_log, action_log, state_log=None):
+    """Convert a journal back into the JSON line logs, in the shapes the loggers write without a journal.
+    Args:
+        journal_filepath: file the journal loggers wrote
+        book_log, transaction_log, action_log, state_log: paths of the logs to write (state_log only if given)
+    """
+    paths = {"book": book_log, "transaction": transaction_log, "action": action_log, "state": state_log}
+    files = {key: open(path, 'w') for (key, path) in paths.items() if path is not None}
+    try:
+        for (record_type, timestamp, value) in event_journal.read_journal(journal_filepath):
+            if record_type == event_journal.SERVER_MESSAGE:
+                if value.message_type != OuchServerMessages.Executed:
+                    continue
+                (key, format_entry, values) = ("transaction", TransactionLogger.format_entry,
+                    (value['order_token'].rstrip(b'\x00'), value['executed_shares'], value['execution_price']))
+            elif record_type == event_journal.CLIENT_MESSAGE:
+                token = value['order_token'].rstrip(b'\x00')
+                if value.message_type == OuchClientMessages.EnterOrder:
+                    values = (PLACE_LIMIT_ORDER_ACTION, token, value['shares'], value['buy_sell_indicator'], value['price'],
+                        value['stock'].rstrip(b'\x00'), value['time_in_force'])
+                else:
+                    values = (CANCEL_LIMIT_ORDER_ACTION, token, value['shares'])
+                (key, format_entry) = ("action", ClientActionLogger.format_entry)
+            elif record_type == event_journal.BOOK:
+                (key, format_entry, values) = ("book", BookLogger.format_entry, (value.bids, value.asks, value.stock))
+            elif record_type in (event_journal.BOOK_SNAPSHOT, event_journal.BOOK_DELTA):
+                symbol = None if value.stock is None else value.stock.rstrip(b' ').decode('ascii', 'replace')
+                if record_type == event_journal.BOOK_SNAPSHOT:
+                    (format_entry, values) = (BookDeltaLogger.format_snapshot, (value.seq, symbol, value.bids, value.asks))
+                else:
+                    (format_entry, values) = (BookDeltaLogger.format_delta, (value.seq, symbol, value.levels))
+                # a delta logger's entries go to the book log under its own key
+                files["book"].write(json_line(BookDeltaLogger.key, timestamp, format_entry, values))
+                continue
+            else:
+                (key, format_entry, values) = ("state", str, (value,))
+            if key in files:
+                files[key].write(json_line(key, timestamp, format_entry, values))
+    finally:
+        for log_file in files.values():
+            log_file.close()
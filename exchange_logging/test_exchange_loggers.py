@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from OuchServer.ouch_messages import OuchServerMessages
+from exchange.order_books.cda_book import CDABook
+from exchange_logging.exchange_loggers import BookLogger, BookDeltaLogger, TransactionLogger, LogWriter, read_book_deltas
+
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_writer_matches_synchronous_logging(self):
+        book = CDABook()
+        book.enter_buy(b'a', 10, 5, True)
+        executed = OuchServerMessages.Executed(timestamp = 1, order_token = b'a', executed_shares = 2,
+            execution_price = 10, liquidity_flag = b'?', match_number = 0, midpoint_peg = False)
+        writer = LogWriter()
+        loggers = [(BookLogger(self.path('sync_book'), 'test_sync_book'), TransactionLogger(self.path('sync_tx'), 'test_sync_tx')),
+                   (BookLogger(self.path('book'), 'test_book', writer), TransactionLogger(self.path('tx'), 'test_tx', writer))]
+        for (book_logger, transaction_logger) in loggers:
+            book_logger.update_log(book, timestamp = 1, stock = b'AAPL')
+            transaction_logger.update_log(executed, timestamp = 2)
+        # the entry holds the book as it was when logged
+        book.enter_sell(b'b', 10, 5, True)
+        writer.close()
+        for handler in (loggers[0][0].logger_fh, loggers[0][1].logger_fh):
+            handler.close()
+        self.assertEqual(self.read('book'), self.read('sync_book'))
+        self.assertEqual(self.read('tx'), self.read('sync_tx'))
+        entry = json.loads(self.read('book'))
+        self.assertEqual(entry['book']['bids'], [{'price': 10, 'quantity': 5}])
+        self.assertEqual(entry['stock'], 'AAPL')
+
+    def test_drop_policy(self):
+        started, release = threading.Event(), threading.Event()
+        def stuck(value):
+            started.set()
+            release.wait()
+            return str(value)
+        writer = LogWriter(max_records = 2, overflow_policy = 'drop')
+        log_file = writer.open(self.path('log'))
+        writer.put(log_file, 'n', 0, stuck, (0,))
+        started.wait()
+        # the thread is busy with record 0, two more fit in the buffer
+        for i in range(1, 5):
+            writer.put(log_file, 'n', i, str, (i,))
+        release.set()
+        writer.close()
+        self.assertEqual(writer.dropped, 2)
+        self.assertEqual([json.loads(line)['n'] for line in self.read('log').splitlines()], [0, 1, 2])
+
+    def test_bad_record_is_dropped_and_the_thread_goes_on(self):
+        writer = LogWriter()
+        log_file = writer.open(self.path('log'))
+        # the thread may write the records as soon as they are put
+        with self.assertLogs(level = 'ERROR'):
+            writer.put(log_file, 'n', 0, str, (0,))
+            # a client token that is not UTF-8
+            writer.put(log_file, 'n', 1, bytes.decode, (b'\xff',))
+            writer.put(log_file, 'n', 2, str, (2,))
+            writer.flush()
+        writer.close()
+        self.assertEqual(writer.failed, 1)
+        self.assertEqual([json.loads(line)['n'] for line in self.read('log').splitlines()], [0, 2])
+
+    def test_dead_writer_blocks_nobody(self):
+        writer = LogWriter(max_records = 1)
+        log_file = writer.open(self.path('log'))
+        def die(written):
+            raise RuntimeError('disk gone')
+        writer.on_written = die
+        with self.assertLogs(level = 'ERROR'):
+            writer.put(log_file, 'n', 0, str, (0,))
+            writer.thread.join(5)
+        self.assertTrue(writer.stopped)
+        # neither a full buffer nor a flush waits for the dead thread
+        for i in range(1, 4):
+            writer.put(log_file, 'n', i, str, (i,))
+        writer.flush()
+        writer.close()
+
+    def test_book_deltas_at_timestamp_and_gaps(self):
+        book = CDABook()
+        book_logger = BookDeltaLogger(self.path('deltas'), 'test_deltas', LogWriter(), snapshot_every = 3)
+        book.enter_buy(b'a', 10, 5, True)
+        book_logger.update_log(book, 100, None)
+        book.enter_sell(b'b', 12, 2, True)
+        book_logger.update_log(book, 200, [(b'S', 12)])
+        book.enter_sell(b'c', 10, 5, True)
+        book_logger.update_log(book, 300, [(b'S', 10), (b'B', 10)])
+        # an entry lost to a full buffer
+        book_logger.books[None][0] += 1
+        book.enter_buy(b'd', 12, 2, True)
+        book_logger.update_log(book, 400, [(b'B', 12), (b'S', 12)])
+        book_logger.writer.close()
+
+        self.assertEqual(read_book_deltas(self.path('deltas'), timestamp = 250), {None: {'bids': {10: 5}, 'asks': {12: 2}}})
+        self.assertEqual(read_book_deltas(self.path('deltas'), timestamp = 300), {None: {'bids': {}, 'asks': {12: 2}}})
+        with self.assertLogs(level = 'WARNING'):
+            self.assertEqual(read_book_deltas(self.path('deltas')), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
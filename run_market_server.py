@@ -3,16 +3,24 @@ Continuous Double Auction Server that handles clients'
 buy/sell and cancel orders
 """
 import asyncio
+from functools import partial
 import configargparse
 import logging as log
 from OuchServer.ouch_server import ProtocolMessageServer
+from OuchServer.client_send_queue import OVERFLOW_POLICIES
+from exchange_logging.exchange_loggers import LOG_OVERFLOW_POLICIES
 from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
 from exchange.order_books.cda_book import CDABook
-from exchange.order_books.fba_book import FBABook
+from exchange.order_books.fba_book import FBABook, CLEARING_ENGINES
 from exchange.order_books.iex_book import IEXBook
+from exchange.order_books.list_elements import PRICE_LADDERS, TickIndexedLadder
+from exchange.order_books.array_price_q import PRICE_QUEUES
+from exchange.order_books.fba_book_price_q import FBA_PRICE_QUEUES
 from exchange.exchange import Exchange
 from exchange.fba_exchange import FBAExchange
 from exchange.iex_exchange import IEXExchange
+from exchange.sharded_exchange import ShardedExchange
+from exchange.sequencer import Sequencer
 
 p = configargparse.getArgParser()
 # Used to set port and bind address for exchange
@@ -26,8 +34,41 @@ p.add('--outputlogfile', default=None, type=str)
 p.add('--book_log', default=None)
 p.add('--mechanism', choices=['cda', 'fba', 'iex'], default = 'cda')
 p.add('--interval', default = None, type=float, help="(FBA) Interval between batch auctions in seconds")
+p.add('--fba_seed', default=None, type=int, help="(FBA) Seed of the random priority of the orders entered at a price in the same batch, for reproducible auctions")
+p.add('--fba_clearing', choices=list(CLEARING_ENGINES), default='numpy', help="(FBA) How the clearing price of a batch is computed: vectorized, or by merging the levels in Python")
 p.add('--delay', default = None, type=float, help="(IEX) 'speed bump' time that orders are delayed before being entered")
+p.add('--ladder', choices=list(PRICE_LADDERS), default='linked', help="Price ladder backend used by the order book")
+# Setting both bounds switches the book to a preallocated tick-indexed ladder, overriding --ladder
+p.add('--min_price', default=None, type=int, help="Lowest price accepted into the book")
+p.add('--max_price', default=None, type=int, help="Highest price accepted into the book")
+p.add('--tick', default=1, type=int, help="Price increment of the book when a price band is set")
+p.add('--level_queue', choices=list(PRICE_QUEUES), default='ordered', help="Queue implementation holding the orders of a price level")
+p.add('--multi_symbol', action='store_true', help="Keep one order book per stock, opened by the first order naming it")
+p.add('--stock', default='AMAZGOOG', help="Symbol of the order book when not in --multi_symbol mode")
+p.add('--shards', default=0, type=int, help="Match in this many worker processes, each owning the books of a share of the stocks (implies --multi_symbol)")
+p.add('--send_queue_bytes', default=1 << 20, type=int, help="Bound in bytes of each client's outbound queue")
+p.add('--send_queue_messages', default=10000, type=int, help="Bound in messages of each client's outbound queue")
+p.add('--overflow_policy', choices=OVERFLOW_POLICIES, default='conflate', help="What a client's full outbound queue does with market data (or the client); order messages that do not fit always disconnect it")
+p.add('--bbo_conflation', default=None, type=float, help="Broadcast at most one BestBidAndOffer per stock every this many seconds (0: once per event loop tick)")
+p.add('--log_buffer_records', default=65536, type=int, help="Bound in records of the buffer of the market log writer thread")
+p.add('--log_overflow_policy', choices=LOG_OVERFLOW_POLICIES, default='block', help="Whether a full market log buffer blocks matching or drops log records")
+p.add('--book_log_mode', choices=['snapshot', 'delta'], default='snapshot', help="Log full books, or only their changed price levels with periodic snapshots")
+p.add('--book_snapshot_every', default=1000, type=int, help="(delta book log) Entries of a book between two full snapshots")
+p.add('--book_snapshot_interval', default=None, type=float, help="(delta book log) Seconds after which a book is snapshot again")
+p.add('--log_format', choices=['json', 'journal'], default='json', help="Write the market logs as JSON lines, or as one binary journal (see exchange_logging/event_journal.py)")
+p.add('--order_history_log', default=None, help="Journal file in exchange/market_logs for every message of every order, which the order store drops once an order is done with")
+p.add('--recent_tokens', default=65536, type=int, help="Number of the last retired order tokens still rejected as a RepeatID; older ones can be reused")
+p.add('--sequencer', action='store_true', help="Queue client messages for a single matching task instead of matching on each client's reader task")
+p.add('--wal_dir', default=None, help="(CDA, no --shards) Write-ahead log and snapshot directory; a restarted exchange recovers its books and orders from it")
+p.add('--state_snapshot_interval', default=60, type=float, help="(--wal_dir) Seconds between two snapshots of the books and order store")
+p.add('--wal_no_wait', action='store_true', help="(--wal_dir) Send responses without waiting for the write-ahead log to fsync their messages")
 options, args = p.parse_known_args()
+if (options.min_price is None) != (options.max_price is None):
+    p.error('--min_price and --max_price set the price band together, give both or neither')
+if options.sequencer and options.shards > 0:
+    p.error('--sequencer is not supported with --shards, each worker matches its own messages')
+if options.wal_dir is not None and (options.mechanism != 'cda' or options.shards > 0):
+    p.error('--wal_dir is only supported by the single process CDA exchange')
 
 
 async def main():
@@ -37,40 +78,94 @@ async def main():
         filename = options.logfile)
 
     loop = asyncio.get_event_loop()
-    server = ProtocolMessageServer(OuchClientMessages, options.host, options.port)
+    server = ProtocolMessageServer(OuchClientMessages, options.host, options.port,
+                                   send_queue_bytes = options.send_queue_bytes,
+                                   send_queue_messages = options.send_queue_messages,
+                                   overflow_policy = options.overflow_policy)
+    if options.min_price is not None and options.max_price is not None:
+        ladder = partial(TickIndexedLadder, min_price = options.min_price,
+                         max_price = options.max_price, tick = options.tick)
+    else:
+        ladder = PRICE_LADDERS[options.ladder]
+
+    if options.mechanism == 'fba':
+        book_factory = partial(FBABook, ladder = ladder, price_q = FBA_PRICE_QUEUES[options.level_queue],
+                               clearing = CLEARING_ENGINES[options.fba_clearing], seed = options.fba_seed)
+    else:
+        book_class = CDABook if options.mechanism == 'cda' else IEXBook
+        book_factory = partial(book_class, ladder = ladder, price_q = PRICE_QUEUES[options.level_queue])
+    if options.multi_symbol:
+        books = dict(order_book = None, book_factory = book_factory)
+    else:
+        books = dict(order_book = book_factory(), stock = options.stock.encode('ascii'))
     
-    if options.mechanism == 'cda':        
-        book = CDABook()
-        exchange = Exchange(order_book = book,
+    logs = dict(log_buffer_records = options.log_buffer_records, log_overflow_policy = options.log_overflow_policy,
+                book_log_mode = options.book_log_mode, book_snapshot_every = options.book_snapshot_every,
+                book_snapshot_interval = options.book_snapshot_interval, log_format = options.log_format,
+                order_history_log = options.order_history_log, recent_tokens = options.recent_tokens)
+    if options.shards > 0:
+        exchange_class, exchange_kwargs = {
+            'cda': (Exchange, {}),
+            'fba': (FBAExchange, dict(interval = options.interval)),
+            'iex': (IEXExchange, dict(delay = options.delay)),
+        }[options.mechanism]
+        exchange = ShardedExchange(options.shards, exchange_class, book_factory,
                             order_reply = server.send_server_response,
                             message_broadcast = server.broadcast_server_message,
-                            loop = loop)
+                            loop = loop,
+                            bbo_conflation = options.bbo_conflation,
+                            **logs,
+                            **exchange_kwargs)
+        exchange.start()
+    elif options.mechanism == 'cda':        
+        exchange = Exchange(order_reply = server.send_server_response,
+                            message_broadcast = server.broadcast_server_message,
+                            loop = loop,
+                            bbo_conflation = options.bbo_conflation,
+                            wal_dir = options.wal_dir,
+                            state_snapshot_interval = options.state_snapshot_interval,
+                            wal_wait_commit = not options.wal_no_wait,
+                            **logs,
+                            **books)
         
     # untested by 115b/c team
     elif options.mechanism == 'fba':
-        book = FBABook()
-        exchange = FBAExchange(order_book = book,
-                            order_reply = server.send_server_response,
+        exchange = FBAExchange(order_reply = server.send_server_response,
                             message_broadcast = server.broadcast_server_message,
                             loop = loop, 
-                            interval = options.interval)
+                            interval = options.interval,
+                            bbo_conflation = options.bbo_conflation,
+                            **logs,
+                            **books)
         exchange.start()
     # untested by 115b/c team
     elif options.mechanism == 'iex':
-        book = IEXBook()
-        exchange = IEXExchange(order_book = book,
-                            order_reply = server.send_server_response,
+        exchange = IEXExchange(order_reply = server.send_server_response,
                             message_broadcast = server.broadcast_server_message,
                             loop = loop,
-                            delay = options.delay)
+                            delay = options.delay,
+                            bbo_conflation = options.bbo_conflation,
+                            **logs,
+                            **books)
     
-    server.register_listener(exchange.process_message)
+    if options.sequencer:
+        sequencer = Sequencer(exchange)
+        sequencer.start()
+        server.register_listener(sequencer.submit)
+    else:
+        server.register_listener(exchange.process_message)
     await server.start()
 
     try:
         await asyncio.get_running_loop().create_future()
     except KeyboardInterrupt:
         pass
+    finally:
+        # write out the market logs and the write-ahead log
+        if options.shards > 0:
+            await exchange.stop()
+        else:
+            exchange.close()
 
 
 if __name__ == '__main__':
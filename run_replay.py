@@ -0,0 +1,61 @@
+"""
+Replays a recorded session (action log or event journal) through a
+Continuous Double Auction exchange, without sockets
+"""
+import asyncio
+from functools import partial
+import configargparse
+import logging as log
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.list_elements import PRICE_LADDERS, TickIndexedLadder
+from exchange.order_books.array_price_q import PRICE_QUEUES
+from exchange.replay import read_actions, replay
+
+p = configargparse.getArgParser()
+p.add('action_log', help="Action log (exchange/market_logs/action_log.txt) or event journal of the session to replay")
+p.add('--debug', action='store_true')
+p.add('--logfile', default=None, type=str)
+p.add('--speed', default=None, type=float, help="Replay this many times faster than recorded, as fast as possible if not set")
+p.add('--ladder', choices=list(PRICE_LADDERS), default='linked', help="Price ladder backend used by the order book")
+p.add('--min_price', default=None, type=int, help="Lowest price accepted into the book")
+p.add('--max_price', default=None, type=int, help="Highest price accepted into the book")
+p.add('--tick', default=1, type=int, help="Price increment of the book when a price band is set")
+p.add('--level_queue', choices=list(PRICE_QUEUES), default='ordered', help="Queue implementation holding the orders of a price level")
+p.add('--multi_symbol', action='store_true', help="Keep one order book per stock, as the recorded exchange had")
+p.add('--stock', default='AMAZGOOG', help="Symbol of the order book when not in --multi_symbol mode")
+p.add('--book_log_mode', choices=['snapshot', 'delta'], default='snapshot', help="Log full books, or only their changed price levels with periodic snapshots")
+p.add('--log_format', choices=['json', 'journal'], default='json', help="Write the replay's market logs as JSON lines, or as one binary journal")
+p.add('--show_books', action='store_true', help="Print the final books")
+options, args = p.parse_known_args()
+if (options.min_price is None) != (options.max_price is None):
+    p.error('--min_price and --max_price set the price band together, give both or neither')
+
+
+async def main():
+    log.basicConfig(level=log.DEBUG if options.debug else log.WARNING,
+        format = "[%(asctime)s.%(msecs)03d] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt = '%H:%M:%S',
+        filename = options.logfile)
+
+    if options.min_price is not None and options.max_price is not None:
+        ladder = partial(TickIndexedLadder, min_price = options.min_price,
+                         max_price = options.max_price, tick = options.tick)
+    else:
+        ladder = PRICE_LADDERS[options.ladder]
+    book_factory = partial(CDABook, ladder = ladder, price_q = PRICE_QUEUES[options.level_queue])
+    stock = options.stock.encode('ascii')
+
+    actions = read_actions(options.action_log)
+    result = await replay(actions, book_factory = book_factory, multi_symbol = options.multi_symbol,
+                          stock = stock, speed = options.speed, book_log_mode = options.book_log_mode,
+                          log_format = options.log_format)
+    print(result)
+    print('digest', result.digest())
+    if options.show_books:
+        for (symbol, book) in sorted(result.books.items()):
+            print(symbol.decode('ascii', 'replace'), 'bids', sorted(book["bids"].items(), reverse=True),
+                  'asks', sorted(book["asks"].items()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())